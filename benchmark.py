@@ -0,0 +1,168 @@
+import argparse
+import cv2
+import json
+import os
+import shutil
+import tempfile
+import time
+import numpy as np
+import tensorflow as tf
+
+from model import CycleGAN
+from module import discriminator, generator_resnet
+from utils import load_data, sample_train_data
+from convert import conversion
+from instrumentation import peak_rss_mb
+
+# CPU benchmarks on synthetic data, no dataset download needed
+# Peak memory is the process peak RSS after each benchmark, so it never decreases over the run
+
+def timing(function, num_runs = 10, num_warmup = 2, num_items = 1):
+
+    for _ in range(num_warmup):
+        function()
+
+    times = list()
+    for _ in range(num_runs):
+        start_time = time.time()
+        function()
+        times.append(time.time() - start_time)
+    times = np.array(times)
+
+    return {
+        'median_ms': float(np.median(times) * 1000),
+        'p95_ms': float(np.percentile(times, 95) * 1000),
+        'throughput': float(num_items / np.median(times)),
+        'peak_rss_mb': peak_rss_mb()}
+
+def benchmark_network(network, resolution, num_filters, batch_size = 1, num_runs = 10):
+
+    # Forward and forward + backward of a generator or discriminator
+    with tf.Graph().as_default():
+        inputs = tf.placeholder(tf.float32, shape = [batch_size, resolution[0], resolution[1], 3])
+        outputs = network(inputs = inputs, num_filters = num_filters, reuse = False, scope_name = 'benchmark')
+        gradients = tf.gradients(tf.reduce_mean(outputs), tf.trainable_variables())
+
+        with tf.Session() as sess:
+            sess.run(tf.global_variables_initializer())
+            feed_dict = {inputs: np.random.uniform(-1, 1, size = [batch_size, resolution[0], resolution[1], 3])}
+            forward = timing(lambda: sess.run(outputs, feed_dict = feed_dict), num_runs = num_runs, num_items = batch_size)
+            backward = timing(lambda: sess.run(gradients, feed_dict = feed_dict), num_runs = num_runs, num_items = batch_size)
+
+    return forward, backward
+
+def benchmark_train_step(resolution, num_filters, batch_size = 1, num_runs = 5, fused_step = False):
+
+    log_dir = tempfile.mkdtemp()
+    with tf.Graph().as_default():
+        model = CycleGAN(input_size = [resolution[0], resolution[1], 3], num_filters = num_filters, mode = 'train', log_dir = log_dir, fused_step = fused_step)
+        input_A = np.random.uniform(-1, 1, size = [batch_size, resolution[0], resolution[1], 3])
+        input_B = np.random.uniform(-1, 1, size = [batch_size, resolution[0], resolution[1], 3])
+        result = timing(lambda: model.train(input_A = input_A, input_B = input_B, learning_rate = 0.0002), num_runs = num_runs, num_items = batch_size)
+        model.writer.close()
+        model.sess.close()
+    shutil.rmtree(log_dir)
+
+    return result
+
+def write_synthetic_images(img_dir, num_images, resolution):
+
+    if not os.path.exists(img_dir):
+        os.makedirs(img_dir)
+    for i in range(num_images):
+        img = np.random.randint(0, 256, size = [resolution[0], resolution[1], 3], dtype = np.uint8)
+        cv2.imwrite(os.path.join(img_dir, '%05d.jpg' % i), img)
+
+def benchmark_data(num_images, image_resolution, load_size, fine_size, num_runs = 3):
+
+    data_dir = tempfile.mkdtemp()
+    write_synthetic_images(img_dir = data_dir, num_images = num_images, resolution = image_resolution)
+
+    results = dict()
+    results['load_data'] = timing(lambda: load_data(img_dir = data_dir, load_size_w = load_size[1], load_size_h = load_size[0]), num_runs = num_runs, num_warmup = 0, num_items = num_images)
+
+    dataset = load_data(img_dir = data_dir, load_size_w = load_size[1], load_size_h = load_size[0])
+    results['sample_train_data'] = timing(lambda: sample_train_data(dataset, dataset, load_size_w = load_size[1], load_size_h = load_size[0], output_size_w = fine_size[1], output_size_h = fine_size[0], batch_size_maximum = num_images),
+                                          num_runs = num_runs, num_warmup = 0, num_items = num_images)
+    shutil.rmtree(data_dir)
+
+    return results
+
+def benchmark_conversion(num_images, image_resolution, batch_size = 8, num_runs = 3):
+
+    # End to end convert.conversion with a randomly initialized model
+    work_dir = tempfile.mkdtemp()
+    img_dir = os.path.join(work_dir, 'images')
+    output_dir = os.path.join(work_dir, 'converted')
+    write_synthetic_images(img_dir = img_dir, num_images = num_images, resolution = image_resolution)
+
+    # convert.conversion builds a model with 64 filters
+    with tf.Graph().as_default():
+        model = CycleGAN(input_size = [256, 256, 3], num_filters = 64, mode = 'test', directions = ['A2B'])
+        model_filepath = model.save(directory = os.path.join(work_dir, 'model'), filename = 'benchmark.ckpt')
+        model.sess.close()
+
+    def run():
+        with tf.Graph().as_default():
+            conversion(model_filepath = model_filepath, img_dir = img_dir, conversion_direction = 'A2B', output_dir = output_dir, batch_size = batch_size)
+
+    result = timing(run, num_runs = num_runs, num_warmup = 0, num_items = num_images)
+    shutil.rmtree(work_dir)
+
+    return result
+
+def parse_resolution(resolution):
+
+    # HxW
+    return [int(size) for size in resolution.split('x')]
+
+if __name__ == '__main__':
+
+    parser = argparse.ArgumentParser(description = 'CPU benchmarks of the CycleGAN networks, training step, data loading and conversion on synthetic data.')
+
+    parser.add_argument('--resolutions', type = str, nargs = '+', help = 'Resolutions HxW for the network and training step benchmarks.', default = ['128x128', '256x256'])
+    parser.add_argument('--num_filters', type = int, nargs = '+', help = 'Filter numbers for the network and training step benchmarks.', default = [16, 32])
+    parser.add_argument('--batch_size', type = int, help = 'Batch size for the network and training step benchmarks.', default = 1)
+    parser.add_argument('--num_runs', type = int, help = 'Number of timed runs per benchmark.', default = 10)
+    parser.add_argument('--num_images', type = int, help = 'Number of synthetic images for the data and conversion benchmarks.', default = 32)
+    parser.add_argument('--image_resolution', type = str, help = 'Resolution HxW of the synthetic images.', default = '512x512')
+    parser.add_argument('--benchmarks', type = str, nargs = '+', help = 'Benchmarks to run: generator, discriminator, train_step, data, conversion.', default = ['generator', 'discriminator', 'train_step', 'data', 'conversion'])
+    parser.add_argument('--output', type = str, help = 'File for the JSON report. If not set, the report is only printed.', default = None)
+
+    argv = parser.parse_args()
+
+    report = {'config': vars(argv), 'results': list()}
+
+    def add_result(name, result, **config):
+        record = {'benchmark': name}
+        record.update(config)
+        record.update(result)
+        report['results'].append(record)
+        print(json.dumps(record))
+
+    for resolution in [parse_resolution(resolution) for resolution in argv.resolutions]:
+        for num_filters in argv.num_filters:
+            config = {'resolution': resolution, 'num_filters': num_filters, 'batch_size': argv.batch_size}
+            if 'generator' in argv.benchmarks:
+                forward, backward = benchmark_network(network = generator_resnet, resolution = resolution, num_filters = num_filters, batch_size = argv.batch_size, num_runs = argv.num_runs)
+                add_result('generator_forward', forward, **config)
+                add_result('generator_backward', backward, **config)
+            if 'discriminator' in argv.benchmarks:
+                forward, backward = benchmark_network(network = discriminator, resolution = resolution, num_filters = num_filters, batch_size = argv.batch_size, num_runs = argv.num_runs)
+                add_result('discriminator_forward', forward, **config)
+                add_result('discriminator_backward', backward, **config)
+            if 'train_step' in argv.benchmarks:
+                add_result('train_step', benchmark_train_step(resolution = resolution, num_filters = num_filters, batch_size = argv.batch_size, num_runs = argv.num_runs), **config)
+                add_result('train_step_fused', benchmark_train_step(resolution = resolution, num_filters = num_filters, batch_size = argv.batch_size, num_runs = argv.num_runs, fused_step = True), **config)
+
+    image_resolution = parse_resolution(argv.image_resolution)
+    if 'data' in argv.benchmarks:
+        fine_size = [image_resolution[0] // 8 * 7, image_resolution[1] // 8 * 7]
+        for name, result in benchmark_data(num_images = argv.num_images, image_resolution = image_resolution, load_size = image_resolution, fine_size = fine_size).items():
+            add_result(name, result, resolution = image_resolution, num_images = argv.num_images)
+    if 'conversion' in argv.benchmarks:
+        add_result('conversion', benchmark_conversion(num_images = argv.num_images, image_resolution = image_resolution), resolution = image_resolution, num_images = argv.num_images)
+
+    if argv.output is not None:
+        with open(argv.output, 'w') as f:
+            json.dump(report, f, indent = 2)
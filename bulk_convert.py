@@ -0,0 +1,208 @@
+import argparse
+import multiprocessing
+import os
+import queue
+import time
+
+# Bulk conversion of directory trees with several worker processes
+# The parent process walks the input tree lazily and puts chunks of files on a bounded work queue
+# Every worker process holds its own model session with a thread budget and converts the chunks with convert.convert_files
+# Completed chunks are appended to a journal, a restarted job skips the files in the journal
+# The output tree mirrors the input tree
+
+image_extensions = ('.jpg', '.jpeg', '.png', '.bmp', '.tif', '.tiff')
+
+def walk_images(img_dir):
+
+    # Yields the image paths relative to img_dir, without listing the whole tree first
+    directories = ['']
+    while len(directories) > 0:
+        directory = directories.pop()
+        subdirectories = list()
+        for entry in sorted(os.scandir(os.path.join(img_dir, directory)), key = lambda entry: entry.name):
+            if entry.is_dir():
+                subdirectories.append(os.path.join(directory, entry.name))
+            elif entry.is_file() and os.path.splitext(entry.name)[1].lower() in image_extensions:
+                yield os.path.join(directory, entry.name)
+        directories.extend(reversed(subdirectories))
+
+def read_journal(journal_filepath):
+
+    if not os.path.exists(journal_filepath):
+        return set()
+    with open(journal_filepath, 'r') as f:
+        # A partially written last line of an interrupted job is ignored, the file is converted again
+        return set(line[:-1] for line in f if line.endswith('\n'))
+
+def worker(rank, config, tasks, results):
+
+    # TensorFlow is imported in the worker so that every process gets its own runtime with the configured thread pools
+    import tensorflow as tf
+    from model import CycleGAN
+    from frozen_model import FrozenCycleGAN
+    from convert import convert_files
+    from utils import load_generator_config
+
+    session_config = tf.ConfigProto(intra_op_parallelism_threads = config['threads_per_worker'], inter_op_parallelism_threads = 1)
+    input_size = [256, 256, 3]
+    if config['frozen_model'] is not None:
+        model = FrozenCycleGAN(model_filepath = config['frozen_model'], session_config = session_config)
+    else:
+        num_filters = config['filter_number']
+        generator_config = None
+        if config['generator_config'] is not None:
+            num_filters, generator_config = load_generator_config(filepath = config['generator_config'])
+        model = CycleGAN(input_size = input_size, num_filters = num_filters, mode = 'test', directions = [config['conversion_direction']],
+                         generator_config = generator_config, session_config = session_config)
+        model.load(filepath = config['model_filepath'])
+
+    while True:
+        chunk = tasks.get()
+        if chunk is None:
+            break
+        filepaths = list()
+        for file in chunk:
+            output_filepath = os.path.join(config['output_dir'], file)
+            if not os.path.exists(os.path.dirname(output_filepath)):
+                os.makedirs(os.path.dirname(output_filepath), exist_ok = True)
+            filepaths.append((os.path.join(config['img_dir'], file), output_filepath))
+        # convert_files returns after all the outputs are written
+        num_converted = convert_files(model = model, filepaths = filepaths, conversion_direction = config['conversion_direction'], input_size = input_size,
+                                      batch_size = config['batch_size'], num_workers = config['io_threads'], tile_size = config['tile_size'], tile_overlap = config['tile_overlap'])
+        results.put((rank, chunk, num_converted))
+
+    results.put((rank, None, 0))
+
+def bulk_conversion(config):
+
+    journal_filepath = config['journal'] if config['journal'] is not None else os.path.join(config['output_dir'], '.bulk_convert_journal')
+    if not os.path.exists(config['output_dir']):
+        os.makedirs(config['output_dir'])
+    completed = read_journal(journal_filepath)
+    if len(completed) > 0:
+        print('Resuming: %d files already converted' % len(completed))
+
+    # TensorFlow is not fork safe
+    context = multiprocessing.get_context('spawn')
+    # At most two chunks per worker are waiting, so the walk stays ahead of the workers without listing the whole tree
+    tasks = context.Queue(maxsize = 2 * config['num_workers'])
+    results = context.Queue()
+    processes = [context.Process(target = worker, args = (rank, config, tasks, results)) for rank in range(config['num_workers'])]
+    # The spawned processes inherit the environment, OpenMP reads it when TensorFlow is first imported
+    environment = os.environ.copy()
+    os.environ['OMP_NUM_THREADS'] = str(config['threads_per_worker'])
+    try:
+        for process in processes:
+            process.start()
+    finally:
+        os.environ.clear()
+        os.environ.update(environment)
+
+    start_time = time.time()
+    last_report_time = start_time
+    num_files = 0
+    num_converted = 0
+    num_submitted = 0
+    # Ranks of the workers that finished all their chunks
+    finished = set()
+
+    journal = open(journal_filepath, 'a')
+
+    def record(block):
+        # Returns False if no result arrived
+        nonlocal num_files, num_converted, last_report_time
+        received = False
+        while True:
+            try:
+                rank, chunk, chunk_converted = results.get(block = block, timeout = 1 if block else None)
+            except queue.Empty:
+                return received
+            received = True
+            if chunk is None:
+                finished.add(rank)
+            else:
+                journal.write(''.join(file + '\n' for file in chunk))
+                journal.flush()
+                num_files += len(chunk)
+                num_converted += chunk_converted
+            if time.time() - last_report_time > config['report_interval']:
+                last_report_time = time.time()
+                print('%d files, %.2f images/second' % (num_files, num_converted / (last_report_time - start_time)))
+            if block:
+                return received
+
+    def chunks():
+        chunk = list()
+        for file in walk_images(config['img_dir']):
+            if file in completed:
+                continue
+            chunk.append(file)
+            if len(chunk) == config['chunk_size']:
+                yield chunk
+                chunk = list()
+        if len(chunk) > 0:
+            yield chunk
+
+    def submit(task):
+        while True:
+            try:
+                tasks.put(task, timeout = 1)
+                return
+            except queue.Full:
+                record(block = False)
+                # Without any worker nobody consumes the queue, a single crashed worker is detected at the end
+                if not any(process.is_alive() for process in processes):
+                    raise Exception('The conversion workers exited unexpectedly, rerun to resume.')
+
+    for chunk in chunks():
+        submit(chunk)
+        num_submitted += len(chunk)
+        record(block = False)
+
+    for _ in processes:
+        submit(None)
+    while len(finished) < len(processes):
+        # A worker that exited without finishing never sends its end marker, the other results are drained first
+        if not record(block = True) and all(rank in finished or not process.is_alive() for rank, process in enumerate(processes)):
+            break
+
+    for process in processes:
+        process.join()
+    journal.close()
+
+    if len(finished) < len(processes):
+        # The chunks of a crashed worker are missing from the journal
+        if num_files < num_submitted:
+            raise Exception('%d conversion workers exited unexpectedly, %d files were not converted, rerun to resume.' % (len(processes) - len(finished), num_submitted - num_files))
+        print('%d conversion workers exited unexpectedly, all files were converted by the others' % (len(processes) - len(finished)))
+
+    time_elapsed = time.time() - start_time
+    print('Converted %d images of %d files in %.1f s with %d workers: %.2f images/second' % (num_converted, num_files, time_elapsed, len(processes),
+        num_converted / time_elapsed if time_elapsed > 0 else 0.0))
+
+if __name__ == '__main__':
+
+    parser = argparse.ArgumentParser(description = 'Convert directory trees of images with several worker processes. Interrupted jobs resume from a journal.')
+
+    parser.add_argument('--model_filepath', type = str, help = 'File path for the pre-trained model.', default = './model/horse_zebra/horse_zebra.ckpt')
+    parser.add_argument('--frozen_model', type = str, help = 'File path for a frozen .pb model exported by freeze_model.py. Used instead of model_filepath if set.', default = None)
+    parser.add_argument('--filter_number', type = int, help = 'The filter number of the pre-trained model.', default = 64)
+    parser.add_argument('--generator_config', type = str, help = 'File path for the generator_config.json of a distilled or pruned model. Overrides the filter number.', default = None)
+    parser.add_argument('--img_dir', type = str, help = 'Root directory of the images for conversion, searched recursively.', default = './data/horse2zebra/testA')
+    parser.add_argument('--conversion_direction', type = str, help = 'Conversion direction for CycleGAN. A2B or B2A.', default = 'A2B')
+    parser.add_argument('--output_dir', type = str, help = 'Root directory for the converted images.', default = './converted_images')
+    parser.add_argument('--journal', type = str, help = 'File path for the journal of converted files. Default is .bulk_convert_journal in output_dir.', default = None)
+    parser.add_argument('--num_workers', type = int, help = 'Number of worker processes.', default = 4)
+    parser.add_argument('--threads_per_worker', type = int, help = 'Number of intra-op threads of each worker. Default is the number of cores divided by the number of workers.', default = None)
+    parser.add_argument('--io_threads', type = int, help = 'Number of threads decoding and writing images in each worker.', default = 2)
+    parser.add_argument('--batch_size', type = int, help = 'Number of images converted in one batch.', default = 8)
+    parser.add_argument('--chunk_size', type = int, help = 'Number of files handed to a worker at once and recorded in the journal together.', default = 64)
+    parser.add_argument('--tile_size', type = int, help = 'Convert images at full resolution in overlapping tiles of this size.', default = None)
+    parser.add_argument('--tile_overlap', type = int, help = 'Overlap in pixels between neighbouring tiles.', default = 32)
+    parser.add_argument('--report_interval', type = float, help = 'Seconds between two throughput reports.', default = 30)
+
+    argv = parser.parse_args()
+    config = vars(argv)
+    config['threads_per_worker'] = argv.threads_per_worker or max(multiprocessing.cpu_count() // argv.num_workers, 1)
+
+    bulk_conversion(config = config)
@@ -0,0 +1,170 @@
+import os
+import re
+import glob
+import time
+import queue
+import threading
+import collections
+import tensorflow as tf
+
+class CheckpointManager(object):
+
+    # Saves the checkpoints of a model in a background thread and applies a retention policy
+    # The variables are copied out of the training session in a single run, the writer thread saves the copy through a shadow graph so that training continues during the disk write
+    # The checkpoint state file is only updated after a checkpoint is completely written, so CycleGAN.load never picks up a partial checkpoint
+    # Retention: the latest checkpoint, the last keep_last checkpoints, every keep_every-th epoch and the keep_best checkpoints with the lowest metric are kept. keep_last = 0 without other rules keeps everything
+    # Pinned checkpoints, e.g. checkpoints waiting for validation, are kept until they are released
+
+    def __init__(self, model, directory, keep_last = 0, keep_every = 0, keep_best = 0, save_interval = 0, callback = None):
+
+        self.directory = directory
+        self.keep_last = keep_last
+        self.keep_every = keep_every
+        self.keep_best = keep_best
+        # Minimum number of seconds between two checkpoints
+        self.save_interval = save_interval
+        # Called from the writer thread with the checkpoint path and epoch once a checkpoint is written
+        self.callback = callback
+
+        if not os.path.exists(directory):
+            os.makedirs(directory)
+
+        self.model = model
+        self.variables = model.sess.graph.get_collection(tf.GraphKeys.GLOBAL_VARIABLES)
+
+        # Shadow graph holding a copy of the variables, saved under the names of the original variables
+        self.graph = tf.Graph()
+        with self.graph.as_default():
+            self.placeholders = [tf.placeholder(variable.dtype.base_dtype, shape = variable.shape) for variable in self.variables]
+            shadow_variables = [tf.Variable(placeholder, trainable = False) for placeholder in self.placeholders]
+            self.initializers = [variable.initializer for variable in shadow_variables]
+            self.saver = tf.train.Saver(var_list = {variable.op.name: shadow_variable for variable, shadow_variable in zip(self.variables, shadow_variables)}, max_to_keep = None)
+        self.sess = tf.Session(graph = self.graph)
+
+        # Checkpoints written by previous runs are kept under the same policy, the epoch is recovered from the <model_name>_<epoch> file name and the metric is unknown
+        # Without keep_last they are never removed, keep_every and keep_best alone could otherwise remove the checkpoint the training resumes from
+        self.checkpoints = list()
+        state = tf.train.get_checkpoint_state(directory)
+        if state is not None:
+            for path in state.all_model_checkpoint_paths:
+                match = re.search(r'_(\d+)$', path)
+                self.checkpoints.append({'path': path, 'epoch': int(match.group(1)) if match is not None else None, 'metric': None, 'adopted': True})
+
+        # Number of pins by checkpoint path, the retention runs in the writer thread and on release
+        self.pinned = collections.Counter()
+        self.lock = threading.Lock()
+
+        self.last_save_time = None
+        # At most one snapshot waits for the writer, save blocks if the writer falls behind
+        self.snapshots = queue.Queue(maxsize = 1)
+        self.error = None
+        self.thread = threading.Thread(target = self.run)
+        self.thread.daemon = True
+        self.thread.start()
+
+    def save(self, filename, epoch, metric = None, force = False):
+
+        # Returns the checkpoint path, or None if the checkpoint is skipped because of the save interval
+        if self.error is not None:
+            raise self.error
+
+        if not force and self.last_save_time is not None and time.time() - self.last_save_time < self.save_interval:
+            return None
+        self.last_save_time = time.time()
+
+        values = self.model.sess.run(self.variables)
+        path = os.path.join(self.directory, filename)
+        # The writer could stop consuming the snapshots after an error
+        while True:
+            try:
+                self.snapshots.put((path, epoch, metric, values), timeout = 1)
+                break
+            except queue.Full:
+                if self.error is not None:
+                    raise self.error
+
+        return path
+
+    def pin(self, path):
+
+        # The checkpoint files of path are not removed until release is called for every pin
+        with self.lock:
+            self.pinned[path] += 1
+
+    def release(self, path):
+
+        with self.lock:
+            self.pinned[path] -= 1
+            if self.pinned[path] <= 0:
+                del self.pinned[path]
+            self.apply_retention()
+
+    def run(self):
+
+        while True:
+            item = self.snapshots.get()
+            if item is None:
+                break
+            path, epoch, metric, values = item
+            try:
+                self.write(path = path, epoch = epoch, metric = metric, values = values)
+            except Exception as e:
+                # Raised in the training thread on the next save
+                self.error = e
+
+    def write(self, path, epoch, metric, values):
+
+        self.sess.run(self.initializers, feed_dict = dict(zip(self.placeholders, values)))
+        # The state is written separately once the checkpoint files are complete
+        self.saver.save(self.sess, path, write_meta_graph = False, write_state = False)
+
+        with self.lock:
+            self.checkpoints = [checkpoint for checkpoint in self.checkpoints if checkpoint['path'] != path]
+            self.checkpoints.append({'path': path, 'epoch': epoch, 'metric': metric})
+            self.apply_retention()
+
+        if self.callback is not None:
+            self.callback(path, epoch)
+
+    def apply_retention(self):
+
+        # Called with the lock held, the latest checkpoint is the last one written
+        if len(self.checkpoints) == 0:
+            return
+        removed = self.retain()
+        tf.train.update_checkpoint_state(self.directory, self.checkpoints[-1]['path'], all_model_checkpoint_paths = [checkpoint['path'] for checkpoint in self.checkpoints])
+
+        for checkpoint in removed:
+            for filepath in glob.glob(checkpoint['path'] + '.*'):
+                os.remove(filepath)
+
+    def retain(self):
+
+        if self.keep_last == 0 and self.keep_every == 0 and self.keep_best == 0:
+            return list()
+
+        kept = set([len(self.checkpoints) - 1])
+        if self.keep_last > 0:
+            kept.update(range(max(len(self.checkpoints) - self.keep_last, 0), len(self.checkpoints)))
+        if self.keep_every > 0:
+            kept.update(i for i, checkpoint in enumerate(self.checkpoints) if checkpoint['epoch'] is not None and checkpoint['epoch'] % self.keep_every == 0)
+        if self.keep_best > 0:
+            ranked = sorted([i for i, checkpoint in enumerate(self.checkpoints) if checkpoint['metric'] is not None], key = lambda i: self.checkpoints[i]['metric'])
+            kept.update(ranked[:self.keep_best])
+        if self.keep_last == 0:
+            kept.update(i for i, checkpoint in enumerate(self.checkpoints) if checkpoint.get('adopted', False))
+        kept.update(i for i, checkpoint in enumerate(self.checkpoints) if checkpoint['path'] in self.pinned)
+
+        removed = [checkpoint for i, checkpoint in enumerate(self.checkpoints) if i not in kept]
+        self.checkpoints = [checkpoint for i, checkpoint in enumerate(self.checkpoints) if i in kept]
+
+        return removed
+
+    def close(self):
+
+        # Wait for the pending checkpoint to be written
+        self.snapshots.put(None)
+        self.thread.join()
+        self.sess.close()
+        if self.error is not None:
+            raise self.error
@@ -0,0 +1,169 @@
+import os
+import glob
+import json
+import time
+import stat
+import shutil
+import hashlib
+import tensorflow as tf
+
+def file_hash(filepath, block_size = 2 ** 20):
+
+    sha256 = hashlib.sha256()
+    with open(filepath, 'rb') as f:
+        for block in iter(lambda: f.read(block_size), b''):
+            sha256.update(block)
+
+    return sha256.hexdigest()
+
+def model_identity(model_filepath):
+
+    # Content hash of a checkpoint, i.e. its index and data files, or of a frozen .pb model
+    # model_filepath could also be a checkpoint directory
+    if os.path.isdir(model_filepath):
+        model_filepath = tf.train.latest_checkpoint(model_filepath)
+
+    if os.path.isfile(model_filepath):
+        filepaths = [model_filepath]
+    else:
+        filepaths = sorted(filepath for filepath in glob.glob(model_filepath + '.*') if not filepath.endswith('.meta'))
+    if len(filepaths) == 0:
+        raise Exception('No model files found for %s.' % model_filepath)
+
+    sha256 = hashlib.sha256()
+    for filepath in filepaths:
+        sha256.update(file_hash(filepath).encode('utf-8'))
+
+    return sha256.hexdigest()
+
+def place_file(source_filepath, target_filepath, link = True):
+
+    # Hard link if possible and link is set, otherwise copy
+    # The target is replaced, not overwritten, so a file linked to the old target is never changed
+    temp_filepath = target_filepath + '.tmp'
+    if os.path.exists(temp_filepath):
+        os.remove(temp_filepath)
+    try:
+        if not link:
+            raise OSError()
+        os.link(source_filepath, temp_filepath)
+    except OSError:
+        shutil.copyfile(source_filepath, temp_filepath)
+    os.replace(temp_filepath, target_filepath)
+
+def write_json(filepath, data):
+
+    # Written to a temporary file first so that an interrupted run never leaves a truncated file behind
+    with open(filepath + '.tmp', 'w') as f:
+        json.dump(data, f)
+    os.replace(filepath + '.tmp', filepath)
+
+class ConversionCache(object):
+
+    # Content-addressed cache of converted images
+    # The key of a converted image is the hash of the input image content, the model identity, the conversion direction and the inference settings
+    # The cached images are kept in cache_dir with a JSON index of their sizes and last use times, and the least recently used images are evicted beyond max_size bytes
+    # Each output directory has a manifest of the keys of its converted images, so images that are already converted in place are skipped without touching the cache
+    # The cached images are read-only copies, outputs are hard links to them and are only ever replaced, see convert.write_image
+    # The cache is not safe for concurrent use by several processes
+
+    manifest_filename = '.conversion_manifest.json'
+
+    def __init__(self, cache_dir, model_identity, settings, max_size = None):
+
+        self.cache_dir = cache_dir
+        self.max_size = max_size
+        # Common part of all the keys
+        self.prefix = json.dumps({'model': model_identity, 'settings': settings}, sort_keys = True)
+
+        if not os.path.exists(os.path.join(cache_dir, 'objects')):
+            os.makedirs(os.path.join(cache_dir, 'objects'))
+        self.index_filepath = os.path.join(cache_dir, 'index.json')
+        self.index = dict()
+        if os.path.exists(self.index_filepath):
+            with open(self.index_filepath, 'r') as f:
+                self.index = json.load(f)
+
+        self.manifests = dict()
+
+    def key(self, input_filepath):
+
+        # The extension is part of the key because it sets the output encoding
+        return hashlib.sha256((self.prefix + file_hash(input_filepath) + os.path.splitext(input_filepath)[1].lower()).encode('utf-8')).hexdigest()
+
+    def object_filepath(self, key):
+
+        return os.path.join(self.cache_dir, 'objects', key[:2], key + self.index[key]['extension'])
+
+    def manifest(self, output_dir):
+
+        if output_dir not in self.manifests:
+            manifest_filepath = os.path.join(output_dir, self.manifest_filename)
+            if os.path.exists(manifest_filepath):
+                with open(manifest_filepath, 'r') as f:
+                    self.manifests[output_dir] = json.load(f)
+            else:
+                self.manifests[output_dir] = dict()
+
+        return self.manifests[output_dir]
+
+    def lookup(self, key, output_filepath):
+
+        # Returns True if output_filepath holds the converted image of key afterwards
+        output_dir, output_file = os.path.split(output_filepath)
+        manifest = self.manifest(output_dir)
+
+        if manifest.get(output_file) == key and os.path.exists(output_filepath):
+            if key in self.index:
+                self.index[key]['last_used'] = time.time()
+            return True
+
+        if key in self.index and os.path.exists(self.object_filepath(key)):
+            place_file(self.object_filepath(key), output_filepath)
+            self.index[key]['last_used'] = time.time()
+            manifest[output_file] = key
+            return True
+
+        return False
+
+    def add(self, key, output_filepath):
+
+        # Store a freshly converted image
+        output_dir, output_file = os.path.split(output_filepath)
+        self.index[key] = {'extension': os.path.splitext(output_file)[1], 'size': os.path.getsize(output_filepath), 'last_used': time.time()}
+        object_filepath = self.object_filepath(key)
+        if not os.path.exists(os.path.dirname(object_filepath)):
+            os.makedirs(os.path.dirname(object_filepath))
+        # A copy, the output could still be written in place by other tools
+        place_file(output_filepath, object_filepath, link = False)
+        os.chmod(object_filepath, stat.S_IRUSR | stat.S_IRGRP | stat.S_IROTH)
+        self.manifest(output_dir)[output_file] = key
+
+    def evict(self):
+
+        # Remove the least recently used images until the cache fits max_size
+        if self.max_size is None:
+            return 0
+
+        total_size = sum(entry['size'] for entry in self.index.values())
+        num_evicted = 0
+        for key in sorted(self.index, key = lambda key: self.index[key]['last_used']):
+            if total_size <= self.max_size:
+                break
+            object_filepath = self.object_filepath(key)
+            if os.path.exists(object_filepath):
+                os.remove(object_filepath)
+            total_size -= self.index[key]['size']
+            del self.index[key]
+            num_evicted += 1
+
+        return num_evicted
+
+    def close(self):
+
+        num_evicted = self.evict()
+        write_json(self.index_filepath, self.index)
+        for output_dir, manifest in self.manifests.items():
+            write_json(os.path.join(output_dir, self.manifest_filename), manifest)
+
+        return num_evicted
@@ -1,34 +1,402 @@
-
 import argparse
 import cv2
 import os
+import time
+import queue
+import threading
+import collections
 import numpy as np
+from concurrent.futures import ThreadPoolExecutor
 
 from model import CycleGAN
-from utils import load_data, sample_train_data, image_scaling, image_scaling_inverse
+from frozen_model import FrozenCycleGAN
+from conversion_cache import ConversionCache, model_identity
+from tracing import Tracer
+from multi_instance import MultiInstanceConverter, load_instance_config
+from utils import image_scaling, image_scaling_inverse, tile_positions, tile_weights, load_generator_config
+
+def read_image(filepath, input_size):
+
+    # If input_size is None, the image is kept at its original resolution for tiled conversion
+
+    img = cv2.imread(filepath)
+    if img is None:
+        return None
+
+    return preprocess_image(img = img, input_size = input_size)
+
+def preprocess_image(img, input_size):
+
+    img_height, img_width, img_channel = img.shape
+    if input_size is not None:
+        img = cv2.resize(img, (input_size[1], input_size[0]))
+    img = image_scaling(imgs = img.astype(np.float32))
+
+    return img, (img_height, img_width)
+
+def write_image(filepath, img_converted, img_shape):
+
+    img_converted = image_scaling_inverse(imgs = img_converted)
+    if img_converted.shape[:2] != tuple(img_shape):
+        img_converted = cv2.resize(img_converted, (img_shape[1], img_shape[0]))
+    # The image replaces an existing file instead of overwriting it, the file could be a hard link to a cached image
+    _, encoded = cv2.imencode(os.path.splitext(filepath)[1], img_converted)
+    with open(filepath + '.tmp', 'wb') as f:
+        f.write(encoded.tobytes())
+    os.replace(filepath + '.tmp', filepath)
+
+def tile_size_for_memory(memory_budget, num_filters, batch_size = 1):
+
+    # Rough estimate of the float32 generator activations kept alive per input pixel
+    # memory_budget is in megabytes and covers one batch of tiles
+    bytes_per_pixel = 4 * num_filters * 16
+    tile_size = int(np.sqrt(memory_budget * 2 ** 20 / (bytes_per_pixel * batch_size)))
+
+    return max(tile_size // 4 * 4, 32)
+
+def convert_tiled(model, img, conversion_direction, tile_size = 512, overlap = 32, batch_size = 4):
+
+    # Convert a full resolution image as overlapping tiles of at most tile_size x tile_size pixels
+    # The tiles are converted in batches and the seams are blended with a feathered window
+
+    tile_size = tile_size // 4 * 4
+    img_height, img_width, img_channel = img.shape
+
+    # The generator needs heights and widths divisible by 4
+    padded_height = -(-img_height // 4) * 4
+    padded_width = -(-img_width // 4) * 4
+    img_padded = np.pad(img, [[0, padded_height - img_height], [0, padded_width - img_width], [0, 0]], mode = 'reflect')
+
+    tile_size_h = min(tile_size, padded_height)
+    tile_size_w = min(tile_size, padded_width)
+    overlap = min(overlap, tile_size_h // 2, tile_size_w // 2)
+    weights = tile_weights(tile_size_h = tile_size_h, tile_size_w = tile_size_w, overlap = overlap)
+
+    tiles = [(h, w) for h in tile_positions(padded_height, tile_size_h, overlap) for w in tile_positions(padded_width, tile_size_w, overlap)]
+
+    img_converted = np.zeros([padded_height, padded_width, img_channel], dtype = np.float32)
+    weights_sum = np.zeros([padded_height, padded_width, 1], dtype = np.float32)
+
+    for i in range(0, len(tiles), batch_size):
+        batch = tiles[i:i + batch_size]
+        tiles_converted = model.test(inputs = np.array([img_padded[h:h + tile_size_h, w:w + tile_size_w] for h, w in batch]), direction = conversion_direction)
+        for (h, w), tile_converted in zip(batch, tiles_converted):
+            img_converted[h:h + tile_size_h, w:w + tile_size_w] += tile_converted * weights
+            weights_sum[h:h + tile_size_h, w:w + tile_size_w] += weights
+
+    img_converted /= weights_sum
+
+    return img_converted[:img_height, :img_width]
+
+def convert_files(model, filepaths, conversion_direction, input_size, batch_size = 8, num_workers = 4, queue_size = 32, tile_size = None, tile_overlap = 32):
+
+    # Three stage pipeline: images are decoded by a worker pool, converted in batches, and written by another worker pool
+    # filepaths is an iterable of (input filepath, output filepath) pairs, it is consumed lazily
+    # The number of decoded images and pending writes is bounded by queue_size
+    # If tile_size is set, images are converted at full resolution one by one, in batches of tiles
+
+    if tile_size is not None:
+        input_size = None
+
+    decode_pool = ThreadPoolExecutor(max_workers = num_workers)
+    write_pool = ThreadPoolExecutor(max_workers = num_workers)
+    decoded = queue.Queue(maxsize = queue_size)
+    # Set if the conversion stops early, the reader stops submitting
+    stopped = threading.Event()
+    # Exception of the reader, raised by the conversion loop
+    reader_errors = list()
+
+    def put(item):
+        while not stopped.is_set():
+            try:
+                decoded.put(item, timeout = 0.1)
+                return
+            except queue.Full:
+                pass
+
+    def submit_decodes():
+        try:
+            for input_filepath, output_filepath in filepaths:
+                if stopped.is_set():
+                    break
+                put((input_filepath, output_filepath, decode_pool.submit(read_image, input_filepath, input_size)))
+        except Exception as e:
+            reader_errors.append(e)
+        finally:
+            put(None)
+
+    reader = threading.Thread(target = submit_decodes)
+    reader.daemon = True
+    reader.start()
+
+    pending_writes = collections.deque()
+    batch = list()
+    num_converted = 0
 
-def conversion(model_filepath, img_dir, conversion_direction, output_dir):
+    try:
+        while True:
+            item = decoded.get()
+            if item is None and len(reader_errors) > 0:
+                raise reader_errors[0]
+            if item is not None:
+                input_filepath, output_filepath, decoding = item
+                result = decoding.result()
+                if result is None:
+                    print('Skipped %s: not a readable image' % input_filepath)
+                else:
+                    img, img_shape = result
+                    batch.append((output_filepath, img, img_shape))
+
+            if tile_size is not None and len(batch) > 0:
+                output_filepath, img, img_shape = batch.pop()
+                img_converted = convert_tiled(model = model, img = img, conversion_direction = conversion_direction, tile_size = tile_size, overlap = tile_overlap, batch_size = batch_size)
+                pending_writes.append(write_pool.submit(write_image, output_filepath, img_converted, img_shape))
+                num_converted += 1
+                while len(pending_writes) > queue_size:
+                    pending_writes.popleft().result()
+            elif len(batch) == batch_size or (item is None and len(batch) > 0):
+                imgs_converted = model.test(inputs = np.array([img for _, img, _ in batch]), direction = conversion_direction)
+                for (output_filepath, _, img_shape), img_converted in zip(batch, imgs_converted):
+                    pending_writes.append(write_pool.submit(write_image, output_filepath, img_converted, img_shape))
+                num_converted += len(batch)
+                batch = list()
+                while len(pending_writes) > queue_size:
+                    pending_writes.popleft().result()
+
+            if item is None:
+                break
+
+        for writing in pending_writes:
+            writing.result()
+    finally:
+        stopped.set()
+        reader.join()
+        decode_pool.shutdown()
+        write_pool.shutdown()
+
+    return num_converted
+
+def convert_video(model, input_filepath, output_filepath, conversion_direction, input_size, batch_size = 8, queue_size = 32, tile_size = None, tile_overlap = 32,
+                  frame_difference = None, codec = 'mp4v'):
+
+    # Frames are decoded by a reader thread, converted in batches, and encoded by a writer thread
+    # The reader and writer queues hold at most queue_size frames each
+    # If frame_difference is set, a frame whose mean absolute difference to the last converted frame is below it, on the 0-255 scale, reuses that converted frame
+    # Returns the number of frames and the number of converted frames
+
+    if tile_size is not None:
+        input_size = None
+
+    capture = cv2.VideoCapture(input_filepath)
+    if not capture.isOpened():
+        raise Exception('Could not open video %s.' % input_filepath)
+    fps = capture.get(cv2.CAP_PROP_FPS)
+    if not fps > 0:
+        fps = 25.0
+    # The frame size is taken from the first frame, some containers report a size of 0
+    success, first_frame = capture.read()
+    if not success:
+        capture.release()
+        raise Exception('Could not read a frame of video %s.' % input_filepath)
+    frame_shape = first_frame.shape[:2]
+
+    video_writer = cv2.VideoWriter(output_filepath, cv2.VideoWriter_fourcc(*codec), fps, (frame_shape[1], frame_shape[0]))
+    if not video_writer.isOpened():
+        capture.release()
+        raise Exception('Could not open %s for writing with codec %s.' % (output_filepath, codec))
+
+    frames = queue.Queue(maxsize = queue_size)
+    converted = queue.Queue(maxsize = queue_size)
+    # Set if the conversion stops early, the reader and writer threads stop
+    stopped = threading.Event()
+    # Exceptions of the reader and writer threads, raised by the conversion loop
+    errors = list()
+
+    def put(items, item):
+        while not stopped.is_set():
+            try:
+                items.put(item, timeout = 0.1)
+                return
+            except queue.Full:
+                pass
+
+    def get(items):
+        while True:
+            try:
+                return items.get(timeout = 0.1)
+            except queue.Empty:
+                if len(errors) > 0:
+                    raise errors[0]
+
+    def read_frames():
+        try:
+            frame = first_frame
+            while frame is not None and not stopped.is_set():
+                put(frames, preprocess_image(img = frame, input_size = input_size))
+                success, frame = capture.read()
+                if not success:
+                    frame = None
+        except Exception as e:
+            errors.append(e)
+        finally:
+            put(frames, None)
+            capture.release()
+
+    def write_frames():
+        try:
+            while not stopped.is_set():
+                try:
+                    img_converted = converted.get(timeout = 0.1)
+                except queue.Empty:
+                    continue
+                if img_converted is None:
+                    break
+                # VideoWriter only takes uint8 frames
+                img_converted = np.clip(image_scaling_inverse(imgs = img_converted), 0, 255).astype(np.uint8)
+                if img_converted.shape[:2] != frame_shape:
+                    img_converted = cv2.resize(img_converted, (frame_shape[1], frame_shape[0]))
+                video_writer.write(img_converted)
+        except Exception as e:
+            errors.append(e)
+            stopped.set()
+
+    reader = threading.Thread(target = read_frames)
+    reader.daemon = True
+    reader.start()
+    writer = threading.Thread(target = write_frames)
+    writer.daemon = True
+    writer.start()
+
+    # Frames waiting for the conversion of the batch, None marks a frame reusing the last converted frame
+    pending = list()
+    num_pending_conversions = 0
+    keyframe = None
+    img_converted = None
+    num_frames = 0
+    num_converted = 0
+
+    try:
+        while True:
+            item = get(frames)
+            if item is None and len(errors) > 0:
+                raise errors[0]
+            if item is not None:
+                img, _ = item
+                num_frames += 1
+                if frame_difference is not None and keyframe is not None and keyframe.shape == img.shape and np.mean(np.abs(img - keyframe)) * 127.5 < frame_difference:
+                    pending.append(None)
+                else:
+                    pending.append(img)
+                    keyframe = img
+                    num_pending_conversions += 1
+
+            if num_pending_conversions == batch_size or len(pending) >= queue_size or (item is None and len(pending) > 0):
+                imgs = [img for img in pending if img is not None]
+                if tile_size is not None:
+                    imgs_converted = [convert_tiled(model = model, img = img, conversion_direction = conversion_direction, tile_size = tile_size, overlap = tile_overlap, batch_size = batch_size) for img in imgs]
+                elif len(imgs) > 0:
+                    imgs_converted = model.test(inputs = np.array(imgs), direction = conversion_direction)
+                else:
+                    imgs_converted = list()
+                imgs_converted = iter(imgs_converted)
+                for img in pending:
+                    # Reused frames follow their keyframe, which is either earlier in this batch or the last frame of the previous batch
+                    if img is not None:
+                        img_converted = next(imgs_converted)
+                    put(converted, img_converted)
+                num_converted += len(imgs)
+                pending = list()
+                num_pending_conversions = 0
+                if len(errors) > 0:
+                    raise errors[0]
+
+            if item is None:
+                break
+
+        put(converted, None)
+        writer.join()
+        if len(errors) > 0:
+            raise errors[0]
+    finally:
+        stopped.set()
+        reader.join()
+        writer.join()
+        video_writer.release()
+
+    return num_frames, num_converted
+
+def conversion(model_filepath, img_dir, conversion_direction, output_dir, batch_size = 8, num_workers = 4, tile_size = None, tile_overlap = 32, memory_budget = None, frozen_model_filepath = None, generator_config_filepath = None,
+               video_filepath = None, video_output_filepath = None, frame_difference = None, video_codec = 'mp4v', cache_dir = None, cache_max_size = None, tracer = None,
+               num_instances = None, threads_per_instance = None, inter_op_threads = 1):
 
     input_size = [256, 256, 3]
     num_filters = 64
+    generator_config = None
 
-    model = CycleGAN(input_size = input_size, num_filters = num_filters, mode = 'test')
+    # Generator architecture of a distilled or pruned model
+    if generator_config_filepath is not None:
+        num_filters, generator_config = load_generator_config(filepath = generator_config_filepath)
 
-    model.load(filepath = model_filepath)
+    if num_instances is not None:
+        # Independent sessions pinned to separate cores, the batches are split across them
+        model_config = {'model_filepath': model_filepath, 'frozen_model_filepath': frozen_model_filepath, 'input_size': input_size, 'num_filters': num_filters,
+                        'generator_config': generator_config, 'directions': [conversion_direction]}
+        model = MultiInstanceConverter(model_config = model_config, num_instances = num_instances, threads_per_instance = threads_per_instance, inter_op_threads = inter_op_threads)
+    elif frozen_model_filepath is not None:
+        model = FrozenCycleGAN(model_filepath = frozen_model_filepath)
+    else:
+        model = CycleGAN(input_size = input_size, num_filters = num_filters, mode = 'test', directions = [conversion_direction], generator_config = generator_config, tracer = tracer)
+        model.load(filepath = model_filepath)
+
+    if tile_size is None and memory_budget is not None:
+        tile_size = tile_size_for_memory(memory_budget = memory_budget, num_filters = num_filters, batch_size = batch_size)
+        print('Tile size for %d MB: %d' % (memory_budget, tile_size))
 
     if not os.path.exists(output_dir):
         os.makedirs(output_dir)
 
-    for file in os.listdir(img_dir):
-        filepath = os.path.join(img_dir, file)
-        img = cv2.imread(filepath)
-        img_height, img_width, img_channel = img.shape
-        img = cv2.resize(img, (input_size[1], input_size[0]))
-        img = image_scaling(imgs = img)
-        img_converted = model.test(inputs = np.array([img]), direction = conversion_direction)[0]
-        img_converted = image_scaling_inverse(imgs = img_converted)
-        img_converted = cv2.resize(img_converted, (img_width, img_height))
-        cv2.imwrite(os.path.join(output_dir, os.path.basename(file)), img_converted)
+    if video_filepath is not None:
+        if video_output_filepath is None:
+            video_output_filepath = os.path.join(output_dir, os.path.basename(video_filepath))
+        start_time = time.time()
+        num_frames, num_converted = convert_video(model = model, input_filepath = video_filepath, output_filepath = video_output_filepath, conversion_direction = conversion_direction,
+                                                  input_size = input_size, batch_size = batch_size, tile_size = tile_size, tile_overlap = tile_overlap,
+                                                  frame_difference = frame_difference, codec = video_codec)
+        time_elapsed = time.time() - start_time
+        print('Converted %d of %d frames, %d reused, %.2f frames/second' % (num_converted, num_frames, num_frames - num_converted, num_frames / time_elapsed))
+        if num_instances is not None:
+            model.close()
+        return
+
+    filepaths = [(os.path.join(img_dir, file), os.path.join(output_dir, os.path.basename(file))) for file in os.listdir(img_dir) if os.path.isfile(os.path.join(img_dir, file))]
+
+    if cache_dir is not None:
+        # Images converted before with the same model and settings are taken from the manifest of output_dir or from the cache
+        settings = {'direction': conversion_direction, 'input_size': input_size if tile_size is None else None, 'tile_size': tile_size, 'tile_overlap': tile_overlap,
+                    'num_filters': num_filters, 'generator_config': generator_config}
+        cache = ConversionCache(cache_dir = cache_dir, model_identity = model_identity(frozen_model_filepath if frozen_model_filepath is not None else model_filepath), settings = settings,
+                                max_size = cache_max_size * 2 ** 20 if cache_max_size is not None else None)
+        with ThreadPoolExecutor(max_workers = num_workers) as executor:
+            keys = list(executor.map(lambda filepath: cache.key(filepath[0]), filepaths))
+        cached = [cache.lookup(key = key, output_filepath = output_filepath) for (_, output_filepath), key in zip(filepaths, keys)]
+        filepaths, keys = [filepath for filepath, hit in zip(filepaths, cached) if not hit], [key for key, hit in zip(keys, cached) if not hit]
+        # Outputs could be hard links to cached images, they must not be overwritten in place
+        for _, output_filepath in filepaths:
+            if os.path.exists(output_filepath):
+                os.remove(output_filepath)
+
+    convert_files(model = model, filepaths = filepaths, conversion_direction = conversion_direction, input_size = input_size, batch_size = batch_size, num_workers = num_workers,
+                  tile_size = tile_size, tile_overlap = tile_overlap)
+
+    if cache_dir is not None:
+        for (_, output_filepath), key in zip(filepaths, keys):
+            if os.path.exists(output_filepath):
+                cache.add(key = key, output_filepath = output_filepath)
+        num_evicted = cache.close()
+        print('Conversion cache: %d cached, %d converted, %d evicted' % (sum(cached), len(filepaths), num_evicted))
+
+    if num_instances is not None:
+        model.close()
 
 
 if __name__ == '__main__':
@@ -44,12 +412,52 @@ if __name__ == '__main__':
     parser.add_argument('--img_dir', type = str, help = 'Directory for the images for conversion.', default = img_dir_default)
     parser.add_argument('--conversion_direction', type = str, help = 'Conversion direction for CycleGAN. A2B or B2A. The first object in the model file name is A, and the second object in the model file name is B.', default = conversion_direction_default)
     parser.add_argument('--output_dir', type = str, help = 'Directory for the converted images.', default = output_dir_default)
+    parser.add_argument('--frozen_model', type = str, help = 'File path for a frozen .pb model exported by freeze_model.py. Used instead of model_filepath if set.', default = None)
+    parser.add_argument('--generator_config', type = str, help = 'File path for the generator_config.json of a distilled model, which sets the filter number and generator architecture.', default = None)
+    parser.add_argument('--batch_size', type = int, help = 'Number of images converted in one batch.', default = 8)
+    parser.add_argument('--num_workers', type = int, help = 'Number of threads decoding and writing images.', default = 4)
+    parser.add_argument('--tile_size', type = int, help = 'Convert images at full resolution in overlapping tiles of this size. Tiles are converted in batches of batch_size.', default = None)
+    parser.add_argument('--tile_overlap', type = int, help = 'Overlap in pixels between neighbouring tiles.', default = 32)
+    parser.add_argument('--video', type = str, help = 'File path for a video to convert instead of the images in img_dir.', default = None)
+    parser.add_argument('--video_output', type = str, help = 'File path for the converted video. Default is the video file name in output_dir.', default = None)
+    parser.add_argument('--video_codec', type = str, help = 'FourCC code of the converted video.', default = 'mp4v')
+    parser.add_argument('--frame_difference', type = float, help = 'Reuse the last converted frame for video frames whose mean absolute pixel difference to it is below this value, on the 0-255 scale.', default = None)
+    parser.add_argument('--cache_dir', type = str, help = 'Directory for the cache of converted images. Images converted before with the same model and settings are not converted again.', default = None)
+    parser.add_argument('--cache_max_size', type = int, help = 'Maximum size of the conversion cache in MB, the least recently used images are evicted.', default = None)
+    parser.add_argument('--trace_start', type = int, help = 'Capture op-level traces of the conversion batches from this batch on. Not available for frozen models.', default = None)
+    parser.add_argument('--trace_steps', type = int, help = 'Number of traced conversion batches.', default = 1)
+    parser.add_argument('--trace_on_signal', help = 'Capture op-level traces of the next trace_steps batches when the process receives SIGUSR1.', action = 'store_true')
+    parser.add_argument('--trace_dir', type = str, help = 'Directory for the Chrome traces and TensorBoard run metadata.', default = './trace')
+    parser.add_argument('--num_instances', type = int, help = 'Convert with this number of independent model sessions, each pinned to its own set of cores.', default = None)
+    parser.add_argument('--threads_per_instance', type = int, help = 'Intra-op threads of each instance. Default is the number of cores of the instance.', default = None)
+    parser.add_argument('--inter_op_threads', type = int, help = 'Inter-op threads of each instance.', default = 1)
+    parser.add_argument('--instance_config', type = str, help = 'JSON file written by multi_instance.py with the tuned number of instances, threads and batch size. Overrides the corresponding arguments.', default = None)
+    parser.add_argument('--memory_budget', type = int, help = 'Memory budget in MB for one batch of tiles. Used to choose the tile size if tile_size is not set.', default = None)
 
     argv = parser.parse_args()
 
+    tracer = None
+    if argv.trace_start is not None or argv.trace_on_signal:
+        tracer = Tracer(log_dir = argv.trace_dir, start_step = argv.trace_start, num_steps = argv.trace_steps, signal_trigger = argv.trace_on_signal)
+
+    if argv.instance_config is not None:
+        instance_config = load_instance_config(filepath = argv.instance_config)
+        argv.num_instances = instance_config['num_instances']
+        argv.threads_per_instance = instance_config['threads_per_instance']
+        argv.inter_op_threads = instance_config['inter_op_threads']
+        argv.batch_size = instance_config['batch_size']
+
     model_filepath = argv.model_filepath
     img_dir = argv.img_dir
     conversion_direction = argv.conversion_direction
     output_dir = argv.output_dir
 
-    conversion(model_filepath = model_filepath, img_dir = img_dir, conversion_direction = conversion_direction, output_dir = output_dir)
\ No newline at end of file
+    conversion(model_filepath = model_filepath, img_dir = img_dir, conversion_direction = conversion_direction, output_dir = output_dir, batch_size = argv.batch_size, num_workers = argv.num_workers,
+               tile_size = argv.tile_size, tile_overlap = argv.tile_overlap, memory_budget = argv.memory_budget,
+               frozen_model_filepath = argv.frozen_model, generator_config_filepath = argv.generator_config,
+               video_filepath = argv.video, video_output_filepath = argv.video_output, frame_difference = argv.frame_difference, video_codec = argv.video_codec,
+               cache_dir = argv.cache_dir, cache_max_size = argv.cache_max_size, tracer = tracer,
+               num_instances = argv.num_instances, threads_per_instance = argv.threads_per_instance, inter_op_threads = argv.inter_op_threads)
+
+    if tracer is not None:
+        tracer.close()
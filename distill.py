@@ -0,0 +1,198 @@
+import argparse
+import os
+import time
+import numpy as np
+import tensorflow as tf
+
+from module import generator_resnet
+from utils import l1_loss, load_data, sample_crops, save_generator_config
+from benchmark import timing
+
+# Knowledge distillation of trained CycleGAN generators into smaller student generators
+# The student is trained to reproduce the outputs of the teacher on the training images, no discriminator is needed
+# The student variables have the same names as the CycleGAN generators, so the student checkpoint is used like any other checkpoint in convert.py and freeze_model.py together with its generator_config.json
+
+generator_scope_names = {'A2B': 'generator_A2B', 'B2A': 'generator_B2A'}
+
+class Distiller(object):
+
+    def __init__(self, teacher_checkpoint, teacher_num_filters = 64, num_filters = 16, generator_config = None, directions = ('A2B',), input_channels = 3, session_config = None,
+                 teacher_generator_config = None, student_checkpoint = None):
+
+        self.directions = directions
+        self.num_filters = num_filters
+        # Keyword arguments of generator_resnet for the student, e.g. {'num_residual_blocks': 4, 'separable': True}
+        self.generator_config = generator_config if generator_config is not None else dict()
+        teacher_generator_config = teacher_generator_config if teacher_generator_config is not None else dict()
+
+        self.inputs = dict()
+        self.teacher_outputs = dict()
+        self.student_outputs = dict()
+        losses = list()
+        for direction in directions:
+            scope_name = generator_scope_names[direction]
+            # Any height and width divisible by 4
+            self.inputs[direction] = tf.placeholder(tf.float32, shape = [None, None, None, input_channels], name = 'input_' + direction)
+            # The teacher is built under a prefixed scope and never trained
+            self.teacher_outputs[direction] = tf.stop_gradient(generator_resnet(inputs = self.inputs[direction], num_filters = teacher_num_filters, reuse = False, scope_name = 'teacher_' + scope_name,
+                                                                          **teacher_generator_config))
+            self.student_outputs[direction] = generator_resnet(inputs = self.inputs[direction], num_filters = num_filters, reuse = False, scope_name = scope_name, **self.generator_config)
+            losses.append(l1_loss(y = self.teacher_outputs[direction], y_hat = self.student_outputs[direction]))
+
+        self.loss = tf.add_n(losses)
+
+        self.teacher_vars = [var for var in tf.global_variables() if var.name.startswith('teacher_')]
+        self.student_vars = [var for var in tf.trainable_variables() if var.name.startswith('generator_')]
+
+        self.learning_rate = tf.placeholder(tf.float32, None, name = 'learning_rate')
+        self.optimizer = tf.train.AdamOptimizer(learning_rate = self.learning_rate, beta1 = 0.5).minimize(self.loss, var_list = self.student_vars)
+
+        # The teacher variables are restored from the names they have in the CycleGAN checkpoint
+        self.teacher_saver = tf.train.Saver(var_list = {var.op.name[len('teacher_'):]: var for var in self.teacher_vars})
+        self.saver = tf.train.Saver(var_list = self.student_vars, max_to_keep = 0)
+
+        self.sess = tf.Session(config = session_config)
+        self.sess.run(tf.global_variables_initializer())
+
+        if os.path.isdir(teacher_checkpoint):
+            teacher_checkpoint = tf.train.latest_checkpoint(teacher_checkpoint)
+        self.teacher_saver.restore(self.sess, teacher_checkpoint)
+
+        # The student could start from a checkpoint with its architecture, e.g. a pruned generator that is fine tuned
+        if student_checkpoint is not None:
+            if os.path.isdir(student_checkpoint):
+                student_checkpoint = tf.train.latest_checkpoint(student_checkpoint)
+            self.saver.restore(self.sess, student_checkpoint)
+
+    def train(self, inputs, learning_rate):
+
+        # inputs maps the conversion directions to batches of scaled images of the source domain
+        feed_dict = {self.inputs[direction]: inputs[direction] for direction in self.directions}
+        feed_dict[self.learning_rate] = learning_rate
+        loss, _ = self.sess.run([self.loss, self.optimizer], feed_dict = feed_dict)
+
+        return loss
+
+    def save(self, directory, filename):
+
+        if not os.path.exists(directory):
+            os.makedirs(directory)
+        self.saver.save(self.sess, os.path.join(directory, filename))
+        save_generator_config(filepath = os.path.join(directory, 'generator_config.json'), num_filters = self.num_filters, generator_config = self.generator_config)
+
+        return os.path.join(directory, filename)
+
+    def compare(self, imgs, direction, num_runs = 10):
+
+        # Latency and output fidelity of the student against the teacher
+        # The differences are measured on the 0-255 pixel scale
+
+        def parameters(variables):
+            return int(sum(np.prod(var.shape.as_list()) for var in variables))
+
+        latencies = dict()
+        generations = dict()
+        for name, output in [('teacher', self.teacher_outputs[direction]), ('student', self.student_outputs[direction])]:
+            # The first run is the warm up
+            generations[name] = self.sess.run(output, feed_dict = {self.inputs[direction]: imgs})
+            latencies[name] = timing(lambda: self.sess.run(output, feed_dict = {self.inputs[direction]: imgs}), num_runs = num_runs, num_warmup = 0)['median_ms'] / 1000
+
+        difference = (generations['student'] - generations['teacher']) * 127.5
+        mean_squared_error = np.mean(np.square(difference))
+        scope_name = generator_scope_names[direction]
+
+        return {
+            'direction': direction,
+            'teacher_parameters': parameters([var for var in self.teacher_vars if var.name.startswith('teacher_' + scope_name + '/')]),
+            'student_parameters': parameters([var for var in self.student_vars if var.name.startswith(scope_name + '/')]),
+            'teacher_ms': latencies['teacher'] * 1000,
+            'student_ms': latencies['student'] * 1000,
+            'speedup': latencies['teacher'] / latencies['student'],
+            'mean_absolute_difference': float(np.mean(np.abs(difference))),
+            'max_absolute_difference': float(np.max(np.abs(difference))),
+            'psnr': float(10 * np.log10(255 ** 2 / mean_squared_error)) if mean_squared_error > 0 else float('inf')}
+
+def distill(teacher_checkpoint, img_dirs, model_dir, model_name, teacher_num_filters, num_filters, generator_config, load_size_w, load_size_h, fine_size_w, fine_size_h,
+            batch_size_maximum, mini_batch_size, epochs, learning_rate, cache_dir, random_seed, num_compare_images, teacher_generator_config = None, student_checkpoint = None):
+
+    # img_dirs maps the conversion directions to the directories of their source images
+
+    np.random.seed(random_seed)
+    tf.set_random_seed(random_seed)
+
+    directions = list(img_dirs.keys())
+    distiller = Distiller(teacher_checkpoint = teacher_checkpoint, teacher_num_filters = teacher_num_filters, num_filters = num_filters, generator_config = generator_config, directions = directions,
+                          teacher_generator_config = teacher_generator_config, student_checkpoint = student_checkpoint)
+
+    datasets = {direction: load_data(img_dir = img_dir, load_size_w = load_size_w, load_size_h = load_size_h, cache_dir = cache_dir) for direction, img_dir in img_dirs.items()}
+    num_samples = min(min(len(dataset) for dataset in datasets.values()), batch_size_maximum)
+
+    for epoch in range(epochs):
+
+        start_time = time.time()
+        samples = {direction: sample_crops(img_dataset = dataset, indices = np.random.permutation(len(dataset))[:num_samples], load_size_w = load_size_w, load_size_h = load_size_h,
+                                           output_size_w = fine_size_w, output_size_h = fine_size_h) for direction, dataset in datasets.items()}
+
+        losses = list()
+        for i in range(num_samples // mini_batch_size):
+            start = i * mini_batch_size
+            end = (i + 1) * mini_batch_size
+            losses.append(distiller.train(inputs = {direction: samples[direction][start:end] for direction in directions}, learning_rate = learning_rate))
+
+        time_elapsed = time.time() - start_time
+        print('Epoch: %d, Distillation Loss : %f, Time Elapsed: %.1f s' % (epoch, np.mean(losses), time_elapsed))
+
+        distiller.save(directory = model_dir, filename = model_name)
+
+    # The comparison samples are drawn separately, so that a run without epochs compares the loaded student as well
+    compare_samples = {direction: sample_crops(img_dataset = dataset, indices = np.random.permutation(len(dataset))[:num_compare_images], load_size_w = load_size_w, load_size_h = load_size_h,
+                                               output_size_w = fine_size_w, output_size_h = fine_size_h) for direction, dataset in datasets.items()}
+    for direction in directions:
+        result = distiller.compare(imgs = compare_samples[direction], direction = direction)
+        print('%s teacher: %d parameters, %.2f ms; student: %d parameters, %.2f ms; speedup %.2fx' % (direction, result['teacher_parameters'], result['teacher_ms'],
+            result['student_parameters'], result['student_ms'], result['speedup']))
+        print('%s student vs teacher: mean absolute difference %.2f, max absolute difference %.2f, PSNR %.2f dB' % (direction, result['mean_absolute_difference'],
+            result['max_absolute_difference'], result['psnr']))
+
+    distiller.sess.close()
+
+if __name__ == '__main__':
+
+    parser = argparse.ArgumentParser(description = 'Distill the generators of a trained CycleGAN model into smaller student generators.')
+
+    parser.add_argument('--teacher_checkpoint', type = str, help = 'Directory or path of the trained CycleGAN checkpoint.', default = './model/horse_zebra')
+    parser.add_argument('--teacher_filter_number', type = int, help = 'The filter number of the trained CycleGAN model.', default = 32)
+    parser.add_argument('--img_A_dir', type = str, help = 'Directory for A images, used to distill the A2B generator.', default = './data/horse2zebra/trainA')
+    parser.add_argument('--img_B_dir', type = str, help = 'Directory for B images, used to distill the B2A generator.', default = './data/horse2zebra/trainB')
+    parser.add_argument('--directions', type = str, nargs = '+', help = 'Conversion directions to distill, A2B and/or B2A.', default = ['A2B'])
+    parser.add_argument('--model_dir', type = str, help = 'Directory for saving the student model and its generator_config.json.', default = './model/horse_zebra_student')
+    parser.add_argument('--model_name', type = str, help = 'File name for saving the student model.', default = 'horse_zebra_student.ckpt')
+    parser.add_argument('--random_seed', type = int, help = 'Random seed for the distillation.', default = 0)
+    parser.add_argument('--batch_size_maximum', type = int, help = 'Maximum number of samples for one epoch.', default = 300)
+    parser.add_argument('--load_size_w', type=int,    help = 'The image load size', default = 286)
+    parser.add_argument('--load_size_h', type=int,    help = 'The image load size', default = 286)
+    parser.add_argument('--fine_size_w', type=int,    help = 'The cropped training image size', default = 256)
+    parser.add_argument('--fine_size_h', type=int,    help = 'The cropped training image size', default = 256)
+    parser.add_argument('--filter_number',          help='The filter number for the first convolutional layer of the student', type=int, default=16)
+    parser.add_argument('--num_residual_blocks',    help='Number of residual blocks of the student', type=int, default=4)
+    parser.add_argument('--separable',              help='Use depthwise separable convolutions in the residual blocks of the student', action='store_true')
+    parser.add_argument('--learning_rate',          help='Learning rate', type=float, default=0.0002)
+    parser.add_argument('--epochs',                 help='Number of distillation epochs', type=int, default=100)
+    parser.add_argument('--mini_batch_size',        help='Number of samples for one training step', type=int, default=4)
+    parser.add_argument('--cache_dir',              help='Directory for the memory-mapped cache of decoded and resized images. If not set, no cache is used', type=str, default=None)
+    parser.add_argument('--num_compare_images',     help='Number of images for the teacher and student comparison', type=int, default=4)
+
+    argv = parser.parse_args()
+
+    img_dirs = dict()
+    if 'A2B' in argv.directions:
+        img_dirs['A2B'] = argv.img_A_dir
+    if 'B2A' in argv.directions:
+        img_dirs['B2A'] = argv.img_B_dir
+
+    distill(teacher_checkpoint = argv.teacher_checkpoint, img_dirs = img_dirs, model_dir = argv.model_dir, model_name = argv.model_name,
+            teacher_num_filters = argv.teacher_filter_number, num_filters = argv.filter_number,
+            generator_config = {'num_residual_blocks': argv.num_residual_blocks, 'separable': argv.separable},
+            load_size_w = argv.load_size_w, load_size_h = argv.load_size_h, fine_size_w = argv.fine_size_w, fine_size_h = argv.fine_size_h,
+            batch_size_maximum = argv.batch_size_maximum, mini_batch_size = argv.mini_batch_size, epochs = argv.epochs, learning_rate = argv.learning_rate,
+            cache_dir = argv.cache_dir, random_seed = argv.random_seed, num_compare_images = argv.num_compare_images)
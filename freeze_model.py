@@ -1,30 +1,108 @@
 import argparse
+import os
+import time
+import numpy as np
 import tensorflow as tf
+from tensorflow.tools.graph_transforms import TransformGraph
+
+from model import CycleGAN
+from frozen_model import FrozenCycleGAN, input_node_names, output_node_names
+from utils import load_generator_config
+
+# Graph transforms applied to the frozen inference graph
+# Training and discriminator nodes are already absent from the test mode graph, strip_unused_nodes removes anything else not needed for the outputs
+transforms = [
+    'strip_unused_nodes',
+    'remove_nodes(op=Identity, op=CheckNumerics)',
+    'fold_constants(ignore_errors=true)',
+    'merge_duplicate_nodes',
+    'strip_unused_nodes',
+    'sort_by_execution_order']
+
+def freeze(checkpoint, output_model_filename, directions = ('A2B', 'B2A'), num_filters = 64, generator_config = None):
+
+    with tf.Graph().as_default():
+        # Inference only graph with the requested generators
+        model = CycleGAN(input_size = [256, 256, 3], num_filters = num_filters, mode = 'test', directions = directions, generator_config = generator_config)
+        model.load(filepath = checkpoint)
+
+        input_names = [input_node_names[direction] for direction in directions]
+        output_names = [output_node_names[direction] for direction in directions]
+
+        # Freeze the graph
+        frozen_graph_def = tf.graph_util.convert_variables_to_constants(model.sess, model.sess.graph_def, output_names)
+        num_nodes_frozen = len(frozen_graph_def.node)
+
+        # Optimize the graph for inference
+        optimized_graph_def = TransformGraph(frozen_graph_def, input_names, output_names, transforms)
+
+        model.sess.close()
+
+    output_dir = os.path.dirname(output_model_filename)
+    if output_dir != '' and not os.path.exists(output_dir):
+        os.makedirs(output_dir)
+
+    # Save the frozen graph
+    with open(output_model_filename, 'wb') as f:
+        f.write(optimized_graph_def.SerializeToString())
+
+    print('Frozen %s to %s: %d nodes, %d nodes after graph transforms' % (', '.join(directions), output_model_filename, num_nodes_frozen, len(optimized_graph_def.node)))
+
+def compare(checkpoint, model_filename, directions = ('A2B', 'B2A'), num_filters = 64, image_size = 256, num_runs = 20, generator_config = None):
+
+    # Compare the load time, latency and outputs of the checkpoint and the frozen model
+
+    imgs = np.random.uniform(-1, 1, size = [1, image_size, image_size, 3]).astype(np.float32)
+
+    start_time = time.time()
+    graph = tf.Graph()
+    with graph.as_default():
+        model_checkpoint = CycleGAN(input_size = [image_size, image_size, 3], num_filters = num_filters, mode = 'test', directions = directions, generator_config = generator_config)
+        model_checkpoint.load(filepath = checkpoint)
+    time_load_checkpoint = time.time() - start_time
+
+    start_time = time.time()
+    model_frozen = FrozenCycleGAN(model_filepath = model_filename)
+    time_load_frozen = time.time() - start_time
+
+    print('Load time: checkpoint %.3f s, frozen %.3f s' % (time_load_checkpoint, time_load_frozen))
+
+    for direction in directions:
+        latencies = dict()
+        for name, model in [('checkpoint', model_checkpoint), ('frozen', model_frozen)]:
+            # Warm up
+            generation = model.test(inputs = imgs, direction = direction)
+            times = list()
+            for _ in range(num_runs):
+                start_time = time.time()
+                model.test(inputs = imgs, direction = direction)
+                times.append(time.time() - start_time)
+            latencies[name] = (np.median(times), generation)
+
+        max_difference = np.max(np.abs(latencies['checkpoint'][1] - latencies['frozen'][1]))
+        print('%s %dx%d latency: checkpoint %.2f ms, frozen %.2f ms, max absolute difference %e' % (direction, image_size, image_size,
+            latencies['checkpoint'][0] * 1000, latencies['frozen'][0] * 1000, max_difference))
 
 if __name__ == '__main__':
-    parser = argparse.ArgumentParser(description = 'Convert images using pre-trained CycleGAN model.')
+    parser = argparse.ArgumentParser(description = 'Freeze a trained CycleGAN model to an optimized TensorFlow inference model in .pb format.')
 
-    parser.add_argument('--meta-filename',              help='File path for your trained model meta file .meta file.', type=str, default = './PLT_X3_to_Microscope_20x/models/PLT_X3_to_Microscope_20x.ckpt_116.meta')
-    parser.add_argument('--check-point-path',           help='Directory to your latest check point', type=str, default='./PLT_X3_to_Microscope_20x/models/')
-    parser.add_argument('--output-model-filename',      help='Input image DIR /image file name', type=str, default = './PLT_X3_to_Microscope_20x/models/plt_x3_to_microscope_20x.pb')
+    parser.add_argument('--check-point-path',           help='Directory to your latest check point, or the path of a check point', type=str, default='./PLT_X3_to_Microscope_20x/models/')
+    parser.add_argument('--output-model-filename',      help='File path for the frozen model', type=str, default = './PLT_X3_to_Microscope_20x/models/plt_x3_to_microscope_20x.pb')
+    parser.add_argument('--directions',                 help='Conversion directions to export, A2B and/or B2A', type=str, nargs='+', default=['A2B'])
+    parser.add_argument('--filter-number',              help='The filter number for the first convolutional layer of the trained model', type=int, default=32)
+    parser.add_argument('--generator-config',           help='File path for the generator_config.json of a distilled model. Overrides the filter number', type=str, default=None)
+    parser.add_argument('--compare',                    help='Compare load time, latency and outputs of the frozen model against the checkpoint', action='store_true')
+    parser.add_argument('--compare-image-size',         help='Image size used for the comparison', type=int, default=256)
 
     args = parser.parse_args()
 
-    output_node_names = ['generator_A2B/d3_conv/Tanh']    # Output nodes
+    num_filters = args.filter_number
+    generator_config = None
+    if args.generator_config is not None:
+        num_filters, generator_config = load_generator_config(filepath = args.generator_config)
 
-    with tf.Session() as sess:
-        # Restore the graph
-        saver = tf.train.import_meta_graph(args.meta_filename)
+    freeze(checkpoint = args.check_point_path, output_model_filename = args.output_model_filename, directions = args.directions, num_filters = num_filters, generator_config = generator_config)
 
-        # Load weights
-        saver.restore(sess, tf.train.latest_checkpoint(args.check_point_path))
-
-        # Freeze the graph
-        frozen_graph_def = tf.graph_util.convert_variables_to_constants(
-            sess,
-            sess.graph_def,
-            output_node_names)
-
-        # Save the frozen graph
-        with open(args.output_model_filename, 'wb') as f:
-            f.write(frozen_graph_def.SerializeToString())
+    if args.compare:
+        compare(checkpoint = args.check_point_path, model_filename = args.output_model_filename, directions = args.directions, num_filters = num_filters, image_size = args.compare_image_size,
+                generator_config = generator_config)
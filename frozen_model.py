@@ -0,0 +1,37 @@
+
+import tensorflow as tf
+
+# Input and output node names of the conversion graphs, shared by CycleGAN and the frozen models
+input_node_names = {'A2B': 'input_A_test', 'B2A': 'input_B_test'}
+output_node_names = {'A2B': 'generation_B_test', 'B2A': 'generation_A_test'}
+
+class FrozenCycleGAN(object):
+
+    # Runs the generators of a frozen .pb model exported by freeze_model.py
+    # It has the same test interface as CycleGAN so that it could be used in convert.py instead of rebuilding the model
+
+    def __init__(self, model_filepath, session_config = None):
+
+        graph_def = tf.GraphDef()
+        with tf.gfile.GFile(model_filepath, 'rb') as f:
+            graph_def.ParseFromString(f.read())
+
+        self.graph = tf.Graph()
+        with self.graph.as_default():
+            tf.import_graph_def(graph_def, name = '')
+
+        node_names = set(node.name for node in graph_def.node)
+        self.directions = [direction for direction in ('A2B', 'B2A') if output_node_names[direction] in node_names]
+        self.inputs = {direction: self.graph.get_tensor_by_name(input_node_names[direction] + ':0') for direction in self.directions}
+        self.outputs = {direction: self.graph.get_tensor_by_name(output_node_names[direction] + ':0') for direction in self.directions}
+
+        self.sess = tf.Session(graph = self.graph, config = session_config)
+
+    def test(self, inputs, direction):
+
+        if direction not in self.directions:
+            raise Exception('Conversion direction %s is not in the frozen model.' % direction)
+
+        generation = self.sess.run(self.outputs[direction], feed_dict = {self.inputs[direction]: inputs})
+
+        return generation
@@ -0,0 +1,101 @@
+import json
+import time
+import resource
+import tracemalloc
+import contextlib
+import collections
+import tensorflow as tf
+
+def peak_rss_mb():
+
+    # ru_maxrss is in kilobytes on Linux
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+class Instrumentation(object):
+
+    # Records the wall time spent in named phases, e.g. data sampling, generator step, checkpointing, the number of processed images, and the process peak memory
+    # The records are accumulated until reset, typically once per epoch
+
+    def __init__(self, enabled = True, trace_allocations = False):
+
+        self.enabled = enabled
+        # Python allocations are traced with tracemalloc, which slows down allocation heavy code
+        self.trace_allocations = trace_allocations
+        if self.enabled and self.trace_allocations:
+            tracemalloc.start()
+        self.reset()
+
+    def reset(self):
+
+        self.phase_times = collections.OrderedDict()
+        self.phase_counts = collections.OrderedDict()
+        self.num_images = 0
+        self.start_time = time.time()
+        # tracemalloc.reset_peak is only available from Python 3.9
+        if self.enabled and self.trace_allocations and hasattr(tracemalloc, 'reset_peak'):
+            tracemalloc.reset_peak()
+
+    @contextlib.contextmanager
+    def phase(self, name):
+
+        if not self.enabled:
+            yield
+            return
+
+        start_time = time.time()
+        try:
+            yield
+        finally:
+            self.phase_times[name] = self.phase_times.get(name, 0.0) + time.time() - start_time
+            self.phase_counts[name] = self.phase_counts.get(name, 0) + 1
+
+    def add_images(self, num_images):
+
+        self.num_images += num_images
+
+    def summary(self):
+
+        time_elapsed = time.time() - self.start_time
+        summary = collections.OrderedDict()
+        summary['time'] = time_elapsed
+        summary['images'] = self.num_images
+        summary['images_per_second'] = self.num_images / time_elapsed if time_elapsed > 0 else 0.0
+        summary['phases'] = collections.OrderedDict((name, {'time': self.phase_times[name], 'count': self.phase_counts[name], 'mean_ms': self.phase_times[name] / self.phase_counts[name] * 1000}) for name in self.phase_times)
+        summary['peak_rss_mb'] = peak_rss_mb()
+        if self.trace_allocations:
+            current, peak = tracemalloc.get_traced_memory()
+            summary['python_allocated_mb'] = current / 2 ** 20
+            summary['python_peak_allocated_mb'] = peak / 2 ** 20
+
+        return summary
+
+    def write_summary(self, writer, step, summary = None):
+
+        # Write the summary as TensorBoard scalars
+        if summary is None:
+            summary = self.summary()
+
+        values = [tf.Summary.Value(tag = 'instrumentation/images_per_second', simple_value = summary['images_per_second']),
+                  tf.Summary.Value(tag = 'instrumentation/peak_rss_mb', simple_value = summary['peak_rss_mb'])]
+        for name, phase in summary['phases'].items():
+            values.append(tf.Summary.Value(tag = 'instrumentation/%s_time' % name, simple_value = phase['time']))
+            values.append(tf.Summary.Value(tag = 'instrumentation/%s_mean_ms' % name, simple_value = phase['mean_ms']))
+        if 'python_peak_allocated_mb' in summary:
+            values.append(tf.Summary.Value(tag = 'instrumentation/python_peak_allocated_mb', simple_value = summary['python_peak_allocated_mb']))
+
+        writer.add_summary(tf.Summary(value = values), step)
+        writer.flush()
+
+    def dump_summary(self, filepath, summary = None, **fields):
+
+        # Append the summary as one JSON line, extra fields such as the epoch are added to the record
+        if summary is None:
+            summary = self.summary()
+
+        record = collections.OrderedDict(fields)
+        record.update(summary)
+        line = json.dumps(record)
+        with open(filepath, 'a') as f:
+            f.write(line + '\n')
+
+        return line
@@ -1,31 +1,63 @@
 
 import os
+import functools
+import itertools
+import numpy as np
 import tensorflow as tf
 from module import discriminator, generator_resnet
 from utils import l1_loss, l2_loss, cross_entropy_loss
+from instrumentation import Instrumentation
 from datetime import datetime
 
 class CycleGAN(object):
 
     # def __init__(self, input_size, num_filters = 64, discriminator = discriminator, generator = generator_resnet, lambda_cycle = 10, mode = 'train', log_dir = './log'):
-    def __init__(self, input_size, num_filters = 64, discriminator = discriminator, generator = generator_resnet, lambda_cycle = 10, mode = 'train', loss_function='l2', log_dir = './log'):
+    def __init__(self, input_size, num_filters = 64, discriminator = discriminator, generator = generator_resnet, lambda_cycle = 10, mode = 'train', loss_function='l2', log_dir = './log', train_inputs = None, fused_step = False, accumulation_steps = 1, directions = ('A2B', 'B2A'), instrumentation = None, session_config = None, generator_config = None, input_dtype = 'float32', random_flip = False, tracer = None):
 
         self.input_size = input_size
+        # Optional (input_A, input_B) tensors from a streaming input pipeline, e.g. utils.load_train_dataset
+        self.train_inputs = train_inputs
+        # Run the generator and discriminator updates in a single session run, without fetching the fake samples back to the host
+        self.fused_step = fused_step
+        # Number of mini batches whose gradients are accumulated for one update
+        self.accumulation_steps = accumulation_steps
+        # Conversion directions available to test, in test mode only these generators are built
+        self.directions = directions
+        # dtype of the fed training samples. uint8 samples, e.g. from sample_train_data with scale = False, are scaled to [-1, 1] in the graph
+        self.input_dtype = tf.as_dtype(input_dtype)
+        # Flip the training samples left/right at random in the graph, instead of in sample_train_data
+        self.random_flip = random_flip
+        # Records the time spent in the session runs of train, disabled unless an Instrumentation is given
+        self.instrumentation = instrumentation if instrumentation is not None else Instrumentation(enabled = False)
+        # Optional tracing.Tracer capturing op-level traces of the session runs of some train and test steps
+        self.tracer = tracer
+        self.train_traced = False
+        # test could be called from several threads
+        self.test_steps = itertools.count()
 
         self.discriminator = discriminator
-        self.generator = generator
+        # Optional keyword arguments of the generator, e.g. {'num_residual_blocks': 4, 'separable': True} for a distilled student generator
+        self.generator_config = generator_config if generator_config is not None else dict()
+        self.generator = functools.partial(generator, **self.generator_config)
         self.lambda_cycle = lambda_cycle
         self.num_filters = num_filters
         self.mode = mode
         self.loss_function = loss_function
 
-        self.build_model()
-        self.optimizer_initializer()
+        if self.mode == 'train':
+            self.build_model()
+            self.optimizer_initializer()
+            # self.saver = tf.train.Saver()
+            self.saver = tf.train.Saver(max_to_keep=0)
+        else:
+            # Inference only: no discriminators, losses or optimizers, and only the generator variables are restored
+            self.build_test_model()
+            self.saver = tf.train.Saver(var_list = self.generator_vars, max_to_keep=0)
 
-        # self.saver = tf.train.Saver()
-        self.saver = tf.train.Saver(max_to_keep=0)
-        self.sess = tf.Session()
+        # session_config could set the thread pools, e.g. tf.ConfigProto(intra_op_parallelism_threads = 4)
+        self.sess = tf.Session(config = session_config)
         self.sess.run(tf.global_variables_initializer())
+        self.sess.run(tf.local_variables_initializer())
 
         if self.mode == 'train':
             self.train_step = 0
@@ -37,14 +69,31 @@ class CycleGAN(object):
     def build_model(self):
 
         # Placeholders for real training samples
-        self.input_A_real = tf.placeholder(tf.float32, shape = [None] + self.input_size, name = 'input_A_real')
-        self.input_B_real = tf.placeholder(tf.float32, shape = [None] + self.input_size, name = 'input_B_real')
+        # With a streaming input pipeline the placeholders default to the pipeline tensors and do not have to be fed
+        if self.train_inputs is None:
+            self.input_A = tf.placeholder(self.input_dtype, shape = [None] + self.input_size, name = 'input_A_real')
+            self.input_B = tf.placeholder(self.input_dtype, shape = [None] + self.input_size, name = 'input_B_real')
+        else:
+            self.input_A = tf.placeholder_with_default(self.train_inputs[0], shape = [None] + self.input_size, name = 'input_A_real')
+            self.input_B = tf.placeholder_with_default(self.train_inputs[1], shape = [None] + self.input_size, name = 'input_B_real')
+        self.input_A_real = self.preprocess(self.input_A)
+        self.input_B_real = self.preprocess(self.input_B)
+        # Real samples of the discriminator
+        if self.train_inputs is not None and not self.fused_step:
+            # With a streaming pipeline and separate generator and discriminator runs, the generator run stores its pipeline batch in local variables
+            # The discriminator run reads them instead of advancing the pipeline, and the batch never leaves the graph
+            self.input_A_real, self.discriminator_input_A_real = self.stored_batch(self.input_A_real, name = 'stored_A_real')
+            self.input_B_real, self.discriminator_input_B_real = self.stored_batch(self.input_B_real, name = 'stored_B_real')
+        else:
+            self.discriminator_input_A_real = self.input_A_real
+            self.discriminator_input_B_real = self.input_B_real
         # Placeholders for fake generated samples
         self.input_A_fake = tf.placeholder(tf.float32, shape = [None] + self.input_size, name = 'input_A_fake')
         self.input_B_fake = tf.placeholder(tf.float32, shape = [None] + self.input_size, name = 'input_B_fake')
         # Placeholder for test samples
-        self.input_A_test = tf.placeholder(tf.float32, shape = [None] + self.input_size, name = 'input_A_test')
-        self.input_B_test = tf.placeholder(tf.float32, shape = [None] + self.input_size, name = 'input_B_test')
+        # The generator is fully convolutional, test samples could have any height and width divisible by 4
+        self.input_A_test = tf.placeholder(tf.float32, shape = [None, None, None, self.input_size[2]], name = 'input_A_test')
+        self.input_B_test = tf.placeholder(tf.float32, shape = [None, None, None, self.input_size[2]], name = 'input_B_test')
 
         self.generation_B = self.generator(inputs = self.input_A_real, num_filters = self.num_filters, reuse = False, scope_name = 'generator_A2B')
         self.cycle_A = self.generator(inputs = self.generation_B, num_filters = self.num_filters, reuse = False, scope_name = 'generator_B2A')
@@ -73,10 +122,16 @@ class CycleGAN(object):
         self.generator_loss = self.generator_loss_A2B + self.generator_loss_B2A + self.lambda_cycle * self.cycle_loss
 
         # Discriminator output
-        self.discrimination_input_A_real = self.discriminator(inputs = self.input_A_real, num_filters = self.num_filters, reuse = True, scope_name = 'discriminator_A')
-        self.discrimination_input_B_real = self.discriminator(inputs = self.input_B_real, num_filters = self.num_filters, reuse = True, scope_name = 'discriminator_B')
-        self.discrimination_input_A_fake = self.discriminator(inputs = self.input_A_fake, num_filters = self.num_filters, reuse = True, scope_name = 'discriminator_A')
-        self.discrimination_input_B_fake = self.discriminator(inputs = self.input_B_fake, num_filters = self.num_filters, reuse = True, scope_name = 'discriminator_B')
+        self.discrimination_input_A_real = self.discriminator(inputs = self.discriminator_input_A_real, num_filters = self.num_filters, reuse = True, scope_name = 'discriminator_A')
+        self.discrimination_input_B_real = self.discriminator(inputs = self.discriminator_input_B_real, num_filters = self.num_filters, reuse = True, scope_name = 'discriminator_B')
+        if self.fused_step:
+            # The fake samples stay in the graph and the discriminator outputs of the generator loss are reused
+            # The discriminator gradients are only computed for the discriminator variables, so nothing flows back into the generators
+            self.discrimination_input_A_fake = self.discrimination_A_fake
+            self.discrimination_input_B_fake = self.discrimination_B_fake
+        else:
+            self.discrimination_input_A_fake = self.discriminator(inputs = self.input_A_fake, num_filters = self.num_filters, reuse = True, scope_name = 'discriminator_A')
+            self.discrimination_input_B_fake = self.discriminator(inputs = self.input_B_fake, num_filters = self.num_filters, reuse = True, scope_name = 'discriminator_B')
 
         # Discriminator wants to classify real and fake correctly
         # Discriminator must be trained such that recommendation for images from category A must be as close to 1, and vice versa for discriminator B. 
@@ -106,46 +161,204 @@ class CycleGAN(object):
         #for var in t_vars: print(var.name)
 
         # Reserved for test
-        self.generation_B_test = self.generator(inputs = self.input_A_test, num_filters = self.num_filters, reuse = True, scope_name = 'generator_A2B')
-        self.generation_A_test = self.generator(inputs = self.input_B_test, num_filters = self.num_filters, reuse = True, scope_name = 'generator_B2A')
+        self.generation_B_test = tf.identity(self.generator(inputs = self.input_A_test, num_filters = self.num_filters, reuse = True, scope_name = 'generator_A2B'), name = 'generation_B_test')
+        self.generation_A_test = tf.identity(self.generator(inputs = self.input_B_test, num_filters = self.num_filters, reuse = True, scope_name = 'generator_B2A'), name = 'generation_A_test')
+
+
+    def stored_batch(self, inputs, name):
+
+        # Returns inputs after they are assigned to a local variable, and the value of the variable
+        # The variable is not part of the checkpoints
+        stored = tf.Variable(tf.zeros([0] + self.input_size, dtype = inputs.dtype), trainable = False, validate_shape = False, collections = [tf.GraphKeys.LOCAL_VARIABLES], name = name)
+        assigned = tf.assign(stored, inputs, validate_shape = False)
+        value = stored.read_value()
+        assigned.set_shape([None] + self.input_size)
+        value.set_shape([None] + self.input_size)
+
+        return assigned, value
+
+    def preprocess(self, inputs):
+
+        # Scaling and flips of the real training samples in float32
+        if inputs.dtype == tf.uint8:
+            inputs = tf.cast(inputs, tf.float32) / 127.5 - 1
+        if self.random_flip:
+            flips = tf.random_uniform([tf.shape(inputs)[0]]) < 0.5
+            inputs = tf.where(flips, tf.reverse(inputs, axis = [2]), inputs)
+
+        return inputs
+
+    def build_test_model(self):
+
+        if 'A2B' in self.directions:
+            self.input_A_test = tf.placeholder(tf.float32, shape = [None, None, None, self.input_size[2]], name = 'input_A_test')
+            self.generation_B_test = tf.identity(self.generator(inputs = self.input_A_test, num_filters = self.num_filters, reuse = False, scope_name = 'generator_A2B'), name = 'generation_B_test')
+
+        if 'B2A' in self.directions:
+            self.input_B_test = tf.placeholder(tf.float32, shape = [None, None, None, self.input_size[2]], name = 'input_B_test')
+            self.generation_A_test = tf.identity(self.generator(inputs = self.input_B_test, num_filters = self.num_filters, reuse = False, scope_name = 'generator_B2A'), name = 'generation_A_test')
+
+        self.generator_vars = [var for var in tf.trainable_variables() if 'generator' in var.name]
 
 
     def optimizer_initializer(self):
 
         self.learning_rate = tf.placeholder(tf.float32, None, name = 'learning_rate')
-        self.discriminator_optimizer = tf.train.AdamOptimizer(learning_rate = self.learning_rate, beta1 = 0.5).minimize(self.discriminator_loss, var_list = self.discriminator_vars)
-        self.generator_optimizer = tf.train.AdamOptimizer(learning_rate = self.learning_rate, beta1 = 0.5).minimize(self.generator_loss, var_list = self.generator_vars) 
+        discriminator_adam = tf.train.AdamOptimizer(learning_rate = self.learning_rate, beta1 = 0.5)
+        generator_adam = tf.train.AdamOptimizer(learning_rate = self.learning_rate, beta1 = 0.5)
+        discriminator_gradients = discriminator_adam.compute_gradients(self.discriminator_loss, var_list = self.discriminator_vars)
+        generator_gradients = generator_adam.compute_gradients(self.generator_loss, var_list = self.generator_vars)
+
+        if self.accumulation_steps > 1:
+            # The gradients of accumulation_steps mini batches are averaged before a single update
+            # The accumulation ops only write to the accumulators, so generator and discriminator accumulations could run in the same session run
+            self.discriminator_accumulate, self.discriminator_optimizer = self.gradient_accumulator(optimizer = discriminator_adam, gradients = discriminator_gradients)
+            self.generator_accumulate, self.generator_optimizer = self.gradient_accumulator(optimizer = generator_adam, gradients = generator_gradients)
+            self.fused_accumulate = tf.group(self.discriminator_accumulate, self.generator_accumulate)
+            self.accumulated_optimizer = tf.group(self.discriminator_optimizer, self.generator_optimizer)
+        elif self.fused_step:
+            # The generator loss reads the discriminator variables and vice versa
+            # All the gradients have to be computed before any variable gets updated
+            with tf.control_dependencies([gradient for gradient, _ in discriminator_gradients + generator_gradients]):
+                self.discriminator_optimizer = discriminator_adam.apply_gradients(discriminator_gradients)
+                self.generator_optimizer = generator_adam.apply_gradients(generator_gradients)
+            self.fused_optimizer = tf.group(self.discriminator_optimizer, self.generator_optimizer)
+        else:
+            self.discriminator_optimizer = discriminator_adam.apply_gradients(discriminator_gradients)
+            self.generator_optimizer = generator_adam.apply_gradients(generator_gradients)
 
-    def train(self, input_A, input_B, learning_rate):
+    def gradient_accumulator(self, optimizer, gradients):
 
-        generation_A, generation_B, generator_loss, _, generator_summaries = self.sess.run(
-            [self.generation_A, self.generation_B, self.generator_loss, self.generator_optimizer, self.generator_summaries], \
-            feed_dict = {self.input_A_real: input_A, self.input_B_real: input_B, self.learning_rate: learning_rate})
+        # Accumulators are local variables so that they are not part of the checkpoints
+        accumulators = [tf.Variable(tf.zeros(variable.shape, dtype = variable.dtype.base_dtype), trainable = False, collections = [tf.GraphKeys.LOCAL_VARIABLES]) for _, variable in gradients]
 
-        self.writer.add_summary(generator_summaries, self.train_step)
+        accumulate = tf.group(*[accumulator.assign_add(gradient / self.accumulation_steps) for accumulator, (gradient, _) in zip(accumulators, gradients)])
 
-        discriminator_loss, _, discriminator_summaries = self.sess.run([self.discriminator_loss, self.discriminator_optimizer, self.discriminator_summaries], \
-            feed_dict = {self.input_A_real: input_A, self.input_B_real: input_B, self.learning_rate: learning_rate, self.input_A_fake: generation_A, self.input_B_fake: generation_B})
+        update = optimizer.apply_gradients([(accumulator, variable) for accumulator, (_, variable) in zip(accumulators, gradients)])
+        with tf.control_dependencies([update]):
+            update_and_reset = tf.group(*[accumulator.assign(tf.zeros_like(accumulator)) for accumulator in accumulators])
 
-        self.writer.add_summary(discriminator_summaries, self.train_step)
+        return accumulate, update_and_reset
+
+    def train(self, input_A, input_B, learning_rate):
+
+        # input_A and input_B could be None if the model reads from a streaming input pipeline
+        # In that case the discriminator step of the two-run update reads the pipeline batch stored by the generator step, so both steps see the same real samples
+
+        self.train_traced = self.tracer is not None and self.tracer.begin_step(self.train_step)
+
+        if self.accumulation_steps == 1:
+            if self.fused_step:
+                generator_loss, discriminator_loss, generator_summaries, discriminator_summaries = self.train_minibatch(input_A = input_A, input_B = input_B, learning_rate = learning_rate,
+                    generator_update = None, discriminator_update = None, fused_update = self.fused_optimizer)
+            else:
+                generator_loss, discriminator_loss, generator_summaries, discriminator_summaries = self.train_minibatch(input_A = input_A, input_B = input_B, learning_rate = learning_rate,
+                    generator_update = self.generator_optimizer, discriminator_update = self.discriminator_optimizer, fused_update = None)
+        else:
+            # The samples are split into accumulation_steps mini batches
+            # In streaming mode every mini batch is pulled from the pipeline
+            inputs_A = np.array_split(input_A, self.accumulation_steps) if input_A is not None else [None] * self.accumulation_steps
+            inputs_B = np.array_split(input_B, self.accumulation_steps) if input_B is not None else [None] * self.accumulation_steps
+
+            generator_losses = list()
+            discriminator_losses = list()
+            for minibatch_A, minibatch_B in zip(inputs_A, inputs_B):
+                if self.fused_step:
+                    generator_loss, discriminator_loss, generator_summaries, discriminator_summaries = self.train_minibatch(input_A = minibatch_A, input_B = minibatch_B, learning_rate = learning_rate,
+                        generator_update = None, discriminator_update = None, fused_update = self.fused_accumulate)
+                else:
+                    generator_loss, discriminator_loss, generator_summaries, discriminator_summaries = self.train_minibatch(input_A = minibatch_A, input_B = minibatch_B, learning_rate = learning_rate,
+                        generator_update = self.generator_accumulate, discriminator_update = self.discriminator_accumulate, fused_update = None)
+                generator_losses.append(generator_loss)
+                discriminator_losses.append(discriminator_loss)
+
+            with self.instrumentation.phase('accumulated_update'):
+                self.run(self.accumulated_optimizer, feed_dict = {self.learning_rate: learning_rate}, name = 'accumulated_update', step = self.train_step, traced = self.train_traced)
+
+            generator_loss = np.mean(generator_losses)
+            discriminator_loss = np.mean(discriminator_losses)
+
+        # Summaries of the last mini batch
+        with self.instrumentation.phase('summary_writing'):
+            self.writer.add_summary(generator_summaries, self.train_step)
+            self.writer.add_summary(discriminator_summaries, self.train_step)
 
         self.train_step += 1
 
         return generator_loss, discriminator_loss
 
+    def train_minibatch(self, input_A, input_B, learning_rate, generator_update, discriminator_update, fused_update):
+
+        feed_dict = {self.learning_rate: learning_rate}
+        if input_A is not None:
+            feed_dict[self.input_A] = input_A
+        if input_B is not None:
+            feed_dict[self.input_B] = input_B
+
+        if fused_update is not None:
+            with self.instrumentation.phase('fused_step'):
+                generator_loss, discriminator_loss, _, generator_summaries, discriminator_summaries = self.run(
+                    [self.generator_loss, self.discriminator_loss, fused_update, self.generator_summaries, self.discriminator_summaries], \
+                    feed_dict = feed_dict, name = 'fused_step', step = self.train_step, traced = self.train_traced)
+
+            return generator_loss, discriminator_loss, generator_summaries, discriminator_summaries
+
+        with self.instrumentation.phase('generator_step'):
+            generation_A, generation_B, generator_loss, _, generator_summaries = self.run(
+                [self.generation_A, self.generation_B, self.generator_loss, generator_update, self.generator_summaries], \
+                feed_dict = feed_dict, name = 'generator_step', step = self.train_step, traced = self.train_traced)
+
+        feed_dict.update({self.input_A_fake: generation_A, self.input_B_fake: generation_B})
+        with self.instrumentation.phase('discriminator_step'):
+            discriminator_loss, _, discriminator_summaries = self.run([self.discriminator_loss, discriminator_update, self.discriminator_summaries], \
+                feed_dict = feed_dict, name = 'discriminator_step', step = self.train_step, traced = self.train_traced)
+
+        return generator_loss, discriminator_loss, generator_summaries, discriminator_summaries
+
 
     def test(self, inputs, direction):
 
+        if direction in ('A2B', 'B2A') and direction not in self.directions:
+            raise Exception('Conversion direction %s is not built in this model.' % direction)
+
+        step = next(self.test_steps)
+        traced = self.tracer is not None and self.tracer.begin_step(step)
+
         if direction == 'A2B':
-            generation = self.sess.run(self.generation_B_test, feed_dict = {self.input_A_test: inputs})
+            generation = self.run(self.generation_B_test, feed_dict = {self.input_A_test: inputs}, name = 'test_A2B', step = step, traced = traced)
         elif direction == 'B2A':
-            generation = self.sess.run(self.generation_A_test, feed_dict = {self.input_B_test: inputs})
+            generation = self.run(self.generation_A_test, feed_dict = {self.input_B_test: inputs}, name = 'test_B2A', step = step, traced = traced)
         else:
             raise Exception('Conversion direction must be specified.')
 
         return generation
 
 
+    def run(self, fetches, feed_dict, name, step, traced = False):
+
+        # Session run, with full tracing if the step is traced
+        if traced:
+            return self.tracer.run(sess = self.sess, fetches = fetches, feed_dict = feed_dict, name = name, step = step)
+
+        return self.sess.run(fetches, feed_dict = feed_dict)
+
+    def get_weights(self):
+
+        # Values of the trainable variables, used to synchronize models across processes
+        return self.sess.run(self.weight_variables())
+
+    def set_weights(self, weights):
+
+        for variable, value in zip(self.weight_variables(), weights):
+            variable.load(value, self.sess)
+
+    def weight_variables(self):
+
+        if self.mode == 'train':
+            return self.generator_vars + self.discriminator_vars
+        else:
+            return self.generator_vars
+
     def save(self, directory, filename):
 
         if not os.path.exists(directory):
@@ -155,7 +368,11 @@ class CycleGAN(object):
         return os.path.join(directory, filename)
 
     def load(self, filepath):
-        checkpoint = tf.train.latest_checkpoint(filepath)
+        # filepath could either be a checkpoint directory or the path of a checkpoint
+        if os.path.isdir(filepath):
+            checkpoint = tf.train.latest_checkpoint(filepath)
+        else:
+            checkpoint = filepath
         #self.saver.restore(self.sess, filepath)
         self.saver.restore(self.sess, checkpoint)
 
@@ -60,23 +60,55 @@ def instance_norm_layer(
     return instance_norm_layer
 
 
+def separable_conv2d_layer(
+    inputs,
+    filters,
+    kernel_size,
+    strides,
+    padding = 'same',
+    activation = None,
+    kernel_initializer = tf.truncated_normal_initializer(stddev = 0.02),
+    name = None):
+
+    # Depthwise convolution followed by a 1x1 pointwise convolution
+    separable_conv_layer = tf.layers.separable_conv2d(
+        inputs = inputs,
+        filters = filters,
+        kernel_size = kernel_size,
+        strides = strides,
+        padding = padding,
+        activation = activation,
+        depthwise_initializer = kernel_initializer,
+        pointwise_initializer = kernel_initializer,
+        name = name)
+
+    return separable_conv_layer
+
 def residual_block(
     inputs, 
     filters, 
     kernel_size = [3, 3], 
     strides = [1, 1],
-    name_prefix = 'residule_block_'):
+    name_prefix = 'residule_block_',
+    separable = False,
+    hidden_filters = None):
 
     p1 = (kernel_size[0] - 1) // 2
     p2 = (kernel_size[1] - 1) // 2 
 
     paddings = [[0, 0], [p1, p1], [p2, p2], [0, 0]]
 
+    # Depthwise separable convolutions need about 1/filters + 1/9 of the multiplications of a 3x3 convolution
+    conv = separable_conv2d_layer if separable else conv2d_layer
+    # The output width must match the input for the skip connection, the width between the two convolutions could be smaller in pruned generators
+    if hidden_filters is None:
+        hidden_filters = filters
+
     h0_pad = tf.pad(tensor = inputs, paddings = paddings, mode = 'REFLECT', name = 'pad0')
-    h1 = conv2d_layer(inputs = h0_pad, filters = filters, kernel_size = kernel_size, strides = strides, padding = 'valid', activation = None, name = name_prefix + 'conv1')
+    h1 = conv(inputs = h0_pad, filters = hidden_filters, kernel_size = kernel_size, strides = strides, padding = 'valid', activation = None, name = name_prefix + 'conv1')
     h1_norm = instance_norm_layer(inputs = h1, activation_fn = tf.nn.relu, name = name_prefix + 'norm1')
     h1_pad = tf.pad(tensor = h1_norm, paddings = paddings, mode = 'REFLECT', name = 'pad1')
-    h2 = conv2d_layer(inputs = h1_pad, filters = filters, kernel_size = kernel_size, strides = strides, padding = 'valid', activation = None, name = name_prefix + 'conv2')
+    h2 = conv(inputs = h1_pad, filters = filters, kernel_size = kernel_size, strides = strides, padding = 'valid', activation = None, name = name_prefix + 'conv2')
     h2_norm = instance_norm_layer(inputs = h2, activation_fn = None, name = name_prefix + 'norm2')
 
     return inputs + h2_norm
@@ -111,7 +143,7 @@ def discriminator(inputs, num_filters = 64, reuse = False, scope_name = 'discrim
         return h4
 
 
-def generator_resnet(inputs, num_filters = 64, output_channels = 3, reuse = False, scope_name = 'generator_resnet'):
+def generator_resnet(inputs, num_filters = 64, output_channels = 3, reuse = False, scope_name = 'generator_resnet', num_residual_blocks = 9, separable = False, layer_filters = None):
 
     with tf.variable_scope(scope_name) as scope:
 
@@ -123,6 +155,14 @@ def generator_resnet(inputs, num_filters = 64, output_channels = 3, reuse = Fals
 
         #output_channels = inputs.shape[-1]
 
+        # Optional per-layer filter numbers of pruned generators, by layer name, e.g. {'c1_conv': 24, 'residual1_conv1': 80}
+        # c3_conv sets the width of all the residual blocks outputs because of the skip connections
+        # Layers not in layer_filters have the default width derived from num_filters
+        def filters(name, default):
+            if layer_filters is None:
+                return default
+            return layer_filters.get(name, default)
+
         # Encoder: 3 convolution layers. 
         # The size will be down to input_width/4, input_height/4
         # The output feature number will be the num_filters*4
@@ -131,12 +171,12 @@ def generator_resnet(inputs, num_filters = 64, output_channels = 3, reuse = Fals
         # https://www.tensorflow.org/api_docs/python/tf/pad
         c0 = tf.pad(tensor = inputs, paddings = [[0, 0], [3, 3], [3, 3], [0, 0]], mode = 'REFLECT', name = 'c0_pad')
 
-        c1 = conv2d_layer(inputs = c0, filters = num_filters, kernel_size = [7, 7], strides = [1, 1], padding = 'valid', activation = None, name = 'c1_conv')
+        c1 = conv2d_layer(inputs = c0, filters = filters('c1_conv', num_filters), kernel_size = [7, 7], strides = [1, 1], padding = 'valid', activation = None, name = 'c1_conv')
         c1_norm = instance_norm_layer(inputs = c1, activation_fn = tf.nn.relu, name = 'c1_norm')
 
-        c2 = conv2d_layer(inputs = c1_norm, filters = num_filters * 2, kernel_size = [3, 3], strides = [2, 2], activation = None, name = 'c2_conv')
+        c2 = conv2d_layer(inputs = c1_norm, filters = filters('c2_conv', num_filters * 2), kernel_size = [3, 3], strides = [2, 2], activation = None, name = 'c2_conv')
         c2_norm = instance_norm_layer(inputs = c2, activation_fn = tf.nn.relu, name = 'c2_norm')
-        c3 = conv2d_layer(inputs = c2_norm, filters = num_filters * 4, kernel_size = [3, 3], strides = [2, 2], activation = None, name = 'c3_conv')
+        c3 = conv2d_layer(inputs = c2_norm, filters = filters('c3_conv', num_filters * 4), kernel_size = [3, 3], strides = [2, 2], activation = None, name = 'c3_conv')
         c3_norm = instance_norm_layer(inputs = c3, activation_fn = tf.nn.relu, name = 'c3_norm')
 
         """
@@ -144,17 +184,14 @@ def generator_resnet(inputs, num_filters = 64, output_channels = 3, reuse = Fals
         c4_norm = instance_norm_layer(inputs = c4, activation_fn = tf.nn.relu, name = 'c4_norm')
         """
         
-        # Transformation: 9 resnet blocks
+        # Transformation: num_residual_blocks resnet blocks, 9 by default
         # Each resnet block includes two convolution layers and one skip connection
-        r1 = residual_block(inputs = c3_norm, filters = num_filters * 4, name_prefix = 'residual1_')
-        r2 = residual_block(inputs = r1, filters = num_filters * 4, name_prefix = 'residual2_')
-        r3 = residual_block(inputs = r2, filters = num_filters * 4, name_prefix = 'residual3_')
-        r4 = residual_block(inputs = r3, filters = num_filters * 4, name_prefix = 'residual4_')
-        r5 = residual_block(inputs = r4, filters = num_filters * 4, name_prefix = 'residual5_')
-        r6 = residual_block(inputs = r5, filters = num_filters * 4, name_prefix = 'residual6_')
-        r7 = residual_block(inputs = r6, filters = num_filters * 4, name_prefix = 'residual7_')
-        r8 = residual_block(inputs = r7, filters = num_filters * 4, name_prefix = 'residual8_')
-        r9 = residual_block(inputs = r8, filters = num_filters * 4, name_prefix = 'residual9_')
+        # Smaller student generators for distillation use fewer blocks and optionally depthwise separable convolutions
+        r = c3_norm
+        for i in range(num_residual_blocks):
+            r = residual_block(inputs = r, filters = filters('c3_conv', num_filters * 4), name_prefix = 'residual%d_' % (i + 1), separable = separable,
+                               hidden_filters = filters('residual%d_conv1' % (i + 1), num_filters * 4))
+        r9 = r
 
         """
         r1 = residual_block(inputs = c4_norm, filters = num_filters * 8, name_prefix = 'residual1_')
@@ -169,9 +206,9 @@ def generator_resnet(inputs, num_filters = 64, output_channels = 3, reuse = Fals
         """
         
         # Decoder: exact opposite of encoder.
-        d1 = conv2d_transpose_layer(inputs = r9, filters = num_filters * 2, kernel_size = [3, 3], strides = [2, 2], name = 'd1_deconv')
+        d1 = conv2d_transpose_layer(inputs = r9, filters = filters('d1_deconv', num_filters * 2), kernel_size = [3, 3], strides = [2, 2], name = 'd1_deconv')
         d1_norm = instance_norm_layer(inputs = d1, activation_fn = tf.nn.relu, name = 'd1_norm')
-        d2 = conv2d_transpose_layer(inputs = d1_norm, filters = num_filters, kernel_size = [3, 3], strides = [2, 2], name = 'd2_deconv')
+        d2 = conv2d_transpose_layer(inputs = d1_norm, filters = filters('d2_deconv', num_filters), kernel_size = [3, 3], strides = [2, 2], name = 'd2_deconv')
         d2_norm = instance_norm_layer(inputs = d2, activation_fn = tf.nn.relu, name = 'd2_norm')
         d2_pad = tf.pad(tensor = d2_norm, paddings = [[0, 0], [3, 3], [3, 3], [0, 0]], mode = 'REFLECT', name = 'd2_pad')
         d3 = conv2d_layer(inputs = d2_pad, filters = output_channels, kernel_size = [7, 7], strides = [1, 1], padding = 'valid', activation = tf.nn.tanh, name = 'd3_conv')
@@ -0,0 +1,274 @@
+import argparse
+import glob
+import json
+import multiprocessing
+import os
+import queue
+import threading
+import numpy as np
+from concurrent.futures import Future
+
+# Multi-instance CPU inference
+# Several independent model sessions run in worker processes, each pinned to its own set of cores with explicit intra-op and inter-op thread counts
+# Conversion batches are split across the instances through a shared request queue, so idle instances pick up work first
+# MultiInstanceConverter has the same test interface as CycleGAN, so convert.py and server.py use it instead of a single session
+
+def parse_cpu_list(cpu_list):
+
+    # e.g. "0-3,8-11"
+    cpus = list()
+    for part in cpu_list.strip().split(','):
+        if '-' in part:
+            start, end = part.split('-')
+            cpus.extend(range(int(start), int(end) + 1))
+        elif part != '':
+            cpus.append(int(part))
+
+    return cpus
+
+def core_sets(num_instances):
+
+    # Split the available cores into num_instances contiguous sets, ordered by NUMA node so that a set does not cross nodes if the instances divide the nodes evenly
+    # Returns None for every instance if there are fewer cores than instances
+    available = set(os.sched_getaffinity(0))
+    ordered = list()
+    for node_filepath in sorted(glob.glob('/sys/devices/system/node/node[0-9]*/cpulist'), key = lambda filepath: int(filepath.split('/')[-2][4:])):
+        with open(node_filepath, 'r') as f:
+            ordered.extend(cpu for cpu in parse_cpu_list(f.read()) if cpu in available and cpu not in ordered)
+    ordered.extend(sorted(available - set(ordered)))
+
+    size = len(ordered) // num_instances
+    if size == 0:
+        return [None] * num_instances
+
+    return [ordered[i * size:(i + 1) * size] for i in range(num_instances)]
+
+def worker(rank, cores, intra_op_threads, inter_op_threads, model_config, requests, results):
+
+    # The OpenMP environment is set by the parent before the spawn, because the main module of the parent, and with it TensorFlow, is imported before worker runs
+    # The session thread pools are only created with the session, so they start on the pinned cores
+    if cores is not None:
+        os.sched_setaffinity(0, cores)
+
+    try:
+        import tensorflow as tf
+        from model import CycleGAN
+        from frozen_model import FrozenCycleGAN
+
+        session_config = tf.ConfigProto(intra_op_parallelism_threads = intra_op_threads, inter_op_parallelism_threads = inter_op_threads)
+        if model_config['frozen_model_filepath'] is not None:
+            model = FrozenCycleGAN(model_filepath = model_config['frozen_model_filepath'], session_config = session_config)
+        else:
+            model = CycleGAN(input_size = model_config['input_size'], num_filters = model_config['num_filters'], mode = 'test', directions = model_config['directions'],
+                             generator_config = model_config['generator_config'], session_config = session_config)
+            model.load(filepath = model_config['model_filepath'])
+    except Exception as e:
+        results.put((None, rank, repr(e)))
+        return
+    results.put((None, rank, None))
+
+    while True:
+        item = requests.get()
+        if item is None:
+            break
+        request_id, inputs, direction = item
+        try:
+            results.put((request_id, model.test(inputs = inputs, direction = direction), None))
+        except Exception as e:
+            results.put((request_id, None, repr(e)))
+
+class MultiInstanceConverter(object):
+
+    # model_config holds model_filepath, frozen_model_filepath, input_size, num_filters, generator_config and directions
+    # threads_per_instance defaults to the number of cores of each instance
+
+    def __init__(self, model_config, num_instances, threads_per_instance = None, inter_op_threads = 1, pin_cores = True):
+
+        self.directions = model_config['directions']
+        self.num_instances = num_instances
+        self.cores = core_sets(num_instances) if pin_cores else [None] * num_instances
+        if threads_per_instance is None:
+            threads_per_instance = len(self.cores[0]) if self.cores[0] is not None else 1
+        self.threads_per_instance = threads_per_instance
+
+        # TensorFlow is not fork safe
+        context = multiprocessing.get_context('spawn')
+        self.requests = context.Queue()
+        self.results = context.Queue()
+        self.processes = list()
+        # The spawned processes inherit the environment, OpenMP reads it when TensorFlow is first imported
+        environment = os.environ.copy()
+        os.environ['OMP_NUM_THREADS'] = str(threads_per_instance)
+        try:
+            for rank in range(num_instances):
+                process = context.Process(target = worker, args = (rank, self.cores[rank], threads_per_instance, inter_op_threads, model_config, self.requests, self.results))
+                process.daemon = True
+                process.start()
+                self.processes.append(process)
+        finally:
+            os.environ.clear()
+            os.environ.update(environment)
+
+        # Wait for all the instances to load the model
+        num_ready = 0
+        while num_ready < num_instances:
+            try:
+                _, rank, error = self.results.get(timeout = 1)
+            except queue.Empty:
+                if all(process.is_alive() for process in self.processes):
+                    continue
+                error = 'exit code %s' % [process.exitcode for process in self.processes if not process.is_alive()][0]
+                rank = [rank for rank, process in enumerate(self.processes) if not process.is_alive()][0]
+            if error is not None:
+                for process in self.processes:
+                    process.terminate()
+                raise Exception('Instance %d failed to load the model: %s' % (rank, error))
+            num_ready += 1
+
+        self.futures = dict()
+        # Set if an instance exits, pending and later conversions fail with it
+        self.error = None
+        self.lock = threading.Lock()
+        self.request_ids = iter(range(2 ** 62))
+        self.collector = threading.Thread(target = self.collect)
+        self.collector.daemon = True
+        self.collector.start()
+
+    def collect(self):
+
+        # Hand the results of the instances to the waiting test calls
+        while True:
+            try:
+                item = self.results.get(timeout = 1)
+            except queue.Empty:
+                # The request of an instance that exits, e.g. killed for running out of memory, would never be answered
+                dead = [rank for rank, process in enumerate(self.processes) if not process.is_alive()]
+                if len(dead) > 0 and self.error is None:
+                    with self.lock:
+                        self.error = Exception('Instance %d exited unexpectedly with exit code %s.' % (dead[0], self.processes[dead[0]].exitcode))
+                        futures = list(self.futures.values())
+                        self.futures.clear()
+                    for future in futures:
+                        future.set_exception(self.error)
+                continue
+            if item is None:
+                break
+            request_id, generation, error = item
+            with self.lock:
+                future = self.futures.pop(request_id, None)
+            if future is None:
+                continue
+            if error is not None:
+                future.set_exception(Exception('Conversion failed in an instance: %s' % error))
+            else:
+                future.set_result(generation)
+
+    def submit(self, inputs, direction):
+
+        future = Future()
+        with self.lock:
+            if self.error is not None:
+                raise self.error
+            request_id = next(self.request_ids)
+            self.futures[request_id] = future
+        self.requests.put((request_id, inputs, direction))
+
+        return future
+
+    def test(self, inputs, direction):
+
+        # The batch is split into one part per instance, test could be called from several threads
+        if direction not in self.directions:
+            raise Exception('Conversion direction %s is not built in this model.' % direction)
+        futures = [self.submit(inputs = part, direction = direction) for part in np.array_split(inputs, min(self.num_instances, len(inputs)))]
+
+        return np.concatenate([future.result() for future in futures])
+
+    def close(self):
+
+        for _ in self.processes:
+            self.requests.put(None)
+        for process in self.processes:
+            process.join()
+        self.results.put(None)
+        self.collector.join()
+
+def load_instance_config(filepath):
+
+    # Instance count, thread counts and batch size chosen by tune
+    with open(filepath, 'r') as f:
+        return json.load(f)
+
+def tune(model_config, direction, image_size, instance_counts, batch_sizes, target_latency, thread_counts = None, inter_op_threads = 1, num_runs = 10):
+
+    # Search the instance count, the intra-op threads per instance and the batch size per instance for the highest throughput whose p95 latency of one converted batch is within target_latency seconds
+    # thread_counts larger than the core set of an instance are skipped, None tries the size of the core set only
+    # Returns the measurements and the chosen configuration, which could be saved for load_instance_config
+
+    # benchmark imports convert, which imports this module
+    from benchmark import timing
+
+    measurements = list()
+    for num_instances in instance_counts:
+        cores = core_sets(num_instances)[0]
+        cores_per_instance = len(cores) if cores is not None else 1
+        for threads_per_instance in (thread_counts if thread_counts is not None else [cores_per_instance]):
+            if threads_per_instance > cores_per_instance:
+                continue
+            converter = MultiInstanceConverter(model_config = model_config, num_instances = num_instances, threads_per_instance = threads_per_instance, inter_op_threads = inter_op_threads)
+            for batch_size in batch_sizes:
+                imgs = np.random.uniform(-1, 1, size = [num_instances * batch_size, image_size[0], image_size[1], 3]).astype(np.float32)
+                result = timing(lambda: converter.test(inputs = imgs, direction = direction), num_runs = num_runs, num_items = len(imgs))
+                measurement = {'num_instances': num_instances, 'threads_per_instance': threads_per_instance, 'inter_op_threads': inter_op_threads,
+                               'batch_size': num_instances * batch_size, 'throughput': result['throughput'], 'p95_latency_ms': result['p95_ms']}
+                measurements.append(measurement)
+                print(json.dumps(measurement))
+            converter.close()
+
+    feasible = [measurement for measurement in measurements if measurement['p95_latency_ms'] <= target_latency * 1000]
+    if len(feasible) > 0:
+        best = max(feasible, key = lambda measurement: measurement['throughput'])
+    else:
+        print('No configuration meets the target latency, choosing the lowest latency')
+        best = min(measurements, key = lambda measurement: measurement['p95_latency_ms'])
+
+    return measurements, best
+
+if __name__ == '__main__':
+
+    parser = argparse.ArgumentParser(description = 'Tune the number of pinned inference instances, threads and batch size for the highest throughput at a target latency.')
+
+    num_cores = len(os.sched_getaffinity(0))
+
+    parser.add_argument('--model_filepath', type = str, help = 'File path for the pre-trained model.', default = './model/horse_zebra/horse_zebra.ckpt')
+    parser.add_argument('--frozen_model', type = str, help = 'File path for a frozen .pb model exported by freeze_model.py. Used instead of model_filepath if set.', default = None)
+    parser.add_argument('--filter_number', type = int, help = 'The filter number of the pre-trained model.', default = 64)
+    parser.add_argument('--generator_config', type = str, help = 'File path for the generator_config.json of a distilled or pruned model. Overrides the filter number.', default = None)
+    parser.add_argument('--direction', type = str, help = 'Conversion direction to tune, A2B or B2A.', default = 'A2B')
+    parser.add_argument('--image_size', type = int, nargs = 2, help = 'Height and width of the converted images.', default = [256, 256])
+    parser.add_argument('--instances', type = int, nargs = '+', help = 'Instance counts to try.', default = [count for count in [1, 2, 4, 8, 16, 32, 64] if count <= num_cores])
+    parser.add_argument('--threads', type = int, nargs = '+', help = 'Intra-op threads per instance to try. Default is the number of cores of an instance.', default = None)
+    parser.add_argument('--batch_sizes', type = int, nargs = '+', help = 'Batch sizes per instance to try.', default = [1, 2, 4, 8])
+    parser.add_argument('--inter_op_threads', type = int, help = 'Inter-op threads of each instance.', default = 1)
+    parser.add_argument('--target_latency', type = float, help = 'Target p95 latency in milliseconds for converting one batch.', default = 1000)
+    parser.add_argument('--num_runs', type = int, help = 'Number of timed batches per configuration.', default = 10)
+    parser.add_argument('--output', type = str, help = 'File for the chosen configuration as JSON, used with --instance_config in convert.py and server.py.', default = 'instance_config.json')
+
+    argv = parser.parse_args()
+
+    num_filters = argv.filter_number
+    generator_config = None
+    if argv.generator_config is not None:
+        from utils import load_generator_config
+        num_filters, generator_config = load_generator_config(filepath = argv.generator_config)
+
+    model_config = {'model_filepath': argv.model_filepath, 'frozen_model_filepath': argv.frozen_model, 'input_size': [argv.image_size[0], argv.image_size[1], 3],
+                    'num_filters': num_filters, 'generator_config': generator_config, 'directions': [argv.direction]}
+
+    measurements, best = tune(model_config = model_config, direction = argv.direction, image_size = argv.image_size, instance_counts = argv.instances, batch_sizes = argv.batch_sizes, thread_counts = argv.threads,
+                              target_latency = argv.target_latency / 1000, inter_op_threads = argv.inter_op_threads, num_runs = argv.num_runs)
+
+    print('Best: %d instances, %d threads per instance, batch size %d, %.2f images/second, p95 latency %.2f ms' % (best['num_instances'], best['threads_per_instance'],
+        best['batch_size'], best['throughput'], best['p95_latency_ms']))
+    with open(argv.output, 'w') as f:
+        json.dump(best, f, indent = 2)
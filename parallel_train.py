@@ -0,0 +1,194 @@
+import argparse
+import multiprocessing
+import os
+import time
+import numpy as np
+
+# Data parallel training on a single host
+# Every worker process holds its own CycleGAN session with a thread budget and trains on its own shard of the A and B images
+# Every sync_interval steps the workers send their generator and discriminator weights to the parent process, which averages them and sends them back
+# The optimizer states stay local to the workers
+
+def worker(rank, num_workers, config, connection):
+
+    # TensorFlow is imported in the worker so that every process gets its own runtime with the configured thread pools
+    import tensorflow as tf
+    from model import CycleGAN
+    from utils import load_data, sample_train_data
+    from checkpoint import CheckpointManager
+
+    np.random.seed(config['random_seed'] + rank)
+    tf.set_random_seed(config['random_seed'] + rank)
+
+    session_config = tf.ConfigProto(intra_op_parallelism_threads = config['threads_per_worker'], inter_op_parallelism_threads = 1)
+    input_size = [config['fine_size_h'], config['fine_size_w'], 3]
+    model = CycleGAN(input_size = input_size, num_filters = config['filter_number'], mode = 'train', lambda_cycle = config['lambda_cycle'], loss_function = config['loss_function'],
+                     log_dir = os.path.join(config['tensorboard_log_dir'], 'worker_%d' % rank), fused_step = config['fused_step'], session_config = session_config)
+
+    # With the memory-mapped cache the shards are strided views, not copies
+    dataset_A_raw = load_data(img_dir = config['img_A_dir'], load_size_w = config['load_size_w'], load_size_h = config['load_size_h'], cache_dir = config['cache_dir'])[rank::num_workers]
+    dataset_B_raw = load_data(img_dir = config['img_B_dir'], load_size_w = config['load_size_w'], load_size_h = config['load_size_h'], cache_dir = config['cache_dir'])[rank::num_workers]
+
+    if config['checkpoint'] is not None and rank == 0:
+        model.load(config['checkpoint'])
+
+    mini_batch_size = config['mini_batch_size']
+    num_samples = min(len(dataset_A_raw), len(dataset_B_raw), config['batch_size_maximum'] // num_workers)
+
+    # All workers start from the weights of worker 0 and run the same number of steps per epoch
+    connection.send((num_samples // mini_batch_size, model.get_weights() if rank == 0 else None))
+    num_steps, weights = connection.recv()
+    model.set_weights(weights)
+
+    # Worker 0 writes the checkpoints in the background
+    checkpoint_manager = CheckpointManager(model = model, directory = config['model_dir'], keep_last = config['keep_last']) if rank == 0 and config['save'] else None
+
+    for epoch in range(config['epochs']):
+
+        dataset_A, dataset_B = sample_train_data(dataset_A_raw, dataset_B_raw, load_size_w = config['load_size_w'], load_size_h = config['load_size_h'],
+                                                 output_size_w = config['fine_size_w'], output_size_h = config['fine_size_h'], batch_size_maximum = num_samples)
+
+        losses = list()
+        epoch_losses = list()
+        for i in range(num_steps):
+            start = i * mini_batch_size
+            end = (i + 1) * mini_batch_size
+            losses.append(model.train(input_A = dataset_A[start:end], input_B = dataset_B[start:end], learning_rate = config['learning_rate']))
+
+            if (i + 1) % config['sync_interval'] == 0 or i == num_steps - 1:
+                connection.send((model.get_weights(), np.mean(losses, axis = 0), len(losses) * mini_batch_size))
+                epoch_losses.extend(losses)
+                losses = list()
+                model.set_weights(connection.recv())
+
+        if checkpoint_manager is not None:
+            checkpoint_manager.save(filename = config['model_name'] + '_' + str(epoch), epoch = epoch, metric = float(np.mean([loss[0] for loss in epoch_losses])), force = True)
+
+    if checkpoint_manager is not None:
+        checkpoint_manager.close()
+    connection.close()
+
+def receive(connection, process):
+
+    # A worker that exits closes its end of the pipe, recv then raises EOFError instead of blocking
+    while not connection.poll(1):
+        if not process.is_alive():
+            raise Exception('A training worker exited unexpectedly with exit code %s.' % process.exitcode)
+
+    return connection.recv()
+
+def train_parallel(config, num_workers):
+
+    # Returns the training throughput in images/second of every epoch
+
+    # The memory-mapped cache is built once here, the workers only open it
+    if config['cache_dir'] is not None:
+        from utils import load_data
+        for img_dir in [config['img_A_dir'], config['img_B_dir']]:
+            load_data(img_dir = img_dir, load_size_w = config['load_size_w'], load_size_h = config['load_size_h'], cache_dir = config['cache_dir'])
+
+    # TensorFlow is not fork safe
+    context = multiprocessing.get_context('spawn')
+    connections = list()
+    processes = list()
+    for rank in range(num_workers):
+        parent_connection, child_connection = context.Pipe()
+        process = context.Process(target = worker, args = (rank, num_workers, config, child_connection))
+        process.start()
+        # Only the worker holds the child end, so that its exit is seen as EOF
+        child_connection.close()
+        connections.append(parent_connection)
+        processes.append(process)
+
+    try:
+        throughputs = synchronize(config = config, connections = connections, processes = processes, num_workers = num_workers)
+        for process in processes:
+            process.join()
+    finally:
+        # After a failed worker the others would wait for the averaged weights forever
+        for process in processes:
+            if process.is_alive():
+                process.terminate()
+
+    return throughputs
+
+def synchronize(config, connections, processes, num_workers):
+
+    # Averages the weights of the workers every sync_interval steps, returns the training throughput of every epoch
+
+    ready = [receive(connection, process) for connection, process in zip(connections, processes)]
+    num_steps = min(num_steps for num_steps, _ in ready)
+    for connection in connections:
+        connection.send((num_steps, ready[0][1]))
+
+    num_syncs = -(-num_steps // config['sync_interval'])
+    throughputs = list()
+    for epoch in range(config['epochs']):
+        start_time = time.time()
+        num_images = 0
+        for sync in range(num_syncs):
+            messages = [receive(connection, process) for connection, process in zip(connections, processes)]
+            weights = [np.mean([message[0][i] for message in messages], axis = 0) for i in range(len(messages[0][0]))]
+            for connection in connections:
+                connection.send(weights)
+            num_images += sum(message[2] for message in messages)
+            generator_loss, discriminator_loss = np.mean([message[1] for message in messages], axis = 0)
+
+        time_elapsed = time.time() - start_time
+        throughputs.append(num_images / time_elapsed)
+        print('Workers: %d, Epoch: %d, Generator Loss : %f, Discriminator Loss : %f, Training Throughput: %.2f images/second' % (num_workers, epoch, generator_loss, discriminator_loss, throughputs[-1]))
+
+    return throughputs
+
+if __name__ == '__main__':
+
+    parser = argparse.ArgumentParser(description = 'Train CycleGAN model with several data parallel worker processes on one host.')
+
+    parser.add_argument('--img_A_dir', type = str, help = 'Directory for A images.', default = './data/horse2zebra/trainA')
+    parser.add_argument('--img_B_dir', type = str, help = 'Directory for B images.', default = './data/horse2zebra/trainB')
+    parser.add_argument('--model_dir', type = str, help = 'Directory for saving models.', default = './model/horse_zebra')
+    parser.add_argument('--model_name', type = str, help = 'File name for saving model.', default = 'horse_zebra.ckpt')
+    parser.add_argument('--random_seed', type = int, help = 'Random seed for model training.', default = 0)
+    parser.add_argument('--batch_size_maximum', type = int, help = 'Maximum number of samples for one epoch over all workers.', default = 300)
+    parser.add_argument('--tensorboard_log_dir', type = str, help = 'TensorBoard log directory.', default = './log')
+    parser.add_argument('--load_size_w', type=int,    help = 'The image load size', default = 1227)
+    parser.add_argument('--load_size_h', type=int,    help = 'The image load size', default = 816)
+    parser.add_argument('--fine_size_w', type=int,    help = 'The cropped training and output image size', default = 1216)
+    parser.add_argument('--fine_size_h', type=int,    help = 'The cropped training and output image size', default = 816)
+    parser.add_argument('--filter_number',      help='The filter number for the first convolutional layer', type=int, default=32)
+    parser.add_argument('--lambda_cycle',       help='The cycle loss weight', type=int, default=10)
+    parser.add_argument('--loss_function',      help='The loss function for generator and discrimator', type=str, default='l2')
+    parser.add_argument('--learning_rate',      help='Learning rate', type=float, default=0.0002)
+    parser.add_argument('--epochs',             help='Maximum epochs for training', type=int, default=1000)
+    parser.add_argument('--checkpoint',         help='Directory of the checkpoint to resume the training', type=str, default=None)
+    parser.add_argument('--mini_batch_size',    help='Number of samples for one training step of each worker', type=int, default=1)
+    parser.add_argument('--fused_step',         help='Run the generator and discriminator updates in a single session run', action='store_true')
+    parser.add_argument('--cache_dir',          help='Directory for the memory-mapped cache of decoded and resized training images, shared by the workers', type=str, default='./cache')
+    parser.add_argument('--num_workers',        help='Number of worker processes', type=int, default=4)
+    parser.add_argument('--threads_per_worker', help='Number of intra-op threads of each worker. Default is the number of cores divided by the number of workers', type=int, default=None)
+    parser.add_argument('--sync_interval',      help='Number of training steps between two weight averages. Every average sends all the weights of every worker through the parent process', type=int, default=20)
+    parser.add_argument('--keep_last',          help='Number of most recent checkpoints to keep, 0 keeps all', type=int, default=0)
+    parser.add_argument('--scaling_test',       help='Measure the scaling efficiency for these worker counts instead of training, e.g. 1 2 4 8', type=int, nargs='+', default=None)
+    parser.add_argument('--scaling_epochs',     help='Number of epochs of each scaling test run, the first one is the warm up', type=int, default=3)
+
+    argv = parser.parse_args()
+    config = vars(argv)
+
+    if argv.scaling_test is None:
+        config['save'] = True
+        config['threads_per_worker'] = argv.threads_per_worker or max(multiprocessing.cpu_count() // argv.num_workers, 1)
+        train_parallel(config = config, num_workers = argv.num_workers)
+    else:
+        # Nothing is saved, the first epoch is the warm up
+        config['save'] = False
+        config['epochs'] = argv.scaling_epochs
+        throughputs = dict()
+        for num_workers in argv.scaling_test:
+            config['threads_per_worker'] = argv.threads_per_worker or max(multiprocessing.cpu_count() // num_workers, 1)
+            epoch_throughputs = train_parallel(config = config, num_workers = num_workers)
+            throughputs[num_workers] = np.mean(epoch_throughputs[1:]) if len(epoch_throughputs) > 1 else epoch_throughputs[0]
+
+        baseline = throughputs[argv.scaling_test[0]] / argv.scaling_test[0]
+        for num_workers in argv.scaling_test:
+            print('Workers: %d, Throughput: %.2f images/second, Speedup: %.2f, Scaling Efficiency: %.1f%%' % (num_workers, throughputs[num_workers],
+                throughputs[num_workers] / throughputs[argv.scaling_test[0]], throughputs[num_workers] / (num_workers * baseline) * 100))
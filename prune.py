@@ -0,0 +1,232 @@
+import argparse
+import os
+import numpy as np
+import tensorflow as tf
+
+from model import CycleGAN
+from distill import distill
+from benchmark import timing
+from utils import load_generator_config, save_generator_config
+
+# Structured channel pruning of a trained generator
+# The output channels of the generator layers are ranked, the least important ones are removed until the FLOPs fit the budget, and the remaining weights are copied into a thinner generator
+# The pruned generator is saved as a regular checkpoint with a generator_config.json holding the per-layer filter numbers, and could be fine tuned by distillation from the original generator
+
+def generator_layers(num_residual_blocks):
+
+    # (layer name, transposed convolution, input group, output group, instance norm index, output pixels per input pixel)
+    # A group is a set of channels pruned together, named after the layer_filters key of generator_resnet. None is the RGB input or output
+    # The residual blocks outputs are added to the c3_conv output, so they all belong to the c3_conv group
+    # instance_norm_layer does not use its name, the InstanceNorm variables are numbered in creation order
+    # For transposed convolutions the last field is the number of input pixels, which is what the multiplications scale with
+    layers = [('c1_conv', False, None, 'c1_conv', 0, 1.0),
+              ('c2_conv', False, 'c1_conv', 'c2_conv', 1, 1 / 4),
+              ('c3_conv', False, 'c2_conv', 'c3_conv', 2, 1 / 16)]
+    for i in range(num_residual_blocks):
+        hidden = 'residual%d_conv1' % (i + 1)
+        layers.append((hidden, False, 'c3_conv', hidden, 3 + 2 * i, 1 / 16))
+        layers.append(('residual%d_conv2' % (i + 1), False, hidden, 'c3_conv', 4 + 2 * i, 1 / 16))
+    layers += [('d1_deconv', True, 'c3_conv', 'd1_deconv', 3 + 2 * num_residual_blocks, 1 / 16),
+               ('d2_deconv', True, 'd1_deconv', 'd2_deconv', 4 + 2 * num_residual_blocks, 1 / 4),
+               ('d3_conv', False, 'd2_deconv', None, None, 1.0)]
+
+    return layers
+
+def instance_norm_name(index):
+
+    return 'InstanceNorm' if index == 0 else 'InstanceNorm_%d' % index
+
+def generator_flops(weights, layers, widths):
+
+    # Multiply-accumulates per input pixel of the generator with the given group widths
+    flops = 0.0
+    for name, transposed, input_group, output_group, _, scale in layers:
+        kernel_h, kernel_w = weights[name + '/kernel'].shape[:2]
+        input_channels = widths[input_group] if input_group is not None else 3
+        output_channels = widths[output_group] if output_group is not None else 3
+        flops += scale * kernel_h * kernel_w * input_channels * output_channels
+
+    return flops
+
+def channel_importance(weights, layers, criterion = 'gamma'):
+
+    # gamma: absolute scale of the instance normalization after the layer
+    # weight: L1 norm of the kernel of each output channel, relative to the mean of the layer because the following instance normalization removes the kernel scale
+    # Importances of the layers sharing a group are summed, and each group is normalized by its mean so that the groups could be ranked together
+
+    importance = dict()
+    for name, transposed, input_group, output_group, norm_index, _ in layers:
+        if output_group is None:
+            continue
+        if criterion == 'gamma':
+            scores = np.abs(weights[instance_norm_name(norm_index) + '/gamma'])
+        elif criterion == 'weight':
+            kernel = weights[name + '/kernel']
+            # Transposed convolution kernels are [height, width, output channels, input channels]
+            scores = np.sum(np.abs(kernel), axis = (0, 1, 3) if transposed else (0, 1, 2))
+            scores = scores / np.mean(scores)
+        else:
+            raise Exception('Unknown importance criterion %s.' % criterion)
+        importance[output_group] = importance.get(output_group, 0) + scores
+
+    return {group: scores / np.mean(scores) for group, scores in importance.items()}
+
+def select_channels(weights, layers, importance, flops_ratio, min_channels = 4):
+
+    # Remove the least important channels over all groups until the FLOPs are at most flops_ratio of the original
+    # Returns the sorted indices of the kept channels of each group
+
+    widths = {group: len(scores) for group, scores in importance.items()}
+    target_flops = generator_flops(weights = weights, layers = layers, widths = widths) * flops_ratio
+    removed = {group: set() for group in importance}
+
+    ranked = sorted(((score, group, channel) for group, scores in importance.items() for channel, score in enumerate(scores)), key = lambda item: item[0])
+    for score, group, channel in ranked:
+        if generator_flops(weights = weights, layers = layers, widths = widths) <= target_flops:
+            break
+        if widths[group] <= min_channels:
+            continue
+        removed[group].add(channel)
+        widths[group] -= 1
+
+    return {group: np.array([channel for channel in range(len(scores)) if channel not in removed[group]]) for group, scores in importance.items()}
+
+def prune_weights(weights, layers, kept):
+
+    # Slice the kernels, biases and instance normalization parameters to the kept channels
+    pruned = dict(weights)
+    for name, transposed, input_group, output_group, norm_index, _ in layers:
+        kernel = weights[name + '/kernel']
+        bias = weights[name + '/bias']
+        if transposed:
+            if output_group is not None:
+                kernel = kernel[:, :, kept[output_group], :]
+            if input_group is not None:
+                kernel = kernel[:, :, :, kept[input_group]]
+        else:
+            if input_group is not None:
+                kernel = kernel[:, :, kept[input_group], :]
+            if output_group is not None:
+                kernel = kernel[:, :, :, kept[output_group]]
+        if output_group is not None:
+            bias = bias[kept[output_group]]
+            for parameter in ['beta', 'gamma']:
+                norm_name = instance_norm_name(norm_index) + '/' + parameter
+                pruned[norm_name] = weights[norm_name][kept[output_group]]
+        pruned[name + '/kernel'] = kernel
+        pruned[name + '/bias'] = bias
+
+    return pruned
+
+def load_generator(checkpoint, direction, num_filters, generator_config):
+
+    # Generator variable values by name relative to the generator scope
+    with tf.Graph().as_default():
+        model = CycleGAN(input_size = [256, 256, 3], num_filters = num_filters, mode = 'test', directions = [direction], generator_config = generator_config)
+        model.load(filepath = checkpoint)
+        values = model.sess.run(model.generator_vars)
+        weights = {variable.op.name.split('/', 1)[1]: value for variable, value in zip(model.generator_vars, values)}
+        model.sess.close()
+
+    return weights
+
+def latency(checkpoint, direction, num_filters, generator_config, image_size, num_runs = 10):
+
+    imgs = np.random.uniform(-1, 1, size = [1, image_size, image_size, 3]).astype(np.float32)
+    with tf.Graph().as_default():
+        model = CycleGAN(input_size = [image_size, image_size, 3], num_filters = num_filters, mode = 'test', directions = [direction], generator_config = generator_config)
+        model.load(filepath = checkpoint)
+        # The first run is the warm up
+        generation = model.test(inputs = imgs, direction = direction)
+        result = timing(lambda: model.test(inputs = imgs, direction = direction), num_runs = num_runs, num_warmup = 0)
+        model.sess.close()
+
+    return result['median_ms'] / 1000, generation
+
+def prune(checkpoint, direction, num_filters, generator_config, output_dir, model_name, flops_ratio, criterion = 'gamma', min_channels = 4, image_size = 256):
+
+    # Returns the path and the generator config of the pruned checkpoint
+
+    generator_config = dict(generator_config) if generator_config is not None else dict()
+    if generator_config.get('separable', False):
+        raise Exception('Pruning of depthwise separable generators is not supported.')
+    num_residual_blocks = generator_config.get('num_residual_blocks', 9)
+
+    weights = load_generator(checkpoint = checkpoint, direction = direction, num_filters = num_filters, generator_config = generator_config)
+    layers = generator_layers(num_residual_blocks = num_residual_blocks)
+
+    importance = channel_importance(weights = weights, layers = layers, criterion = criterion)
+    kept = select_channels(weights = weights, layers = layers, importance = importance, flops_ratio = flops_ratio, min_channels = min_channels)
+    pruned_weights = prune_weights(weights = weights, layers = layers, kept = kept)
+
+    layer_filters = {group: len(channels) for group, channels in kept.items()}
+    pruned_generator_config = dict(generator_config)
+    pruned_generator_config['layer_filters'] = layer_filters
+
+    with tf.Graph().as_default():
+        model = CycleGAN(input_size = [image_size, image_size, 3], num_filters = num_filters, mode = 'test', directions = [direction], generator_config = pruned_generator_config)
+        for variable in model.generator_vars:
+            variable.load(pruned_weights[variable.op.name.split('/', 1)[1]], model.sess)
+        pruned_checkpoint = model.save(directory = output_dir, filename = model_name)
+        model.sess.close()
+    save_generator_config(filepath = os.path.join(output_dir, 'generator_config.json'), num_filters = num_filters, generator_config = pruned_generator_config)
+
+    widths = {group: len(scores) for group, scores in importance.items()}
+    flops = generator_flops(weights = weights, layers = layers, widths = widths) * image_size ** 2
+    pruned_flops = generator_flops(weights = pruned_weights, layers = layers, widths = layer_filters) * image_size ** 2
+    print('Layer filters: ' + ', '.join('%s %d/%d' % (group, layer_filters[group], widths[group]) for group in widths))
+    print('%dx%d multiply-accumulates: original %.2f G, pruned %.2f G (%.1f%%)' % (image_size, image_size, flops / 1e9, pruned_flops / 1e9, pruned_flops / flops * 100))
+
+    time_original, generation_original = latency(checkpoint = checkpoint, direction = direction, num_filters = num_filters, generator_config = generator_config, image_size = image_size)
+    time_pruned, generation_pruned = latency(checkpoint = pruned_checkpoint, direction = direction, num_filters = num_filters, generator_config = pruned_generator_config, image_size = image_size)
+    print('%dx%d latency: original %.2f ms, pruned %.2f ms, speedup %.2fx, mean absolute difference %.2f before fine tuning' % (image_size, image_size,
+        time_original * 1000, time_pruned * 1000, time_original / time_pruned, np.mean(np.abs(generation_pruned - generation_original)) * 127.5))
+
+    return pruned_checkpoint, pruned_generator_config
+
+if __name__ == '__main__':
+
+    parser = argparse.ArgumentParser(description = 'Prune the channels of a trained CycleGAN generator to a FLOP budget and optionally fine tune it by distillation.')
+
+    parser.add_argument('--checkpoint', type = str, help = 'Directory or path of the trained CycleGAN checkpoint.', default = './model/horse_zebra')
+    parser.add_argument('--filter_number', type = int, help = 'The filter number of the trained model.', default = 32)
+    parser.add_argument('--generator_config', type = str, help = 'File path for the generator_config.json of the trained model, e.g. a distilled model. Overrides the filter number.', default = None)
+    parser.add_argument('--direction', type = str, help = 'Conversion direction of the generator to prune, A2B or B2A.', default = 'A2B')
+    parser.add_argument('--output_dir', type = str, help = 'Directory for saving the pruned model and its generator_config.json.', default = './model/horse_zebra_pruned')
+    parser.add_argument('--model_name', type = str, help = 'File name for saving the pruned model.', default = 'horse_zebra_pruned.ckpt')
+    parser.add_argument('--flops_ratio', type = float, help = 'FLOP budget of the pruned generator relative to the original.', default = 0.5)
+    parser.add_argument('--criterion', type = str, help = 'Channel importance: gamma for the instance normalization scale, or weight for the kernel L1 norm.', default = 'gamma')
+    parser.add_argument('--min_channels', type = int, help = 'Minimum number of channels kept in each layer.', default = 4)
+    parser.add_argument('--image_size', type = int, help = 'Image size for the FLOP and latency report.', default = 256)
+    parser.add_argument('--fine_tune_epochs', type = int, help = 'Number of epochs to fine tune the pruned generator by distillation from the original. 0 for no fine tuning.', default = 0)
+    parser.add_argument('--img_dir', type = str, help = 'Directory for the source domain images used for fine tuning.', default = './data/horse2zebra/trainA')
+    parser.add_argument('--load_size_w', type=int,    help = 'The image load size for fine tuning', default = 286)
+    parser.add_argument('--load_size_h', type=int,    help = 'The image load size for fine tuning', default = 286)
+    parser.add_argument('--fine_size_w', type=int,    help = 'The cropped image size for fine tuning', default = 256)
+    parser.add_argument('--fine_size_h', type=int,    help = 'The cropped image size for fine tuning', default = 256)
+    parser.add_argument('--learning_rate',          help='Learning rate for fine tuning', type=float, default=0.0001)
+    parser.add_argument('--mini_batch_size',        help='Number of samples for one fine tuning step', type=int, default=4)
+    parser.add_argument('--batch_size_maximum',     help='Maximum number of samples for one fine tuning epoch', type=int, default=300)
+    parser.add_argument('--cache_dir',              help='Directory for the memory-mapped cache of decoded and resized images. If not set, no cache is used', type=str, default=None)
+    parser.add_argument('--random_seed',            help='Random seed for fine tuning', type=int, default=0)
+
+    argv = parser.parse_args()
+
+    num_filters = argv.filter_number
+    generator_config = None
+    if argv.generator_config is not None:
+        num_filters, generator_config = load_generator_config(filepath = argv.generator_config)
+
+    pruned_checkpoint, pruned_generator_config = prune(checkpoint = argv.checkpoint, direction = argv.direction, num_filters = num_filters, generator_config = generator_config,
+                                                       output_dir = argv.output_dir, model_name = argv.model_name, flops_ratio = argv.flops_ratio, criterion = argv.criterion,
+                                                       min_channels = argv.min_channels, image_size = argv.image_size)
+
+    if argv.fine_tune_epochs > 0:
+        # The original generator is the teacher, the fine tuned pruned generator overwrites the pruned checkpoint
+        with tf.Graph().as_default():
+            distill(teacher_checkpoint = argv.checkpoint, img_dirs = {argv.direction: argv.img_dir}, model_dir = argv.output_dir, model_name = argv.model_name,
+                    teacher_num_filters = num_filters, num_filters = num_filters, generator_config = pruned_generator_config,
+                    load_size_w = argv.load_size_w, load_size_h = argv.load_size_h, fine_size_w = argv.fine_size_w, fine_size_h = argv.fine_size_h,
+                    batch_size_maximum = argv.batch_size_maximum, mini_batch_size = argv.mini_batch_size, epochs = argv.fine_tune_epochs, learning_rate = argv.learning_rate,
+                    cache_dir = argv.cache_dir, random_seed = argv.random_seed, num_compare_images = 4,
+                    teacher_generator_config = generator_config, student_checkpoint = pruned_checkpoint)
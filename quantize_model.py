@@ -0,0 +1,210 @@
+import os
+if __name__ == '__main__':
+    # The int8 calibration reads the ranges logged by TensorFlow Print ops, which are only emitted with INFO logging enabled
+    # This has to be set before TensorFlow is imported, an explicit setting is kept
+    os.environ.setdefault('TF_CPP_MIN_LOG_LEVEL', '0')
+
+import argparse
+import sys
+import tempfile
+import time
+import cv2
+import numpy as np
+import tensorflow as tf
+from tensorflow.python.framework import tensor_util
+from tensorflow.tools.graph_transforms import TransformGraph
+
+from model import CycleGAN
+from freeze_model import freeze
+from frozen_model import FrozenCycleGAN, input_node_names, output_node_names
+from utils import image_scaling, load_generator_config
+
+def quantize_float16(graph_def, min_elements = 1024):
+
+    # Store the float32 weights as float16 constants followed by a cast back to float32
+    # The model size is halved, the computation stays in float32
+
+    quantized_graph_def = tf.GraphDef()
+    quantized_graph_def.versions.CopyFrom(graph_def.versions)
+
+    for node in graph_def.node:
+        if node.op == 'Const' and node.attr['dtype'].type == tf.float32.as_datatype_enum:
+            value = tensor_util.MakeNdarray(node.attr['value'].tensor)
+            if value.size >= min_elements:
+                node_float16 = quantized_graph_def.node.add()
+                node_float16.op = 'Const'
+                node_float16.name = node.name + '_float16'
+                node_float16.attr['dtype'].type = tf.float16.as_datatype_enum
+                node_float16.attr['value'].tensor.CopyFrom(tensor_util.make_tensor_proto(value.astype(np.float16)))
+
+                # The cast keeps the name of the original constant so that its consumers are unchanged
+                node_cast = quantized_graph_def.node.add()
+                node_cast.op = 'Cast'
+                node_cast.name = node.name
+                node_cast.input.append(node_float16.name)
+                node_cast.attr['SrcT'].type = tf.float16.as_datatype_enum
+                node_cast.attr['DstT'].type = tf.float32.as_datatype_enum
+                continue
+
+        quantized_graph_def.node.extend([node])
+
+    return quantized_graph_def
+
+def log_requantization_ranges(graph_def, calibration_data, log_filepath):
+
+    # Run the calibration images through the graph and collect the ranges printed by the logging ops in log_filepath
+    # The Print ops write to the process stderr, which is redirected to the log file meanwhile
+
+    graph = tf.Graph()
+    with graph.as_default():
+        tf.import_graph_def(graph_def, name = '')
+
+    with tf.Session(graph = graph) as sess:
+        sys.stderr.flush()
+        stderr_fd = os.dup(2)
+        with open(log_filepath, 'w') as log_file:
+            os.dup2(log_file.fileno(), 2)
+            try:
+                for direction, imgs in calibration_data.items():
+                    for img in imgs:
+                        sess.run(output_node_names[direction] + ':0', feed_dict = {input_node_names[direction] + ':0': img[np.newaxis]})
+            finally:
+                os.dup2(stderr_fd, 2)
+                os.close(stderr_fd)
+
+def quantize_int8(graph_def, directions, calibration_data = None):
+
+    # Eight bit weights and eight bit convolutions where TensorFlow has quantized kernels
+    # Without calibration data the activation ranges are computed at run time, with it they are frozen from the logged ranges
+
+    input_names = [input_node_names[direction] for direction in directions]
+    output_names = [output_node_names[direction] for direction in directions]
+
+    quantized_graph_def = TransformGraph(graph_def, input_names, output_names, [
+        'add_default_attributes',
+        'strip_unused_nodes',
+        'fold_constants(ignore_errors=true)',
+        'quantize_weights',
+        'quantize_nodes'])
+
+    if calibration_data is None:
+        return quantized_graph_def
+
+    logged_graph_def = TransformGraph(quantized_graph_def, input_names, output_names, [
+        'insert_logging(op=RequantizationRange, show_name=true, message="__requant_min_max:")'])
+
+    if os.environ.get('TF_CPP_MIN_LOG_LEVEL', '0') != '0':
+        raise Exception('The int8 calibration needs TF_CPP_MIN_LOG_LEVEL=0 before TensorFlow is imported.')
+
+    log_fd, log_filepath = tempfile.mkstemp(suffix = '.log')
+    os.close(log_fd)
+    log_requantization_ranges(graph_def = logged_graph_def, calibration_data = calibration_data, log_filepath = log_filepath)
+
+    calibrated_graph_def = TransformGraph(quantized_graph_def, input_names, output_names, [
+        'freeze_requantization_ranges(min_max_log_file="%s")' % log_filepath,
+        'fold_constants(ignore_errors=true)',
+        'strip_unused_nodes',
+        'sort_by_execution_order'])
+
+    os.remove(log_filepath)
+
+    return calibrated_graph_def
+
+def load_calibration_images(img_dir, num_images = 16, image_size = 256, offset = 0):
+
+    # The first num_images images in file name order after skipping offset images
+    files = sorted([file for file in os.listdir(img_dir) if os.path.isfile(os.path.join(img_dir, file))])[offset:offset + num_images]
+    imgs = [cv2.imread(os.path.join(img_dir, file)) for file in files]
+    imgs = [image_scaling(imgs = cv2.resize(img, (image_size, image_size)).astype(np.float32)) for img in imgs if img is not None]
+
+    return np.array(imgs)
+
+def report(checkpoint, model_filepaths, directions, num_filters, evaluation_data, num_runs = 10, generator_config = None):
+
+    # Latency, model size and output deviation of the exported models against the float32 checkpoint
+    # evaluation_data should not contain the calibration images, otherwise the int8 deviation is understated
+    evaluation_data = {direction: imgs for direction, imgs in evaluation_data.items() if len(imgs) > 0}
+
+    graph = tf.Graph()
+    with graph.as_default():
+        model_checkpoint = CycleGAN(input_size = [256, 256, 3], num_filters = num_filters, mode = 'test', directions = directions, generator_config = generator_config)
+        model_checkpoint.load(filepath = checkpoint)
+
+    references = {direction: model_checkpoint.test(inputs = imgs, direction = direction) for direction, imgs in evaluation_data.items()}
+
+    for name, model_filepath in model_filepaths:
+        model = FrozenCycleGAN(model_filepath = model_filepath)
+        size = os.path.getsize(model_filepath) / 2 ** 20
+
+        for direction, imgs in evaluation_data.items():
+            generation = model.test(inputs = imgs, direction = direction)
+            times = list()
+            for _ in range(num_runs):
+                start_time = time.time()
+                model.test(inputs = imgs[:1], direction = direction)
+                times.append(time.time() - start_time)
+
+            # Deviation in 8-bit pixel values
+            difference = np.abs(generation - references[direction]) * 127.5
+            mse = np.mean(np.square(difference))
+            psnr = 10 * np.log10(255 ** 2 / mse) if mse > 0 else float('inf')
+            print('%-8s %s: size %.2f MB, latency %.2f ms, mean absolute deviation %.3f, max absolute deviation %.3f, PSNR %.2f dB' % (
+                name, direction, size, np.median(times) * 1000, np.mean(difference), np.max(difference), psnr))
+
+        model.sess.close()
+
+if __name__ == '__main__':
+
+    parser = argparse.ArgumentParser(description = 'Export float16 and int8 quantized CycleGAN generators for CPU inference.')
+
+    parser.add_argument('--check-point-path',           help='Directory to your latest check point, or the path of a check point', type=str, default='./model/horse_zebra/')
+    parser.add_argument('--output-dir',                 help='Directory for the exported models', type=str, default='./model/horse_zebra/quantized')
+    parser.add_argument('--model-name',                 help='File name prefix for the exported models', type=str, default='cycle_gan')
+    parser.add_argument('--directions',                 help='Conversion directions to export, A2B and/or B2A', type=str, nargs='+', default=['A2B'])
+    parser.add_argument('--filter-number',              help='The filter number for the first convolutional layer of the trained model', type=int, default=32)
+    parser.add_argument('--calibration-A-dir',          help='Directory of A images for the int8 calibration, e.g. the training A directory', type=str, default='./data/horse2zebra/trainA')
+    parser.add_argument('--calibration-B-dir',          help='Directory of B images for the int8 calibration, e.g. the training B directory', type=str, default='./data/horse2zebra/trainB')
+    parser.add_argument('--generator-config',           help='File path for the generator_config.json of a distilled or pruned model. Overrides the filter number', type=str, default=None)
+    parser.add_argument('--num-calibration-images',     help='Number of images per direction used for the calibration', type=int, default=16)
+    parser.add_argument('--eval-A-dir',                 help='Directory of A images for the report. Default is the images following the calibration images in the calibration A directory', type=str, default=None)
+    parser.add_argument('--eval-B-dir',                 help='Directory of B images for the report. Default is the images following the calibration images in the calibration B directory', type=str, default=None)
+    parser.add_argument('--num-eval-images',            help='Number of images per direction used for the report', type=int, default=16)
+    parser.add_argument('--image-size',                 help='Calibration images are resized to this size', type=int, default=256)
+
+    args = parser.parse_args()
+
+    if not os.path.exists(args.output_dir):
+        os.makedirs(args.output_dir)
+
+    float32_filepath = os.path.join(args.output_dir, args.model_name + '_float32.pb')
+    float16_filepath = os.path.join(args.output_dir, args.model_name + '_float16.pb')
+    int8_filepath = os.path.join(args.output_dir, args.model_name + '_int8.pb')
+
+    num_filters = args.filter_number
+    generator_config = None
+    if args.generator_config is not None:
+        num_filters, generator_config = load_generator_config(filepath = args.generator_config)
+
+    freeze(checkpoint = args.check_point_path, output_model_filename = float32_filepath, directions = args.directions, num_filters = num_filters, generator_config = generator_config)
+
+    graph_def = tf.GraphDef()
+    with tf.gfile.GFile(float32_filepath, 'rb') as f:
+        graph_def.ParseFromString(f.read())
+
+    # A images are converted by A2B and B images by B2A
+    calibration_dirs = {'A2B': args.calibration_A_dir, 'B2A': args.calibration_B_dir}
+    calibration_data = {direction: load_calibration_images(img_dir = calibration_dirs[direction], num_images = args.num_calibration_images, image_size = args.image_size) for direction in args.directions}
+    # Held-out images for the report, either from separate directories or the images after the calibration images
+    eval_dirs = {'A2B': args.eval_A_dir, 'B2A': args.eval_B_dir}
+    evaluation_data = {direction: load_calibration_images(img_dir = eval_dirs[direction], num_images = args.num_eval_images, image_size = args.image_size) if eval_dirs[direction] is not None else
+                       load_calibration_images(img_dir = calibration_dirs[direction], num_images = args.num_eval_images, image_size = args.image_size, offset = args.num_calibration_images)
+                       for direction in args.directions}
+
+    with open(float16_filepath, 'wb') as f:
+        f.write(quantize_float16(graph_def = graph_def).SerializeToString())
+
+    with open(int8_filepath, 'wb') as f:
+        f.write(quantize_int8(graph_def = graph_def, directions = args.directions, calibration_data = calibration_data).SerializeToString())
+
+    report(checkpoint = args.check_point_path, model_filepaths = [('float32', float32_filepath), ('float16', float16_filepath), ('int8', int8_filepath)],
+           directions = args.directions, num_filters = num_filters, evaluation_data = evaluation_data, generator_config = generator_config)
@@ -0,0 +1,236 @@
+import argparse
+import cv2
+import json
+import queue
+import threading
+import time
+import collections
+import numpy as np
+from http.server import BaseHTTPRequestHandler, HTTPServer
+from socketserver import ThreadingMixIn
+
+from model import CycleGAN
+from frozen_model import FrozenCycleGAN
+from multi_instance import MultiInstanceConverter, load_instance_config
+from utils import image_scaling, image_scaling_inverse, load_generator_config
+
+class ConversionRequest(object):
+
+    def __init__(self, img):
+
+        self.img = img
+        self.img_converted = None
+        self.error = None
+        self.arrival_time = time.time()
+        self.done = threading.Event()
+
+class BatchingConverter(object):
+
+    # Collects concurrent conversion requests of one direction into batches
+    # A batch is run as soon as it has max_batch_size requests, or when the oldest request has waited max_latency seconds
+
+    def __init__(self, model, direction, input_size, max_batch_size = 8, max_latency = 0.01, num_latencies = 1000):
+
+        self.model = model
+        self.direction = direction
+        self.input_size = input_size
+        self.max_batch_size = max_batch_size
+        self.max_latency = max_latency
+
+        self.requests = queue.Queue()
+        self.lock = threading.Lock()
+        self.latencies = collections.deque(maxlen = num_latencies)
+        self.batch_sizes = collections.deque(maxlen = num_latencies)
+        self.num_requests = 0
+        self.num_batches = 0
+
+        self.thread = threading.Thread(target = self.run)
+        self.thread.daemon = True
+        self.thread.start()
+
+    def convert(self, img):
+
+        # Blocking call used by the request handler threads
+        request = ConversionRequest(img = img)
+        self.requests.put(request)
+        request.done.wait()
+        if request.error is not None:
+            raise request.error
+
+        return request.img_converted
+
+    def run(self):
+
+        while True:
+            batch = [self.requests.get()]
+            deadline = batch[0].arrival_time + self.max_latency
+            while len(batch) < self.max_batch_size:
+                # Requests that are already waiting are always taken, under load the deadline of the oldest request has usually passed
+                try:
+                    batch.append(self.requests.get_nowait())
+                    continue
+                except queue.Empty:
+                    pass
+                timeout = deadline - time.time()
+                if timeout <= 0:
+                    break
+                try:
+                    batch.append(self.requests.get(timeout = timeout))
+                except queue.Empty:
+                    break
+
+            try:
+                imgs = np.array([image_scaling(imgs = cv2.resize(request.img, (self.input_size[1], self.input_size[0])).astype(np.float32)) for request in batch])
+                imgs_converted = self.model.test(inputs = imgs, direction = self.direction)
+                for request, img_converted in zip(batch, imgs_converted):
+                    img_converted = image_scaling_inverse(imgs = img_converted)
+                    img_height, img_width = request.img.shape[:2]
+                    request.img_converted = np.clip(cv2.resize(img_converted, (img_width, img_height)), 0, 255).astype(np.uint8)
+            except Exception as e:
+                for request in batch:
+                    request.error = e
+
+            finish_time = time.time()
+            with self.lock:
+                self.num_requests += len(batch)
+                self.num_batches += 1
+                self.batch_sizes.append(len(batch))
+                for request in batch:
+                    self.latencies.append(finish_time - request.arrival_time)
+
+            for request in batch:
+                request.done.set()
+
+    def metrics(self):
+
+        with self.lock:
+            latencies = np.array(self.latencies) * 1000
+            metrics = {
+                'queue_depth': self.requests.qsize(),
+                'num_requests': self.num_requests,
+                'num_batches': self.num_batches,
+                'mean_batch_size': float(np.mean(self.batch_sizes)) if len(self.batch_sizes) > 0 else 0.0}
+        if len(latencies) > 0:
+            metrics.update({
+                'latency_ms_p50': float(np.percentile(latencies, 50)),
+                'latency_ms_p95': float(np.percentile(latencies, 95)),
+                'latency_ms_p99': float(np.percentile(latencies, 99))})
+
+        return metrics
+
+class ThreadingHTTPServer(ThreadingMixIn, HTTPServer):
+
+    daemon_threads = True
+
+def make_handler(converters):
+
+    class ConversionHandler(BaseHTTPRequestHandler):
+
+        # POST /convert/A2B or /convert/B2A with an encoded image as body, responds with the converted image in the same format
+        # GET /metrics responds with the queue depth, batch and latency statistics of every direction as JSON
+
+        def do_POST(self):
+
+            direction = self.path.strip('/').split('/')[-1]
+            if not self.path.startswith('/convert/') or direction not in converters:
+                self.send_error(404, 'Unknown conversion direction')
+                return
+
+            body = self.rfile.read(int(self.headers.get('Content-Length', 0)))
+            if len(body) == 0:
+                self.send_error(400, 'Empty request body')
+                return
+            img = cv2.imdecode(np.frombuffer(body, dtype = np.uint8), cv2.IMREAD_COLOR)
+            if img is None:
+                self.send_error(400, 'Could not decode the image')
+                return
+
+            try:
+                img_converted = converters[direction].convert(img = img)
+            except Exception as e:
+                self.send_error(500, str(e))
+                return
+
+            content_type = self.headers.get('Content-Type', 'image/png')
+            extension = '.jpg' if content_type in ('image/jpeg', 'image/jpg') else '.png'
+            _, encoded = cv2.imencode(extension, img_converted)
+            self.send_response(200)
+            self.send_header('Content-Type', 'image/jpeg' if extension == '.jpg' else 'image/png')
+            self.send_header('Content-Length', str(len(encoded)))
+            self.end_headers()
+            self.wfile.write(encoded.tobytes())
+
+        def do_GET(self):
+
+            if self.path != '/metrics':
+                self.send_error(404)
+                return
+
+            body = json.dumps({direction: converter.metrics() for direction, converter in converters.items()}).encode('utf-8')
+            self.send_response(200)
+            self.send_header('Content-Type', 'application/json')
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, format, *args):
+            pass
+
+    return ConversionHandler
+
+def serve(model, directions, input_size, host = '127.0.0.1', port = 8000, max_batch_size = 8, max_latency = 0.01):
+
+    converters = {direction: BatchingConverter(model = model, direction = direction, input_size = input_size, max_batch_size = max_batch_size, max_latency = max_latency) for direction in directions}
+
+    server = ThreadingHTTPServer((host, port), make_handler(converters))
+    print('Serving %s on http://%s:%d' % (', '.join(directions), host, port))
+    server.serve_forever()
+
+if __name__ == '__main__':
+
+    parser = argparse.ArgumentParser(description = 'Serve a pre-trained CycleGAN model over HTTP with dynamic request batching.')
+
+    parser.add_argument('--model_filepath', type = str, help = 'File path for the pre-trained model.', default = './model/horse_zebra/horse_zebra.ckpt')
+    parser.add_argument('--frozen_model', type = str, help = 'File path for a frozen .pb model exported by freeze_model.py. Used instead of model_filepath if set.', default = None)
+    parser.add_argument('--directions', type = str, nargs = '+', help = 'Conversion directions to serve, A2B and/or B2A.', default = ['A2B', 'B2A'])
+    parser.add_argument('--filter_number', type = int, help = 'The filter number for the first convolutional layer of the trained model.', default = 64)
+    parser.add_argument('--generator_config', type = str, help = 'File path for the generator_config.json of a distilled or pruned model. Overrides the filter number.', default = None)
+    parser.add_argument('--image_size', type = int, nargs = 2, help = 'Height and width the images are resized to for conversion.', default = [256, 256])
+    parser.add_argument('--host', type = str, help = 'Host address to listen on.', default = '127.0.0.1')
+    parser.add_argument('--port', type = int, help = 'Port to listen on.', default = 8000)
+    parser.add_argument('--max_batch_size', type = int, help = 'Maximum number of requests converted in one batch.', default = 8)
+    parser.add_argument('--max_latency', type = float, help = 'Maximum time in milliseconds a request waits for a batch to fill up.', default = 10)
+    parser.add_argument('--num_instances', type = int, help = 'Convert with this number of independent model sessions, each pinned to its own set of cores.', default = None)
+    parser.add_argument('--threads_per_instance', type = int, help = 'Intra-op threads of each instance. Default is the number of cores of the instance.', default = None)
+    parser.add_argument('--inter_op_threads', type = int, help = 'Inter-op threads of each instance.', default = 1)
+    parser.add_argument('--instance_config', type = str, help = 'JSON file written by multi_instance.py with the tuned number of instances, threads and batch size. Overrides the corresponding arguments.', default = None)
+
+    argv = parser.parse_args()
+
+    input_size = argv.image_size + [3]
+
+    num_filters = argv.filter_number
+    generator_config = None
+    if argv.generator_config is not None:
+        num_filters, generator_config = load_generator_config(filepath = argv.generator_config)
+
+    if argv.instance_config is not None:
+        instance_config = load_instance_config(filepath = argv.instance_config)
+        argv.num_instances = instance_config['num_instances']
+        argv.threads_per_instance = instance_config['threads_per_instance']
+        argv.inter_op_threads = instance_config['inter_op_threads']
+        argv.max_batch_size = instance_config['batch_size']
+
+    if argv.num_instances is not None:
+        # Every batch is split across the instances
+        model_config = {'model_filepath': argv.model_filepath, 'frozen_model_filepath': argv.frozen_model, 'input_size': input_size, 'num_filters': num_filters,
+                        'generator_config': generator_config, 'directions': argv.directions}
+        model = MultiInstanceConverter(model_config = model_config, num_instances = argv.num_instances, threads_per_instance = argv.threads_per_instance,
+                                       inter_op_threads = argv.inter_op_threads)
+    elif argv.frozen_model is not None:
+        model = FrozenCycleGAN(model_filepath = argv.frozen_model)
+    else:
+        model = CycleGAN(input_size = input_size, num_filters = num_filters, mode = 'test', directions = argv.directions, generator_config = generator_config)
+        model.load(filepath = argv.model_filepath)
+
+    serve(model = model, directions = argv.directions, input_size = input_size, host = argv.host, port = argv.port, max_batch_size = argv.max_batch_size, max_latency = argv.max_latency / 1000)
@@ -0,0 +1,125 @@
+import os
+import signal
+import threading
+import collections
+import tensorflow as tf
+from tensorflow.python.client import timeline
+
+class Tracer(object):
+
+    # Op-level tracing of the session runs of CycleGAN.train and CycleGAN.test
+    # The steps from start_step to start_step + num_steps - 1 are traced, and with signal_trigger the next num_steps steps after a SIGUSR1
+    # Every traced session run is written as a Chrome trace, chrome://tracing, and as TensorBoard run metadata, and a ranked per-op summary is printed
+
+    def __init__(self, log_dir, start_step = None, num_steps = 1, signal_trigger = False, top_k = 15):
+
+        self.log_dir = log_dir
+        self.start_step = start_step
+        self.num_steps = num_steps
+        self.top_k = top_k
+        if not os.path.exists(log_dir):
+            os.makedirs(log_dir)
+        self.writer = tf.summary.FileWriter(log_dir)
+
+        # Number of traced runs by name and step, repeated runs in a step get a suffix
+        self.run_counts = collections.defaultdict(int)
+        # Number of steps still to trace because of a signal
+        self.signal_requested = False
+        self.signal_steps = 0
+        # Signal handlers could only be installed from the main thread
+        if signal_trigger and threading.current_thread() is threading.main_thread():
+            signal.signal(signal.SIGUSR1, self.request)
+
+    def request(self, signum = None, frame = None):
+
+        self.signal_requested = True
+
+    def begin_step(self, step):
+
+        # Returns True if the session runs of this step are traced
+        if self.signal_requested:
+            self.signal_requested = False
+            self.signal_steps = self.num_steps
+        if self.signal_steps > 0:
+            self.signal_steps -= 1
+            return True
+
+        return self.start_step is not None and self.start_step <= step < self.start_step + self.num_steps
+
+    def run(self, sess, fetches, feed_dict, name, step):
+
+        # Session run with full tracing
+        run_options = tf.RunOptions(trace_level = tf.RunOptions.FULL_TRACE)
+        run_metadata = tf.RunMetadata()
+        results = sess.run(fetches, feed_dict = feed_dict, options = run_options, run_metadata = run_metadata)
+        self.record(run_metadata = run_metadata, name = name, step = step)
+
+        return results
+
+    def record(self, run_metadata, name, step):
+
+        key = '%s_%d' % (name, step)
+        tag = key if self.run_counts[key] == 0 else '%s_%d' % (key, self.run_counts[key])
+        self.run_counts[key] += 1
+        with open(os.path.join(self.log_dir, 'timeline_%s.json' % tag), 'w') as f:
+            f.write(timeline.Timeline(run_metadata.step_stats).generate_chrome_trace_format())
+        self.writer.add_run_metadata(run_metadata, tag, step)
+        self.writer.flush()
+
+        op_types, categories, total = self.summary(run_metadata = run_metadata)
+        print('Trace %s: %.2f ms of op time' % (tag, total / 1000))
+        print('  Op types:')
+        for op_type, time in op_types[:self.top_k]:
+            print('    %-40s %10.2f ms %5.1f%%' % (op_type, time / 1000, time / total * 100))
+        print('  Scopes and layers:')
+        for category, time in categories[:self.top_k]:
+            print('    %-40s %10.2f ms %5.1f%%' % (category, time / 1000, time / total * 100))
+
+    def summary(self, run_metadata):
+
+        # Returns the op time in microseconds by op type and by scope and layer type, in decreasing order, and the total op time
+        op_types = collections.defaultdict(int)
+        categories = collections.defaultdict(int)
+        total = 0
+        for device_stats in run_metadata.step_stats.dev_stats:
+            # GPU stream devices repeat the kernels of the GPU device
+            if '/stream:' in device_stats.device or '/memcpy' in device_stats.device:
+                continue
+            for node_stats in device_stats.node_stats:
+                if node_stats.node_name == '_SOURCE':
+                    continue
+                time = node_stats.all_end_rel_micros
+                # The timeline label has the form "node_name = OpType(inputs)"
+                op_type = node_stats.timeline_label.split(' = ')[-1].split('(')[0] if ' = ' in node_stats.timeline_label else node_stats.node_name.split(':')[0]
+                op_types[op_type] += time
+                categories[self.category(node_name = node_stats.node_name, op_type = op_type)] += time
+                total += time
+
+        def ranked(times):
+            return sorted(times.items(), key = lambda item: item[1], reverse = True)
+
+        return ranked(op_types), ranked(categories), max(total, 1)
+
+    def category(self, node_name, op_type):
+
+        # Network scope, e.g. generator_A2B, and layer type of module.py, gradient ops are marked as backward
+        backward = node_name.startswith('gradients')
+        components = [component for component in node_name.split('/') if not component.startswith('gradients')]
+        scope = components[0] if len(components) > 1 else 'other'
+
+        if op_type.startswith('MirrorPad'):
+            layer = 'reflect_pad'
+        elif any(component.startswith('InstanceNorm') for component in components):
+            layer = 'instance_norm'
+        elif any('deconv' in component for component in components):
+            layer = 'transposed_conv'
+        elif op_type.startswith('Conv2D') or op_type.startswith('DepthwiseConv2d') or any('conv' in component for component in components):
+            layer = 'conv'
+        else:
+            layer = 'other'
+
+        return '%s/%s%s' % (scope, layer, ' (backward)' if backward else '')
+
+    def close(self):
+
+        self.writer.close()
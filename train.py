@@ -1,38 +1,104 @@
 import tensorflow as tf
-import cv2
 import os
 import numpy as np
 import argparse
 import time
 
-from utils import load_data, sample_train_data, image_scaling, image_scaling_inverse
+from utils import load_data, load_train_dataset, sample_train_data
 from model import CycleGAN
+from validation import Validator
+from instrumentation import Instrumentation
+from checkpoint import CheckpointManager
+from tracing import Tracer
 
 def train(img_A_dir, img_B_dir, model_dir, model_name, random_seed, batch_size_maximum, validation_A_dir, validation_B_dir, output_dir, lambda_cycle, loss_function, tensorboard_log_dir):
 
     np.random.seed(random_seed)
 
     num_epochs = argv.epochs
-    mini_batch_size = 1 # mini_batch_size = 1 is better
+    mini_batch_size = argv.mini_batch_size # mini_batch_size = 1 is better
+    accumulation_steps = argv.accumulation_steps
+    # Number of samples for one update
+    step_size = mini_batch_size * accumulation_steps
     learning_rate = 0.0002
     input_size = [argv.fine_size_h, argv.fine_size_w, 3]
+    # The generators and discriminators are fully convolutional, so they could be trained on smaller random patches and still convert full resolution images
+    # The model is built for the patch size, validation runs at the full fine size
+    patch_size_h = argv.patch_size_h if argv.patch_size_h is not None else argv.fine_size_h
+    patch_size_w = argv.patch_size_w if argv.patch_size_w is not None else argv.fine_size_w
+    patch_input_size = [patch_size_h, patch_size_w, 3]
     #num_filters = 64 # Tried num_filters = 8 still not good for 200 epochs
     num_filters = argv.filter_number
 
+    validation_dirs = dict()
+    validation_output_dirs = dict()
+
     if validation_A_dir is not None:
         validation_A_output_dir = os.path.join(output_dir, 'converted_A')
         if not os.path.exists(validation_A_output_dir):
             os.makedirs(validation_A_output_dir)
+        validation_dirs['A2B'] = validation_A_dir
+        validation_output_dirs['A2B'] = validation_A_output_dir
 
     if validation_B_dir is not None:
         validation_B_output_dir = os.path.join(output_dir, 'converted_B')
         if not os.path.exists(validation_B_output_dir):
             os.makedirs(validation_B_output_dir)
-
-    model = CycleGAN(input_size = input_size, num_filters = num_filters, mode = 'train', lambda_cycle=lambda_cycle, loss_function=loss_function, log_dir = tensorboard_log_dir)
-
-    dataset_A_raw = load_data(img_dir = img_A_dir, load_size_w = argv.load_size_w, load_size_h = argv.load_size_h)
-    dataset_B_raw = load_data(img_dir = img_B_dir, load_size_w = argv.load_size_w, load_size_h = argv.load_size_h)
+        validation_dirs['B2A'] = validation_B_dir
+        validation_output_dirs['B2A'] = validation_B_output_dir
+
+    if len(validation_dirs) > 0:
+        validator = Validator(validation_dirs = validation_dirs, output_dirs = validation_output_dirs, input_size = input_size, num_filters = num_filters, batch_size = argv.validation_batch_size)
+    else:
+        validator = None
+
+    if argv.streaming:
+        # Images are decoded, cropped and flipped lazily by the tf.data pipeline and fed to the graph directly
+        tf.set_random_seed(random_seed)
+        input_A, input_B, num_samples = load_train_dataset(img_A_dir = img_A_dir, img_B_dir = img_B_dir, load_size_w = argv.load_size_w, load_size_h = argv.load_size_h,
+                                                           output_size_w = patch_size_w, output_size_h = patch_size_h, batch_size = mini_batch_size,
+                                                           num_parallel_calls = argv.num_parallel_calls, random_seed = random_seed, num_patches = argv.num_patches)
+        train_inputs = (input_A, input_B)
+    else:
+        train_inputs = None
+
+    # Per-phase timing, throughput and memory, written to TensorBoard and as one JSON line per epoch
+    instrumentation = Instrumentation(trace_allocations = argv.trace_allocations)
+
+    # With uint8 inputs the sampled crops stay uint8 and are scaled, and optionally flipped, in the graph
+    # The streaming pipeline already produces scaled float32 samples
+    uint8_inputs = argv.uint8_inputs and not argv.streaming
+    if argv.uint8_inputs and argv.streaming:
+        print('Warning: --uint8_inputs is ignored with --streaming')
+
+    # Op-level traces of a window of training steps, or of the next steps after a SIGUSR1
+    if argv.trace_start is not None or argv.trace_on_signal:
+        tracer = Tracer(log_dir = argv.trace_dir if argv.trace_dir is not None else os.path.join(tensorboard_log_dir, 'trace'), start_step = argv.trace_start, num_steps = argv.trace_steps,
+                        signal_trigger = argv.trace_on_signal)
+    else:
+        tracer = None
+    model = CycleGAN(input_size = patch_input_size, num_filters = num_filters, mode = 'train', lambda_cycle=lambda_cycle, loss_function=loss_function, log_dir = tensorboard_log_dir, train_inputs = train_inputs, fused_step = argv.fused_step, accumulation_steps = accumulation_steps,
+                     instrumentation = instrumentation, input_dtype = 'uint8' if uint8_inputs else 'float32', random_flip = uint8_inputs and argv.graph_flips,
+                     tracer = tracer)
+    metrics_file = argv.metrics_file if argv.metrics_file is not None else os.path.join(model.log_dir, 'metrics.jsonl')
+
+    # Validation runs in the background on each checkpoint once it is written
+    # The checkpoint is pinned so that the retention policy does not remove it before it is validated
+    def checkpoint_saved(checkpoint, epoch):
+        if validator is not None and ((epoch + 1) % argv.validation_interval == 0 or epoch == num_epochs - 1):
+            checkpoint_manager.pin(checkpoint)
+            try:
+                validator.submit(checkpoint = checkpoint, epoch = epoch, callback = checkpoint_manager.release)
+            except Exception:
+                checkpoint_manager.release(checkpoint)
+                raise
+
+    checkpoint_manager = CheckpointManager(model = model, directory = model_dir, keep_last = argv.keep_last, keep_every = argv.keep_every, keep_best = argv.keep_best,
+                                           save_interval = argv.save_interval, callback = checkpoint_saved)
+
+    if not argv.streaming:
+        dataset_A_raw = load_data(img_dir = img_A_dir, load_size_w = argv.load_size_w, load_size_h = argv.load_size_h, cache_dir = argv.cache_dir)
+        dataset_B_raw = load_data(img_dir = img_B_dir, load_size_w = argv.load_size_w, load_size_h = argv.load_size_h, cache_dir = argv.cache_dir)
 
     if argv.checkpoint is not None:
         print('loading model from checkpoint')
@@ -42,62 +108,60 @@ def train(img_A_dir, img_B_dir, model_dir, model_name, random_seed, batch_size_m
         print('Epoch: %d' % epoch)
 
         start_time_epoch = time.time()
+        instrumentation.reset()
+
+        if argv.streaming:
+            n_samples = min(num_samples, batch_size_maximum * argv.num_patches)
+        else:
+            with instrumentation.phase('sampling'):
+                #dataset_A, dataset_B = sample_train_data(dataset_A_raw, dataset_B_raw, load_size = 286, output_size = 256, batch_size_maximum = batch_size_maximum)
+                dataset_A, dataset_B = sample_train_data(dataset_A_raw, dataset_B_raw, load_size_w = argv.load_size_w, load_size_h = argv.load_size_h,
+                                                        output_size_w = patch_size_w, output_size_h = patch_size_h, batch_size_maximum = batch_size_maximum,
+                                                        num_threads = argv.sampling_threads, num_patches = argv.num_patches, scale = not uint8_inputs, flip = not (uint8_inputs and argv.graph_flips))
+            n_samples = dataset_A.shape[0]
 
-        #dataset_A, dataset_B = sample_train_data(dataset_A_raw, dataset_B_raw, load_size = 286, output_size = 256, batch_size_maximum = batch_size_maximum)
-        dataset_A, dataset_B = sample_train_data(dataset_A_raw, dataset_B_raw, load_size_w = argv.load_size_w, load_size_h = argv.load_size_h,
-                                                output_size_w = argv.fine_size_w, output_size_h = argv.fine_size_h, batch_size_maximum = batch_size_maximum)
+        start_time_training = time.time()
 
-        n_samples = dataset_A.shape[0]
-        for i in range(n_samples // mini_batch_size):
+        generator_losses = list()
+        for i in range(n_samples // step_size):
 
-            start = i * mini_batch_size
-            end = (i + 1) * mini_batch_size
+            start = i * step_size
+            end = (i + 1) * step_size
 
-            generator_loss, discriminator_loss = model.train(input_A = dataset_A[start:end], input_B = dataset_B[start:end], learning_rate = learning_rate)
+            if argv.streaming:
+                generator_loss, discriminator_loss = model.train(input_A = None, input_B = None, learning_rate = learning_rate)
+            else:
+                generator_loss, discriminator_loss = model.train(input_A = dataset_A[start:end], input_B = dataset_B[start:end], learning_rate = learning_rate)
+            instrumentation.add_images(step_size)
+            generator_losses.append(generator_loss)
 
             if i % 50 == 0:
                 print('Minibatch: %d, Generator Loss : %f, Discriminator Loss : %f' % (i, generator_loss, discriminator_loss))
 
+        time_elapsed_training = time.time() - start_time_training
+        print('Training Throughput: %.2f images/second, %.2f steps/second' % ((n_samples // step_size) * step_size / time_elapsed_training, (n_samples // step_size) / time_elapsed_training))
+
         #model.save(directory = model_dir, filename = model_name)
-        model.save(directory = model_dir, filename = model_name + '_' + str(epoch))
-
-        if validation_A_dir is not None:
-            final_output_dir = os.path.join(validation_A_output_dir, str(epoch))
-            if not os.path.exists(final_output_dir):
-                os.makedirs(final_output_dir)
-
-            for file in os.listdir(validation_A_dir):
-                filepath = os.path.join(validation_A_dir, file)
-                img = cv2.imread(filepath)
-                img_height, img_width, img_channel = img.shape
-                img = cv2.resize(img, (input_size[1], input_size[0]))
-                img = image_scaling(imgs = img)
-                img_converted = model.test(inputs = np.array([img]), direction = 'A2B')[0]
-                img_converted = image_scaling_inverse(imgs = img_converted)
-                img_converted = cv2.resize(img_converted, (img_width, img_height))
-                cv2.imwrite(os.path.join(final_output_dir, os.path.basename(file)), img_converted)
-
-        if validation_B_dir is not None:
-            final_output_dir = os.path.join(validation_B_output_dir, str(epoch))
-            if not os.path.exists(final_output_dir):
-                os.makedirs(final_output_dir)
-
-            for file in os.listdir(validation_B_dir):
-                filepath = os.path.join(validation_B_dir, file)
-                img = cv2.imread(filepath)
-                img_height, img_width, img_channel = img.shape
-                img = cv2.resize(img, (input_size[1], input_size[0]))
-                img = image_scaling(imgs = img)
-                img_converted = model.test(inputs = np.array([img]), direction = 'B2A')[0]
-                img_converted = image_scaling_inverse(imgs = img_converted)
-                img_converted = cv2.resize(img_converted, (img_width, img_height))
-                cv2.imwrite(os.path.join(final_output_dir, os.path.basename(file)), img_converted)
+        # The checkpoint is written in the background, the mean generator loss of the epoch is used to keep the best checkpoints
+        # Time spent here is copying the variables, or waiting for the previous checkpoint or validation to finish
+        with instrumentation.phase('checkpointing'):
+            checkpoint_manager.save(filename = model_name + '_' + str(epoch), epoch = epoch, metric = float(np.mean(generator_losses)), force = epoch == num_epochs - 1)
 
         end_time_epoch = time.time()
         time_elapsed_epoch = end_time_epoch - start_time_epoch
 
         print('Time Elapsed for This Epoch: %02d:%02d:%02d' % (time_elapsed_epoch // 3600, (time_elapsed_epoch % 3600 // 60), (time_elapsed_epoch % 60 // 1)))
 
+        epoch_summary = instrumentation.summary()
+        instrumentation.write_summary(writer = model.writer, step = epoch, summary = epoch_summary)
+        print('Metrics: ' + instrumentation.dump_summary(filepath = metrics_file, summary = epoch_summary, epoch = epoch))
+
+    checkpoint_manager.close()
+    if validator is not None:
+        validator.close()
+    if tracer is not None:
+        tracer.close()
+
 if __name__ == '__main__':
 
     parser = argparse.ArgumentParser(description = 'Train CycleGAN model for datasets.')
@@ -122,6 +186,8 @@ if __name__ == '__main__':
     parser.add_argument('--validation_A_dir', type = str, help = 'Convert validation A images after each training epoch. If set none, no conversion would be done during the training.', default = validation_A_dir_default)
     parser.add_argument('--validation_B_dir', type = str, help = 'Convert validation B images after each training epoch. If set none, no conversion would be done during the training.', default = None)
     parser.add_argument('--output_dir', type = str, help = 'Output directory for converted validation images.', default = output_dir_default)
+    parser.add_argument('--validation_interval', type = int, help = 'Convert validation images every this number of epochs.', default = 1)
+    parser.add_argument('--validation_batch_size', type = int, help = 'Number of validation images converted in one batch.', default = 4)
     parser.add_argument('--tensorboard_log_dir', type = str, help = 'TensorBoard log directory.', default = tensorboard_log_dir_default)
     parser.add_argument('--load_size_w', type=int,    help = 'The image load size', default = 1227)
     parser.add_argument('--load_size_h', type=int,    help = 'The image load size', default = 816)
@@ -130,11 +196,33 @@ if __name__ == '__main__':
     # For resolution 1024x1024, filter number is 16
     # For resolution 1024x512, filter number is 32
     # For resolution 512x512, filter number is 64
+    parser.add_argument('--patch_size_w', type=int,   help = 'Train on random patches of this width instead of the full fine size crops. Checkpoints still convert full resolution images', default = None)
+    parser.add_argument('--patch_size_h', type=int,   help = 'Train on random patches of this height instead of the full fine size crops. Checkpoints still convert full resolution images', default = None)
+    parser.add_argument('--num_patches', type=int,    help = 'Number of random patches sampled from each training image in one epoch', default = 1)
     parser.add_argument('--filter_number',      help='The filter number for the first convolutional layer', type=int, default=32)
     parser.add_argument('--lambda_cycle',       help='The cycle loss weight', type=int, default=10)
     parser.add_argument('--loss_function',      help='The loss function for generator and discrimator', type=str, default='l2')
     parser.add_argument('--epochs',             help='Maximum epochs for training', type=int, default=1000)
     parser.add_argument('--checkpoint',         help='Directory of the checkpoint to resume the training', type=str, default=None)
+    parser.add_argument('--streaming',          help='Read training images lazily with a parallel tf.data pipeline instead of loading them all into memory', action='store_true')
+    parser.add_argument('--mini_batch_size',    help='Number of samples for one training step', type=int, default=1)
+    parser.add_argument('--accumulation_steps', help='Number of mini batches whose gradients are accumulated for one update', type=int, default=1)
+    parser.add_argument('--fused_step',         help='Run the generator and discriminator updates in a single session run', action='store_true')
+    parser.add_argument('--keep_last',          help='Number of most recent checkpoints to keep. 0 keeps all checkpoints unless keep_every or keep_best is set', type=int, default=0)
+    parser.add_argument('--keep_every',         help='Also keep the checkpoint of every this number of epochs', type=int, default=0)
+    parser.add_argument('--keep_best',          help='Also keep this number of checkpoints with the lowest mean generator loss', type=int, default=0)
+    parser.add_argument('--save_interval',      help='Minimum number of seconds between two checkpoints. The last epoch is always saved', type=float, default=0)
+    parser.add_argument('--metrics_file',       help='File for the per epoch timing and memory metrics as JSON lines. Default is metrics.jsonl in the TensorBoard log directory', type=str, default=None)
+    parser.add_argument('--trace_allocations',  help='Also record Python memory allocations with tracemalloc', action='store_true')
+    parser.add_argument('--cache_dir',          help='Directory for the memory-mapped cache of decoded and resized training images. If not set, no cache is used', type=str, default=None)
+    parser.add_argument('--sampling_threads',   help='Number of threads cropping and scaling the training samples of each epoch', type=int, default=4)
+    parser.add_argument('--uint8_inputs',       help='Keep the sampled training crops as uint8 and scale them in the graph, which needs a quarter of the memory of float32 samples', action='store_true')
+    parser.add_argument('--graph_flips',        help='With --uint8_inputs, flip the training samples in the graph instead of while sampling', action='store_true')
+    parser.add_argument('--trace_start',        help='Capture op-level traces of the training steps from this step on', type=int, default=None)
+    parser.add_argument('--trace_steps',        help='Number of traced training steps', type=int, default=1)
+    parser.add_argument('--trace_on_signal',    help='Capture op-level traces of the next trace_steps training steps when the process receives SIGUSR1', action='store_true')
+    parser.add_argument('--trace_dir',          help='Directory for the Chrome traces and TensorBoard run metadata. Default is trace in the TensorBoard log directory', type=str, default=None)
+    parser.add_argument('--num_parallel_calls', help='Number of parallel workers decoding images in streaming mode', type=int, default=4)
 
     argv = parser.parse_args()
 
@@ -1,9 +1,12 @@
 
 import tensorflow as tf
 import os
+import json
+import hashlib
 import random
 import numpy as np
 import cv2
+from concurrent.futures import ThreadPoolExecutor
 
 
 def l1_loss(y, y_hat):
@@ -51,12 +54,41 @@ def read_img_modified(img_filepath, load_size_w=286, load_size_h=286, output_siz
     if np.random.random() >  0.5:
         img_output = np.fliplr(img_output)
 
-    # Image scaling
-    img_output = image_scaling(imgs = img_output)
+    # Image scaling in float32, NumPy would promote the uint8 image to float64
+    img_output = image_scaling(imgs = img_output.astype(np.float32))
 
     return img_output
 
 
+def tile_positions(length, tile_length, overlap):
+
+    # Start offsets of the tiles covering [0, length), the last tile is aligned to the end
+
+    if length <= tile_length:
+        return [0]
+
+    stride = tile_length - overlap
+    positions = list(range(0, length - tile_length, stride))
+    positions.append(length - tile_length)
+
+    return positions
+
+def tile_weights(tile_size_h, tile_size_w, overlap):
+
+    # Feathering window for blending overlapping tiles, the weights ramp up linearly within the overlap
+
+    def ramp(length):
+        weights = np.ones(length, dtype = np.float32)
+        num_ramp = min(overlap, length // 2)
+        if num_ramp > 0:
+            weights_ramp = np.arange(1, num_ramp + 1, dtype = np.float32) / (num_ramp + 1)
+            weights[:num_ramp] = weights_ramp
+            weights[-num_ramp:] = weights_ramp[::-1]
+        return weights
+
+    return np.outer(ramp(tile_size_h), ramp(tile_size_w))[:, :, np.newaxis]
+
+
 #def load_train_data(img_A_dir, img_B_dir, load_size = 286, output_size = 256):
 def load_train_data(img_A_dir, img_B_dir, load_size_w=286, load_size_h=286, output_size_w=256, output_size_h=256):
 
@@ -80,8 +112,69 @@ def load_train_data(img_A_dir, img_B_dir, load_size_w=286, load_size_h=286, outp
     return img_A_dataset, img_B_dataset
 
 
+def read_img_tensor(img_filepath, load_size_w=286, load_size_h=286, output_size_w=256, output_size_h=256, num_patches=1):
+
+    # Graph counterpart of cv2.imread + img_subsampling + image_scaling for the streaming input pipeline
+    # With num_patches > 1, a [num_patches, output_size_h, output_size_w, 3] tensor of independent random crops of the same image is returned
+
+    img = tf.image.decode_image(tf.read_file(img_filepath), channels = 3)
+    img.set_shape([None, None, 3])
+    # cv2 decodes to BGR, keep the same channel order as the rest of the repo
+    img = tf.reverse(img, axis = [-1])
+    img = tf.image.resize_images(img, [load_size_h, load_size_w])
+
+    def crop():
+        img_output = tf.random_crop(img, [output_size_h, output_size_w, 3])
+        # Flip image in the left/right direction
+        img_output = tf.image.random_flip_left_right(img_output)
+
+        # Image scaling
+        return image_scaling(imgs = img_output)
+
+    if num_patches == 1:
+        return crop()
+
+    return tf.stack([crop() for _ in range(num_patches)])
+
+
+def load_train_dataset(img_A_dir, img_B_dir, load_size_w=286, load_size_h=286, output_size_w=256, output_size_h=256, batch_size=1, num_parallel_calls=4, prefetch_size=2, random_seed=None, num_patches=1):
+
+    # Streaming alternative to load_data + sample_train_data
+    # File paths are read lazily, decoded, resized, cropped and flipped by parallel tf.data workers, and batches are prefetched ahead of the training step
+    # Returns the batch tensors for A and B, which could be passed to CycleGAN directly so that no feed_dict is needed, and the number of samples per epoch
+    # With num_patches > 1, every decoded image yields num_patches random patches of the output size, and an epoch has num_patches samples per image
+
+    def image_dataset(img_dir):
+
+        img_filepaths = sorted([os.path.join(img_dir, file) for file in os.listdir(img_dir) if os.path.isfile(os.path.join(img_dir, file))])
+        dataset = tf.data.Dataset.from_tensor_slices(img_filepaths)
+        # Reshuffled on every pass over the directory
+        dataset = dataset.shuffle(buffer_size = len(img_filepaths), seed = random_seed).repeat()
+        dataset = dataset.map(lambda filepath: read_img_tensor(img_filepath = filepath, load_size_w = load_size_w, load_size_h = load_size_h, output_size_w = output_size_w, output_size_h = output_size_h,
+                                                               num_patches = num_patches),
+                              num_parallel_calls = num_parallel_calls)
+        if num_patches > 1:
+            # Split the patches into samples and mix the patches of neighbouring images
+            dataset = dataset.flat_map(tf.data.Dataset.from_tensor_slices).shuffle(buffer_size = num_patches * 4, seed = random_seed)
+
+        return dataset, len(img_filepaths) * num_patches
+
+    dataset_A, num_samples_A = image_dataset(img_dir = img_A_dir)
+    dataset_B, num_samples_B = image_dataset(img_dir = img_B_dir)
+
+    dataset = tf.data.Dataset.zip((dataset_A, dataset_B))
+    dataset = dataset.batch(batch_size).prefetch(prefetch_size)
+
+    input_A, input_B = dataset.make_one_shot_iterator().get_next()
+
+    return input_A, input_B, min(num_samples_A, num_samples_B)
+
+
 #def load_data(img_dir, load_size = 256):
-def load_data(img_dir, load_size_w=256, load_size_h=256):
+def load_data(img_dir, load_size_w=256, load_size_h=256, cache_dir=None):
+
+    if cache_dir is not None:
+        return load_data_cached(img_dir = img_dir, load_size_w = load_size_w, load_size_h = load_size_h, cache_dir = cache_dir)
 
     img_filepaths = [os.path.join(img_dir, file) for file in os.listdir(img_dir) if os.path.isfile(os.path.join(img_dir, file))]
     img_dataset = [cv2.resize(cv2.imread(filepath), (load_size_w, load_size_h)) for filepath in img_filepaths]
@@ -89,10 +182,69 @@ def load_data(img_dir, load_size_w=256, load_size_h=256):
 
     return img_dataset
 
+def load_data_cached(img_dir, load_size_w=256, load_size_h=256, cache_dir='./cache'):
+
+    # The decoded and resized images are kept in a uint8 .npy file together with a JSON index of the file names, sizes and mtimes
+    # If the directory has not changed, the cache is opened as a read-only memmap without decoding anything
+    # Otherwise only added or modified files are decoded, and the rows of unchanged files are copied from the previous cache
+
+    img_files = sorted([file for file in os.listdir(img_dir) if os.path.isfile(os.path.join(img_dir, file))])
+    entries = list()
+    for file in img_files:
+        stat = os.stat(os.path.join(img_dir, file))
+        entries.append([file, stat.st_size, stat.st_mtime_ns])
+
+    if not os.path.exists(cache_dir):
+        os.makedirs(cache_dir)
+
+    cache_name = hashlib.sha1(('%s_%d_%d' % (os.path.abspath(img_dir), load_size_w, load_size_h)).encode('utf-8')).hexdigest()
+    data_filepath = os.path.join(cache_dir, cache_name + '.npy')
+    index_filepath = os.path.join(cache_dir, cache_name + '.json')
+
+    cached_dataset = None
+    cached_rows = dict()
+    if os.path.exists(index_filepath) and os.path.exists(data_filepath):
+        with open(index_filepath, 'r') as f:
+            index = json.load(f)
+        cached_dataset = np.load(data_filepath, mmap_mode = 'r')
+        if index['entries'] == entries:
+            return cached_dataset
+        cached_rows = {tuple(entry): row for row, entry in enumerate(index['entries'])}
+
+    # Write the new cache to a temporary file first so that an interrupted run never leaves a truncated cache behind
+    temp_filepath = data_filepath + '.tmp'
+    img_dataset = np.lib.format.open_memmap(temp_filepath, mode = 'w+', dtype = np.uint8, shape = (len(entries), load_size_h, load_size_w, 3))
+    num_decoded = 0
+    for row, entry in enumerate(entries):
+        cached_row = cached_rows.get(tuple(entry))
+        if cached_row is not None:
+            img_dataset[row] = cached_dataset[cached_row]
+        else:
+            img_dataset[row] = cv2.resize(cv2.imread(os.path.join(img_dir, entry[0])), (load_size_w, load_size_h))
+            num_decoded += 1
+    img_dataset.flush()
+    del img_dataset, cached_dataset
+
+    # The index is removed before the data is replaced, so a crash in between only causes a rebuild
+    if os.path.exists(index_filepath):
+        os.remove(index_filepath)
+    os.replace(temp_filepath, data_filepath)
+    with open(index_filepath + '.tmp', 'w') as f:
+        json.dump({'img_dir': os.path.abspath(img_dir), 'load_size_w': load_size_w, 'load_size_h': load_size_h, 'entries': entries}, f)
+    os.replace(index_filepath + '.tmp', index_filepath)
+
+    print('Image cache for %s: %d decoded, %d reused' % (img_dir, num_decoded, len(entries) - num_decoded))
+
+    return np.load(data_filepath, mmap_mode = 'r')
+
 #def img_subsampling(img, load_size, output_size):
 def img_subsampling(img, load_size_w, load_size_h, output_size_w, output_size_h):
 
-    img_enlarged = cv2.resize(img, (load_size_w, load_size_h))
+    # Images from load_data are already at the load size
+    if img.shape[0] != load_size_h or img.shape[1] != load_size_w:
+        img_enlarged = cv2.resize(img, (load_size_w, load_size_h))
+    else:
+        img_enlarged = img
 
     h_start = np.random.randint(load_size_h - output_size_h + 1)
     h_end = h_start + output_size_h
@@ -107,41 +259,79 @@ def img_subsampling(img, load_size_w, load_size_h, output_size_w, output_size_h)
 
     return img_output
 
+def sample_crops(img_dataset, indices, load_size_w, load_size_h, output_size_w, output_size_h, num_threads = 1, scale = True, flip = True):
+
+    # Batched img_subsampling + image_scaling
+    # The crop offsets and flips of all samples are drawn at once, and the scaled crops are written into one preallocated float32 buffer
+    # With scale = False the crops are kept as uint8, a quarter of the float32 memory, and have to be scaled in the graph, e.g. by CycleGAN with input_dtype = 'uint8'
+    # With flip = False no crop is flipped, e.g. if the flips are done in the graph
+
+    num_samples = len(indices)
+    h_starts = np.random.randint(load_size_h - output_size_h + 1, size = num_samples)
+    w_starts = np.random.randint(load_size_w - output_size_w + 1, size = num_samples)
+    flips = np.random.random(num_samples) > 0.5
+
+    img_output = np.empty([num_samples, output_size_h, output_size_w, 3], dtype = np.float32 if scale else np.uint8)
+
+    def crop(i):
+        img = img_dataset[indices[i]]
+        if img.shape[0] != load_size_h or img.shape[1] != load_size_w:
+            img = cv2.resize(img, (load_size_w, load_size_h))
+        img_crop = img[h_starts[i]:h_starts[i] + output_size_h, w_starts[i]:w_starts[i] + output_size_w]
+        # Flip image in the left/right direction
+        if flip and flips[i]:
+            img_crop = img_crop[:, ::-1]
+        img_output[i] = img_crop
+        # Image scaling in place
+        if scale:
+            img_output[i] *= 1 / 127.5
+            img_output[i] -= 1
+
+    # NumPy and OpenCV release the GIL for the copies, so threads could work on different samples in parallel
+    if num_threads > 1:
+        with ThreadPoolExecutor(max_workers = num_threads) as executor:
+            list(executor.map(crop, range(num_samples)))
+    else:
+        for i in range(num_samples):
+            crop(i)
+
+    return img_output
+
 #def sample_train_data(img_A_dataset, img_B_dataset, load_size = 286, output_size = 256, batch_size_maximum = 1000):
-def sample_train_data(img_A_dataset, img_B_dataset, load_size_w = 286, load_size_h = 286, output_size_w = 256, output_size_h = 256, batch_size_maximum = 1000):
+def sample_train_data(img_A_dataset, img_B_dataset, load_size_w = 286, load_size_h = 286, output_size_w = 256, output_size_h = 256, batch_size_maximum = 1000, num_threads = 1, num_patches = 1, scale = True, flip = True):
+
+    # With num_patches > 1, num_patches random patches of the output size are cropped from each sampled image, in random order
+    # batch_size_maximum counts images, so an epoch has up to batch_size_maximum * num_patches samples
+    # scale and flip as in sample_crops
 
     num_samples = min(len(img_A_dataset), len(img_B_dataset), batch_size_maximum)
     train_data_A_idx = np.arange(len(img_A_dataset))
     train_data_B_idx = np.arange(len(img_B_dataset))
     np.random.shuffle(train_data_A_idx)
     np.random.shuffle(train_data_B_idx)
+    train_data_A_idx = train_data_A_idx[:num_samples]
+    train_data_B_idx = train_data_B_idx[:num_samples]
+    if num_patches > 1:
+        train_data_A_idx = np.random.permutation(np.repeat(train_data_A_idx, num_patches))
+        train_data_B_idx = np.random.permutation(np.repeat(train_data_B_idx, num_patches))
 
-    img_A_subset = img_A_dataset[train_data_A_idx[:num_samples]]
-    img_B_subset = img_B_dataset[train_data_B_idx[:num_samples]]
-
-    train_data_A = list()
-    train_data_B = list()
-
-    for img in img_A_subset:
-        img_output = img_subsampling(img = img, load_size_w=load_size_w, load_size_h=load_size_h, output_size_w = output_size_w, output_size_h=output_size_h)
-        img_output = image_scaling(imgs = img_output)
-        train_data_A.append(img_output)
-
-    for img in img_B_subset:
-        img_output = img_subsampling(img = img, load_size_w=load_size_w, load_size_h=load_size_h, output_size_w = output_size_w, output_size_h=output_size_h)
-        img_output = image_scaling(imgs = img_output)
-        train_data_B.append(img_output)
-
-    train_data_A = np.array(train_data_A)
-    train_data_B = np.array(train_data_B)
+    train_data_A = sample_crops(img_dataset = img_A_dataset, indices = train_data_A_idx, load_size_w = load_size_w, load_size_h = load_size_h,
+                                output_size_w = output_size_w, output_size_h = output_size_h, num_threads = num_threads, scale = scale, flip = flip)
+    train_data_B = sample_crops(img_dataset = img_B_dataset, indices = train_data_B_idx, load_size_w = load_size_w, load_size_h = load_size_h,
+                                output_size_w = output_size_w, output_size_h = output_size_h, num_threads = num_threads, scale = scale, flip = flip)
 
     return train_data_A, train_data_B
 
+def save_generator_config(filepath, num_filters, generator_config):
 
+    # The generator architecture of a checkpoint, e.g. a distilled student generator, is stored next to it as JSON
+    with open(filepath, 'w') as f:
+        json.dump({'num_filters': num_filters, 'generator_config': generator_config}, f, indent = 2)
 
+def load_generator_config(filepath):
 
+    # Returns num_filters and the generator keyword arguments for CycleGAN
+    with open(filepath) as f:
+        config = json.load(f)
 
-
-
-
-
+    return config['num_filters'], config['generator_config']
@@ -0,0 +1,93 @@
+import cv2
+import os
+import queue
+import threading
+import numpy as np
+import tensorflow as tf
+
+from model import CycleGAN
+from utils import image_scaling
+from convert import write_image
+
+class Validator(object):
+
+    # Converts the validation images in a background thread while training continues
+    # The validation images are decoded and resized once. Every submitted checkpoint is restored into a separate inference-only model and the images are converted in batches
+    # validation_dirs and output_dirs map the conversion directions to the validation image directories and the output directories
+
+    def __init__(self, validation_dirs, output_dirs, input_size, num_filters, batch_size = 8):
+
+        self.output_dirs = output_dirs
+        self.batch_size = batch_size
+        self.datasets = {direction: self.preprocess(img_dir = img_dir, input_size = input_size) for direction, img_dir in validation_dirs.items()}
+
+        # The validation model lives in its own graph and session, so it does not interfere with the training graph
+        with tf.Graph().as_default():
+            self.model = CycleGAN(input_size = input_size, num_filters = num_filters, mode = 'test', directions = list(validation_dirs.keys()))
+
+        # At most one validation is pending, submit blocks if the validation falls behind
+        self.checkpoints = queue.Queue(maxsize = 1)
+        # Exception of a failed validation, raised in the training thread by submit and close
+        self.error = None
+        self.thread = threading.Thread(target = self.run)
+        self.thread.daemon = True
+        self.thread.start()
+
+    def preprocess(self, img_dir, input_size):
+
+        files = list()
+        imgs = list()
+        img_shapes = list()
+        for file in os.listdir(img_dir):
+            img = cv2.imread(os.path.join(img_dir, file))
+            if img is None:
+                continue
+            files.append(file)
+            img_shapes.append(img.shape[:2])
+            imgs.append(cv2.resize(img, (input_size[1], input_size[0])))
+
+        return files, np.array(imgs), img_shapes
+
+    def submit(self, checkpoint, epoch, callback = None):
+
+        # callback is called with the checkpoint path once the checkpoint is no longer needed, also if the validation fails or is skipped
+        if self.error is not None:
+            raise self.error
+        self.checkpoints.put((checkpoint, epoch, callback))
+
+    def run(self):
+
+        while True:
+            item = self.checkpoints.get()
+            if item is None:
+                break
+            checkpoint, epoch, callback = item
+            # After a failure the queue is still drained, so that submit and close do not block
+            try:
+                if self.error is None:
+                    self.validate(checkpoint = checkpoint, epoch = epoch)
+            except Exception as e:
+                self.error = e
+            finally:
+                if callback is not None:
+                    callback(checkpoint)
+
+    def validate(self, checkpoint, epoch):
+
+        self.model.load(filepath = checkpoint)
+        for direction, (files, imgs, img_shapes) in self.datasets.items():
+            final_output_dir = os.path.join(self.output_dirs[direction], str(epoch))
+            if not os.path.exists(final_output_dir):
+                os.makedirs(final_output_dir)
+            for start in range(0, len(files), self.batch_size):
+                imgs_converted = self.model.test(inputs = image_scaling(imgs = imgs[start:start + self.batch_size].astype(np.float32)), direction = direction)
+                for file, img_converted, img_shape in zip(files[start:start + self.batch_size], imgs_converted, img_shapes[start:start + self.batch_size]):
+                    write_image(filepath = os.path.join(final_output_dir, os.path.basename(file)), img_converted = img_converted, img_shape = img_shape)
+
+    def close(self):
+
+        # Wait for the pending validation to finish
+        self.checkpoints.put(None)
+        self.thread.join()
+        if self.error is not None:
+            raise self.error